@@ -1,26 +1,51 @@
-from flask import Flask, request, render_template, redirect, url_for, session, g, jsonify
+from flask import Flask, request, render_template, redirect, url_for, session, jsonify
 import os
 import sqlite3
+import sys
 import requests
 import logging
-from werkzeug.security import generate_password_hash, check_password_hash
 from dotenv import load_dotenv
 from openai import OpenAI  # Updated import
 from twilio.rest import Client
 from apscheduler.schedulers.background import BackgroundScheduler
 from datetime import datetime, timedelta  # Added timedelta
-from geopy.geocoders import Nominatim
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from pytz import timezone
 import re
 import json
 import pytz
+from shards import ensure_shards, ShardLeaseManager
+from simulation import simulate_daily_run
+from pipeline import format_weather_message, SendPipeline, ZIPCODE_INDEX_SQL
+import database
+from database import DATABASE, get_db
+from users import (count_users, find_user_by_phone, forget_user, get_profile, get_user, iter_users,
+                   phone_registered, update_contact, update_password, update_preferences)
+from preferences import migrate_preferences, preferences_bp, TEMPERATURE_SENSITIVITIES
+from profile_cache import profile_cache
+from passwords import hasher, PasswordHasherBusy
+from ratelimit import parse_rate
+from security import get_remote_addr, rate_limit_by_ip, SecurityManager
+from bruteforce import failed_logins
+from config import get_config
+from logconfig import configure_logging
+from monitoring import record_token_usage, setup_monitoring, track_api_request
+from tracing import init_tracing
+from geocode import backfill_coordinates, geocode_zip
+from catchup import dispatch_window, ensure_catchup, mark_dispatched
+from runs import ensure_runs, install_shutdown_handler, resumable_runs
+from ledger import claim_daily_send, ensure_ledger, mark_daily_send, release_daily_send
+from dispatcher import (due_users_query, format_send_minute, migrate_send_minute, parse_preferred_time,
+                        rebuild_schedule, reconcile_jobs, remove_legacy_jobs, reschedule_user, schedule_dispatcher,
+                        DEFAULT_SEND_MINUTE, DISPATCH_JOB_ID)
+
+configure_logging()
+logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
 
 # Constants and OpenAI client setup
-DATABASE = 'jacket_app.db'
 OPENWEATHERMAP_API_KEY = os.environ.get("OPENWEATHERMAP_API_KEY")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 client = OpenAI(api_key=OPENAI_API_KEY)  # Initialize client once
@@ -35,26 +60,56 @@ class WeatherAPIException(Exception):
     pass
 
 # Add debug logging for API keys at startup
-logging.info("[INIT] Checking environment variables:")
-logging.info(f"[INIT] OpenAI API Key present: {bool(OPENAI_API_KEY)}")
-logging.info(f"[INIT] Twilio credentials present: {bool(os.getenv('TWILIO_ACCOUNT_SID'))} / {bool(os.getenv('TWILIO_AUTH_TOKEN'))}")
-logging.info(f"[INIT] Twilio phone number: {os.getenv('TWILIO_PHONE_NUMBER')}")
+logger.info("[INIT] Checking environment variables:")
+logger.info("[INIT] OpenAI API Key present: %s", bool(OPENAI_API_KEY))
+logger.info("[INIT] Twilio credentials present: %s / %s",
+            bool(os.getenv('TWILIO_ACCOUNT_SID')), bool(os.getenv('TWILIO_AUTH_TOKEN')))
+logger.info("[INIT] Twilio phone number: %s", os.getenv('TWILIO_PHONE_NUMBER'))
 
 # Add debug logging for environment variables at startup
-logging.info("[ENV] Checking environment variables:")
-logging.info(f"[ENV] TWILIO_ACCOUNT_SID: {'Present' if os.getenv('TWILIO_ACCOUNT_SID') else 'Missing'}")
-logging.info(f"[ENV] TWILIO_AUTH_TOKEN: {'Present' if os.getenv('TWILIO_AUTH_TOKEN') else 'Missing'}")
-logging.info(f"[ENV] TWILIO_PHONE_NUMBER: {os.getenv('TWILIO_PHONE_NUMBER')}")
-logging.info(f"[ENV] OPENWEATHERMAP_API_KEY: {'Present' if OPENWEATHERMAP_API_KEY else 'Missing'}")
-logging.info(f"[ENV] OPENAI_API_KEY: {'Present' if OPENAI_API_KEY else 'Missing'}")
+logger.info("[ENV] Checking environment variables:")
+logger.info("[ENV] TWILIO_ACCOUNT_SID: %s", 'Present' if os.getenv('TWILIO_ACCOUNT_SID') else 'Missing')
+logger.info("[ENV] TWILIO_AUTH_TOKEN: %s", 'Present' if os.getenv('TWILIO_AUTH_TOKEN') else 'Missing')
+logger.info("[ENV] TWILIO_PHONE_NUMBER: %s", os.getenv('TWILIO_PHONE_NUMBER'))
+logger.info("[ENV] OPENWEATHERMAP_API_KEY: %s", 'Present' if OPENWEATHERMAP_API_KEY else 'Missing')
+logger.info("[ENV] OPENAI_API_KEY: %s", 'Present' if OPENAI_API_KEY else 'Missing')
+
+# Upstream calls, each timed and sized by track_api_request
+@track_api_request('openai', 'chat_completion')
+def create_chat_completion(**params):
+    """Call the chat completions API, returning the raw response."""
+    return client.chat.completions.with_raw_response.create(**params)
+
+def chat_completion(**params):
+    """Create a chat completion and count the tokens it used."""
+    response = create_chat_completion(**params).parse()
+    record_token_usage('openai', 'chat_completion', response.usage)
+    return response
+
+@track_api_request('openweathermap', 'current')
+def fetch_current_weather(url):
+    response = requests.get(url)
+    response.raise_for_status()
+    return response
+
+@track_api_request('openweathermap', 'forecast')
+def fetch_forecast(lat, lon):
+    url = f"http://api.openweathermap.org/data/2.5/forecast?lat={lat}&lon={lon}&units=imperial&appid={OPENWEATHERMAP_API_KEY}"
+    response = requests.get(url)
+    response.raise_for_status()
+    return response
+
+@track_api_request('twilio', 'send_sms', payload_size=lambda message: len((message.body or '').encode()))
+def create_sms(twilio_client, **params):
+    return twilio_client.messages.create(**params)
 
 # Utility functions
 def generate_jacket_recommendation(temperature_f, wind_speed, condition):
     """Generate a short, friendly jacket recommendation."""
-    logging.info(f"[OPENAI] Generating recommendation for {temperature_f}°F")
+    logger.debug("[OPENAI] Generating recommendation for %s°F", temperature_f)
     
     if not OPENAI_API_KEY:
-        logging.error("[OPENAI] No API key available")
+        logger.error("[OPENAI] No API key available")
         return get_fallback_recommendation(temperature_f)
     
     try:
@@ -63,7 +118,7 @@ def generate_jacket_recommendation(temperature_f, wind_speed, condition):
             "provide a SHORT (max 15 words), complete jacket recommendation. Be direct and friendly."
         )
         
-        response = client.chat.completions.create(
+        response = chat_completion(
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": "You are a helpful weather assistant. Keep responses under 15 words."},
@@ -73,10 +128,10 @@ def generate_jacket_recommendation(temperature_f, wind_speed, condition):
             temperature=0.7
         )
         recommendation = response.choices[0].message.content.strip()
-        logging.info(f"[OPENAI] Success: {recommendation}")
+        logger.debug("[OPENAI] Success: %s", recommendation)
         return recommendation
     except Exception as e:
-        logging.error(f"[OPENAI] Error: {str(e)}")
+        logger.error("[OPENAI] Error: %s", e)
         return get_fallback_recommendation(temperature_f)
 
 def get_fallback_recommendation(temperature_f):
@@ -94,12 +149,9 @@ def should_wear_jacket(weather_data):
     condition = weather_data['weather'][0]['main']
     return generate_jacket_recommendation(temperature, wind_speed, condition)
 
-def get_db():
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
-    return db
+def connect_db():
+    """Open a new connection, e.g. for threads outside the request context."""
+    return database.connect(DATABASE)
 
 def init_db():
     """Initialize the database and create tables"""
@@ -108,45 +160,72 @@ def init_db():
         # Define the schema directly here instead of reading from file
         schema = '''
         DROP TABLE IF EXISTS users;
+        DROP TABLE IF EXISTS user_preferences;
+        DROP TABLE IF EXISTS daily_sends;
         CREATE TABLE users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             phone_number TEXT NOT NULL UNIQUE,
             password TEXT NOT NULL,
             zipcode TEXT,
             preferred_time TEXT DEFAULT '07:30',
+            send_minute INTEGER DEFAULT 450,
             temperature_sensitivity TEXT DEFAULT 'Normal',
+            temperature_unit TEXT DEFAULT 'F',
             latitude REAL,
             longitude REAL,
             weather_notification_temp INTEGER DEFAULT 32,
             weather_notification_condition TEXT DEFAULT 'Snow'
         );
+        CREATE INDEX idx_users_send_minute ON users (send_minute, id);
+        CREATE INDEX idx_users_zipcode ON users (zipcode, id);
         '''
         db.executescript(schema)
+        ensure_ledger(db)
+        ensure_shards(db)
+        ensure_catchup(db)
+        ensure_runs(db)
         db.commit()
-        logging.info("[DB] Database initialized successfully")
+        # Every cached profile belongs to a user that was just dropped
+        profile_cache.clear()
+        logger.info("[DB] Database initialized successfully")
     except Exception as e:
-        logging.error(f"[DB] Error initializing database: {e}")
+        logger.error("[DB] Error initializing database: %s", e)
         raise
 
+def migrate_db():
+    """Bring an existing database up to the current schema."""
+    with app.app_context():
+        db = get_db()
+        if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'").fetchone() is None:
+            init_db()
+            return
+        migrate_send_minute(db)
+        migrate_preferences(db)
+        db.execute(ZIPCODE_INDEX_SQL)
+        ensure_ledger(db)
+        ensure_shards(db)
+        ensure_catchup(db)
+        ensure_runs(db)
+        # Only the local index is used here, so startup never waits on Nominatim
+        if backfill_coordinates(db):
+            profile_cache.clear()
+
 def get_coordinates(zipcode):
-    try:
-        geolocator = Nominatim(user_agent="jacket-app")
-        location = geolocator.geocode({"postalcode": zipcode, "country": "US"})
-        if location:
-            return location.latitude, location.longitude
-        return None, None
-    except Exception as e:
-        logging.error(f"Error fetching coordinates: {e}")
-        return None, None
+    """Look up a ZIP's centroid in the local index, see geocode.py.
+
+    Never calls out to the network; ZIPs the index lacks are filled in by
+    backfill_missing_coordinates.
+    """
+    return geocode_zip(zipcode)
 
 def validate_phone(phone):
     """Validates a 10-digit US phone number."""
     # Remove any non-digit characters
     digits = ''.join(filter(str.isdigit, phone))
     if len(digits) == 10:
-        logging.info(f"Valid phone number: {digits}")
+        logger.debug("Valid phone number: %s", digits)
         return True
-    logging.error(f"Invalid phone number: {phone} (digits: {digits})")
+    logger.error("Invalid phone number: %s (digits: %s)", phone, digits)
     return False
 
 def format_phone_number(phone):
@@ -159,44 +238,51 @@ def format_phone_number(phone):
         digits = digits[1:]
     
     if not validate_phone(digits):
-        logging.error(f"Phone validation failed for: {phone}")
+        logger.error("Phone validation failed for: %s", phone)
         raise ValueError("Invalid phone number. Please enter a 10-digit US phone number.")
     
     formatted = f'+1{digits}'
-    logging.info(f"Formatted phone number: {formatted}")
+    logger.debug("Formatted phone number: %s", formatted)
     return formatted
 
 def create_user(phone, password, zipcode, preferred_time, temperature_sensitivity):
-    logging.info(f"[REGISTRATION] Creating user with phone: {phone}")
+    logger.debug("[REGISTRATION] Creating user with phone: %s", phone)
     
     if not phone or not password:
-        logging.error("[REGISTRATION] Missing required fields")
+        logger.error("[REGISTRATION] Missing required fields")
         raise ValueError("Phone number and password are required")
     
     try:
         formatted_phone = format_phone_number(phone)
-        logging.info(f"[REGISTRATION] Formatted phone: {formatted_phone}")
+        logger.debug("[REGISTRATION] Formatted phone: %s", formatted_phone)
         
         db = get_db()
-        existing_user = db.execute('SELECT * FROM users WHERE phone_number = ?', [formatted_phone]).fetchone()
-        if existing_user:
-            logging.error(f"[REGISTRATION] Phone number already registered: {formatted_phone}")
+        if phone_registered(formatted_phone):
+            logger.error("[REGISTRATION] Phone number already registered: %s", formatted_phone)
             raise ValueError("Phone number is already registered")
         
-        hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
+        send_minute = parse_preferred_time(preferred_time)
+        if send_minute is None:
+            send_minute = DEFAULT_SEND_MINUTE
+        
+        latitude, longitude = get_coordinates(zipcode)
+        
+        hashed_password = hasher.hash(password)
         db.execute('''
-            INSERT INTO users (phone_number, password, zipcode, preferred_time, temperature_sensitivity) 
-            VALUES (?, ?, ?, ?, ?)
-        ''', [formatted_phone, hashed_password, zipcode, preferred_time, temperature_sensitivity])
+            INSERT INTO users (phone_number, password, zipcode, preferred_time, send_minute,
+                               temperature_sensitivity, latitude, longitude) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [formatted_phone, hashed_password, zipcode, format_send_minute(send_minute, '%H:%M'),
+              send_minute, temperature_sensitivity, latitude, longitude])
         db.commit()
         
         # Verify user was created
-        new_user = db.execute('SELECT * FROM users WHERE phone_number = ?', [formatted_phone]).fetchone()
-        logging.info(f"[REGISTRATION] User created successfully: {dict(new_user)}")
+        new_user = find_user_by_phone(formatted_phone, view='contact')
+        logger.info("[REGISTRATION] User created successfully: %s", new_user['id'])
         
     except Exception as e:
-        logging.error(f"[REGISTRATION] Error creating user: {str(e)}")
-        logging.exception("[REGISTRATION] Full exception details:")
+        logger.error("[REGISTRATION] Error creating user: %s", e)
+        logger.exception("[REGISTRATION] Full exception details:")
         raise
 
 def create_app():
@@ -207,52 +293,64 @@ def create_app():
     return app
 
 app = create_app()
-
-@app.teardown_appcontext
-def close_db(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+database.init_app(app)
+app.register_blueprint(preferences_bp)
+security_manager = SecurityManager(app)
+setup_monitoring(app)
+init_tracing(app)
 
 @app.route('/')
 def index():
     return render_template('login.html')
 
 @app.route('/login', methods=['GET', 'POST'])
+@rate_limit_by_ip(*parse_rate(get_config().RATELIMIT_LOGIN), methods=('POST',))
 def login():
     if request.method == 'POST':
         try:
             phone = request.form['phone']
             password = request.form['password']
-            logging.info(f"[LOGIN] Attempt for phone: {phone}")
+            logger.debug("[LOGIN] Attempt for phone: %s", phone)
             
             formatted_phone = format_phone_number(phone)
-            logging.info(f"[LOGIN] Formatted phone: {formatted_phone}")
+            logger.debug("[LOGIN] Formatted phone: %s", formatted_phone)
             
-            db = get_db()
-            user = db.execute('SELECT * FROM users WHERE phone_number = ?', [formatted_phone]).fetchone()
+            client_ip = get_remote_addr()
+            if failed_logins.is_blocked(formatted_phone, client_ip):
+                logger.warning("[LOGIN] Too many failed attempts for %s from %s", formatted_phone, client_ip)
+                return "Too many failed attempts, please try again later", 429
+            
+            user = find_user_by_phone(formatted_phone)
             
             if user:
-                logging.info(f"[LOGIN] User found: {dict(user)}")
-                if check_password_hash(user['password'], password):
-                    logging.info(f"[LOGIN] Password valid for user {user['id']}")
+                logger.debug("[LOGIN] User found: %s", user['id'])
+                if hasher.verify(user['password'], password):
+                    logger.info("[LOGIN] Password valid for user %s", user['id'])
+                    if hasher.needs_rehash(user['password']):
+                        update_password(user['id'], hasher.hash(password))
+                        logger.info("[LOGIN] Upgraded password hash for user %s", user['id'])
+                    failed_logins.clear(formatted_phone, client_ip)
                     session['user_id'] = user['id']
                     return redirect(url_for('dashboard'))
                 else:
-                    logging.error(f"[LOGIN] Invalid password for user {user['id']}")
+                    logger.error("[LOGIN] Invalid password for user %s", user['id'])
             else:
-                logging.error(f"[LOGIN] No user found with phone: {formatted_phone}")
+                logger.error("[LOGIN] No user found with phone: %s", formatted_phone)
             
+            failed_logins.record_failure(formatted_phone, client_ip)
             return "Invalid phone number or password"
             
+        except PasswordHasherBusy:
+            return "Too many sign-ins right now, please try again shortly", 503, {'Retry-After': '5'}
         except Exception as e:
-            logging.error(f"[LOGIN] Error during login: {str(e)}")
-            logging.exception("[LOGIN] Full exception details:")
+            logger.error("[LOGIN] Error during login: %s", e)
+            logger.exception("[LOGIN] Full exception details:")
             return "Error during login"
     
     return render_template('login.html')
 
 @app.route('/register', methods=['GET', 'POST'])
+@rate_limit_by_ip(*parse_rate(get_config().RATELIMIT_REGISTER), methods=('POST',))
 def register():
     if request.method == 'POST':
         phone = request.form['phone']
@@ -269,6 +367,8 @@ def register():
             return redirect(url_for('login'))
         except ValueError as e:
             return str(e)
+        except PasswordHasherBusy:
+            return "Too many sign-ups right now, please try again shortly", 503, {'Retry-After': '5'}
     return render_template('register.html')
 
 @app.route('/dashboard')
@@ -276,29 +376,17 @@ def dashboard():
     if 'user_id' not in session:
         return redirect(url_for('login'))
         
-    db = get_db()
-    user = db.execute('SELECT * FROM users WHERE id = ?', [session['user_id']]).fetchone()
+    user = get_profile(session['user_id'])
     
     if user is None:
         # If user not found, clear session and redirect to login
         session.clear()
         return redirect(url_for('login'))
     
-    try:
-        preferred_time = user["preferred_time"] or "07:30"  # Default if None
-        
-        if "AM" in preferred_time.upper() or "PM" in preferred_time.upper():
-            formatted_time = datetime.strptime(preferred_time, "%I:%M %p").strftime("%I:%M %p")
-        else:
-            formatted_time = datetime.strptime(preferred_time, "%H:%M").strftime("%I:%M %p")
-    except Exception as e:
-        logging.error(f"Error formatting time: {e}")
-        formatted_time = "07:30 AM"  # Default on error
-    
     form_data = {
         "zipcode": user["zipcode"] or "",
         "phone": user["phone_number"],
-        "preferred_time": formatted_time,
+        "preferred_time": format_send_minute(user["send_minute"]),
         "latitude": user["latitude"],
         "longitude": user["longitude"]
     }
@@ -310,8 +398,7 @@ def get_current_weather():
         return jsonify({'error': 'Not logged in'}), 401
 
     try:
-        db = get_db()
-        user = db.execute('SELECT * FROM users WHERE id = ?', [session['user_id']]).fetchone()
+        user = get_profile(session['user_id'])
         
         if user is None:
             return jsonify({'error': 'User not found'}), 404
@@ -339,7 +426,7 @@ def get_current_weather():
             'icon_url': icon_url
         })
     except Exception as e:
-        logging.error(f"Error in get_current_weather: {e}")
+        logger.error("Error in get_current_weather: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/profile', methods=['GET', 'POST'])
@@ -350,84 +437,53 @@ def profile():
     if request.method == 'POST':
         try:
             form_data = request.form.to_dict()
-            logging.info(f"Received profile update data: {form_data}")
+            logger.info("Received profile update data: %s", form_data)
             
             phone = format_phone_number(form_data.get('phone', ''))
             preferred_time = form_data.get('preferred_time', '07:30 AM')
-            formatted_time = datetime.strptime(preferred_time, "%I:%M %p").strftime("%H:%M")
+            send_minute = parse_preferred_time(preferred_time)
+            if send_minute is None:
+                raise ValueError(f"Invalid preferred time: {preferred_time}")
             
             # Update user
             db = get_db()
-            db.execute('''
-                UPDATE users 
-                SET zipcode = ?,
-                    phone_number = ?,
-                    preferred_time = ?
-                WHERE id = ?
-            ''', [
-                form_data.get('zipcode'),
-                phone,
-                formatted_time,
-                session['user_id']
-            ])
-            db.commit()
+            update_contact(session['user_id'], form_data.get('zipcode'), phone)
+            
+            # Only this user's send minute changes; the dispatcher job stays as is
+            reschedule_user(db, session['user_id'], send_minute)
+            forget_user(session['user_id'])
+            
+            sensitivity = form_data.get('temperature_sensitivity')
+            if sensitivity in TEMPERATURE_SENSITIVITIES:
+                unit = get_profile(session['user_id'])['temperature_unit'] or 'F'
+                update_preferences(session['user_id'], unit, sensitivity)
             
-            # Update scheduler with new time
             try:
-                dt = datetime.strptime(preferred_time, "%I:%M %p")
-                hour, minute = dt.hour, dt.minute
-                
                 global scheduler
                 if scheduler is None or not scheduler.running:
                     scheduler = init_scheduler()
-                else:
-                    job = scheduler.add_job(
-                        func=send_daily_weather_update,
-                        trigger='cron',
-                        hour=hour,
-                        minute=minute,
-                        id='daily_weather_job',
-                        replace_existing=True
-                    )
-                    logging.info(f"[SCHEDULER] Job rescheduled for {hour:02d}:{minute:02d}")
-                
             except Exception as e:
-                logging.error(f"[SCHEDULER] Error updating schedule: {e}")
+                logger.error("[SCHEDULER] Error starting scheduler: %s", e)
             
             return jsonify({'message': 'Profile updated successfully'})
             
         except Exception as e:
-            logging.error(f"Profile update error: {e}")
+            logger.error("Profile update error: %s", e)
             return jsonify({'error': str(e)}), 500
 
     # Handle GET request
     try:
-        user = get_db().execute('SELECT * FROM users WHERE id = ?', 
-                              [session['user_id']]).fetchone()
-        user_dict = dict(user)
-        
-        # Format time for display
-        stored_time = user_dict.get("preferred_time", "07:30")
-        try:
-            if ":" in stored_time:
-                if "AM" in stored_time.upper() or "PM" in stored_time.upper():
-                    formatted_time = stored_time
-                else:
-                    formatted_time = datetime.strptime(stored_time, "%H:%M").strftime("%I:%M %p")
-            else:
-                formatted_time = "07:30 AM"
-        except ValueError as e:
-            logging.error(f"Time format error: {e}")
-            formatted_time = "07:30 AM"
+        user_dict = get_profile(session['user_id'])
         
         form_data = {
             "zipcode": user_dict["zipcode"],
             "phone": user_dict["phone_number"],
-            "preferred_time": formatted_time,
+            "preferred_time": format_send_minute(user_dict["send_minute"]),
+            "temperature_sensitivity": user_dict["temperature_sensitivity"],
         }
         return render_template('profile.html', form_data=form_data)
     except Exception as e:
-        logging.error(f"Error loading profile: {e}")
+        logger.error("Error loading profile: %s", e)
         return redirect(url_for('login'))
 
 @app.route('/next-run')
@@ -435,7 +491,7 @@ def next_run():
     """Check when the next message will be sent."""
     try:
         jobs = scheduler.get_jobs()
-        weather_job = next((job for job in jobs if job.id == 'daily_weather_job'), None)
+        weather_job = next((job for job in jobs if job.id == DISPATCH_JOB_ID), None)
         
         if weather_job:
             next_run = weather_job.next_run_time
@@ -467,82 +523,71 @@ def get_weather(zipcode=None, latitude=None, longitude=None, units='imperial'):
         elif latitude and longitude:
             url = f"http://api.openweathermap.org/data/2.5/weather?lat={latitude}&lon={longitude}&appid={OPENWEATHERMAP_API_KEY}&units={units}"
         else:
-            logging.warning("No location provided, using default location")
+            logger.warning("No location provided, using default location")
             url = f"http://api.openweathermap.org/data/2.5/weather?zip={DEFAULT_ZIP},us&appid={OPENWEATHERMAP_API_KEY}&units={units}"
 
-        logging.debug(f"Fetching weather data from: {url}")
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.json()
+        logger.debug("Fetching weather data from: %s", url)
+        return fetch_current_weather(url).json()
     except requests.exceptions.RequestException as e:
-        logging.error(f"Weather API request failed: {e}")
+        logger.error("Weather API request failed: %s", e)
         raise WeatherAPIException("Unable to fetch weather data")
     except Exception as e:
-        logging.error(f"Unexpected error in get_weather: {e}")
+        logger.error("Unexpected error in get_weather: %s", e)
         raise WeatherAPIException(str(e))
 
 def send_text_message(to_number, message_body):
     """Send SMS with enhanced error handling and logging."""
-    logging.info(f"[SMS] Starting send process for {to_number}")
-    logging.info(f"[SMS] Message: {message_body}")
+    logger.debug("[SMS] Starting send process for %s", to_number)
+    logger.debug("[SMS] Message: %s", message_body)
     
     account_sid = os.getenv("TWILIO_ACCOUNT_SID")
     auth_token = os.getenv("TWILIO_AUTH_TOKEN")
     twilio_number = os.getenv("TWILIO_PHONE_NUMBER")
     
-    logging.info(f"[SMS] Twilio credentials present: SID={bool(account_sid)}, Token={bool(auth_token)}, Number={bool(twilio_number)}")
+    logger.debug("[SMS] Twilio credentials present: SID=%s, Token=%s, Number=%s",
+                 bool(account_sid), bool(auth_token), bool(twilio_number))
     
     if not all([account_sid, auth_token, twilio_number]):
         missing = []
         if not account_sid: missing.append("TWILIO_ACCOUNT_SID")
         if not auth_token: missing.append("TWILIO_AUTH_TOKEN")
         if not twilio_number: missing.append("TWILIO_PHONE_NUMBER")
-        logging.error(f"[SMS] Missing credentials: {', '.join(missing)}")
+        logger.error("[SMS] Missing credentials: %s", ', '.join(missing))
         return False
     
     try:
         formatted_number = format_phone_number(to_number)
-        logging.info(f"[SMS] Formatted number: {formatted_number}")
+        logger.debug("[SMS] Formatted number: %s", formatted_number)
         
-        client = Client(account_sid, auth_token)
-        message = client.messages.create(
+        message = create_sms(
+            Client(account_sid, auth_token),
             body=message_body,
             from_=twilio_number,
             to=formatted_number
         )
         
-        logging.info(f"[SMS] Success! SID: {message.sid}")
+        logger.info("[SMS] Sent to %s, SID: %s", formatted_number, message.sid)
         return True
     except Exception as e:
-        logging.error(f"[SMS] Error: {str(e)}")
-        logging.exception("[SMS] Full exception details:")
+        logger.error("[SMS] Error: %s", e)
+        logger.exception("[SMS] Full exception details:")
         return False
 
 @app.route('/test-sms')
 def test_sms():
     try:
-        logging.info("Test SMS endpoint triggered")
+        logger.info("Test SMS endpoint triggered")
         # Use your actual test phone number here
         result = send_text_message('6087702909', 'Test message from Render deployment')
         if result:
             return "Test message sent successfully!"
         return "Failed to send test message", 500
     except Exception as e:
-        logging.error(f"Test SMS error: {str(e)}")
+        logger.error("Test SMS error: %s", e)
         return f"Error: {str(e)}", 500
 
 def generate_weather_message(user_data, weather_data):
-    temp_f = round(weather_data['main']['temp'])
-    temp_c = round((temp_f - 32) * 5.0 / 9.0)  # Convert to Celsius
-    condition = weather_data['weather'][0]['main']
-    recommendation = should_wear_jacket(weather_data)
-    
-    return (
-        f"Good morning!\n"
-        f"Current Weather: {temp_f}°F ({temp_c}°C)\n"
-        f"Condition: {condition}\n"
-        f"Recommendation: {recommendation}"
-    )
+    return format_weather_message(weather_data, should_wear_jacket(weather_data))
 
 @app.route('/send-test-message')
 def send_test_message():
@@ -550,7 +595,7 @@ def send_test_message():
         return "Please log in first.", 401
 
     try:
-        user = get_db().execute('SELECT * FROM users WHERE id = ?', [session['user_id']]).fetchone()
+        user = get_user(session['user_id'], view='contact')
         weather_data = get_weather(zipcode=user['zipcode'])
         message = generate_weather_message(user, weather_data)
         
@@ -558,7 +603,7 @@ def send_test_message():
             return "Message sent successfully!"
         return "Failed to send message.", 500
     except Exception as e:
-        logging.error(f"Test message error: {e}")
+        logger.error("Test message error: %s", e)
         return f"Error: {str(e)}", 500
 
 @app.route('/weekly_weather')
@@ -567,19 +612,14 @@ def get_weekly_weather():
         return jsonify({'error': 'Not logged in'}), 401
 
     try:
-        user = get_db().execute('SELECT * FROM users WHERE id = ?', [session['user_id']]).fetchone()
+        user = get_profile(session['user_id'])
         
         # Use user location or fallback to defaults
         lat = user['latitude'] if user['latitude'] else DEFAULT_LAT
         lon = user['longitude'] if user['longitude'] else DEFAULT_LON
         
-        url = f"http://api.openweathermap.org/data/2.5/forecast?lat={lat}&lon={lon}&units=imperial&appid={OPENWEATHERMAP_API_KEY}"
-        logging.debug(f"Fetching weekly forecast for lat={lat}, lon={lon}")
-        
-        response = requests.get(url)
-        response.raise_for_status()
-        
-        data = response.json()
+        logger.debug("Fetching weekly forecast for lat=%s, lon=%s", lat, lon)
+        data = fetch_forecast(lat, lon).json()
         daily_data = {
             'daily': []
         }
@@ -594,7 +634,7 @@ def get_weekly_weather():
         daily_data['daily'] = list(by_day.values())
         return jsonify(daily_data)
     except Exception as e:
-        logging.error(f"Error in weekly_weather: {e}")
+        logger.error("Error in weekly_weather: %s", e)
         return jsonify({'error': 'Unable to fetch weekly forecast'}), 500
 
 @app.route('/hourly_weather')
@@ -603,16 +643,12 @@ def get_hourly_weather():
         return jsonify({'error': 'Not logged in'}), 401
 
     try:
-        user = get_db().execute('SELECT * FROM users WHERE id = ?', [session['user_id']]).fetchone()
+        user = get_profile(session['user_id'])
         
         lat = user['latitude'] if user['latitude'] else DEFAULT_LAT
         lon = user['longitude'] if user['longitude'] else DEFAULT_LON
         
-        url = f"http://api.openweathermap.org/data/2.5/forecast?lat={lat}&lon={lon}&units=imperial&appid={OPENWEATHERMAP_API_KEY}"
-        response = requests.get(url)
-        response.raise_for_status()
-        
-        data = response.json()
+        data = fetch_forecast(lat, lon).json()
         hourly_data = []
         
         # Process each hourly entry
@@ -627,69 +663,171 @@ def get_hourly_weather():
         
         return jsonify({'hourly': hourly_data})
     except Exception as e:
-        logging.error(f"Error in hourly_weather: {e}")
+        logger.error("Error in hourly_weather: %s", e)
         return jsonify({'error': 'Unable to fetch hourly forecast'}), 500
 
-def send_daily_weather_update(user_id=None):
-    """Send weather update to users."""
-    logging.info("[SCHEDULER] Starting daily weather update")
+def local_send_date():
+    """Return today's date in the scheduler timezone, the ledger key for daily sends."""
+    return datetime.now(pytz.timezone('America/Chicago')).date().isoformat()
+
+def send_daily_message(db, user_dict, local_date):
+    """Claim, build and text one user's daily message.
+    
+    Returns None when the day's send was already claimed by another path,
+    otherwise a (success, message) tuple.
+    """
+    if not claim_daily_send(db, user_dict['id'], local_date):
+        return None
+    
+    try:
+        weather_data = get_weather(zipcode=user_dict['zipcode'])
+        message = generate_weather_message(user_dict, weather_data)
+        success = send_text_message(user_dict['phone_number'], message)
+    except Exception:
+        release_daily_send(db, user_dict['id'], local_date)
+        raise
+    
+    if success:
+        mark_daily_send(db, user_dict['id'], local_date)
+    else:
+        release_daily_send(db, user_dict['id'], local_date)
+    return success, message
+
+class LiveProviders:
+    """The real weather, OpenAI and Twilio calls used by the send pipeline."""
+    
+    def weather(self, zipcode):
+        return get_weather(zipcode=zipcode)
+    
+    def recommend(self, temperature_f, wind_speed, condition):
+        return generate_jacket_recommendation(temperature_f, wind_speed, condition)
+    
+    def send(self, phone_number, body):
+        return send_text_message(phone_number, body)
+
+def build_send_pipeline(providers=None, record=True):
+    """Create a send pipeline for today, with the live providers by default."""
+    return SendPipeline(providers or LiveProviders(), connect_db, local_send_date(), record=record)
+
+def run_send_pipeline(where='1', params=(), run_id=None):
+    """Stream the users matching where through the staged send.
+
+    Runs with a run_id are checkpointed and resume where they stopped.
+    """
+    return build_send_pipeline().run(get_db(), where, params, run_id, shard_leases.owner)
+
+def send_daily_weather_update(user_id=None, dry_run=False):
+    """Send weather update to users.
+    
+    With dry_run the pipeline runs against simulated providers, writes
+    nothing and returns a throughput report instead of texting anyone.
+    """
+    logger.info("[SCHEDULER] Starting daily weather update%s", ' (dry run)' if dry_run else '')
+    
+    # If user_id is provided, send only to that user; otherwise stream every user
+    if user_id:
+        where, params, run_id = 'id = ?', [user_id], None
+    else:
+        where, params, run_id = '1', [], f'daily:{local_send_date()}'
+    
+    try:
+        with app.app_context():
+            if dry_run:
+                return simulate_daily_run(
+                    lambda providers: build_send_pipeline(providers, record=False),
+                    get_db(), where, params
+                )
+            return run_send_pipeline(where, params, run_id)
+                    
+    except Exception as e:
+        logger.error("[SCHEDULER] Critical error: %s", e)
+
+def dispatch_due_users():
+    """Send to users due this minute in the shards this process holds.
+    
+    Minutes missed while no process was awake are caught up in the same run,
+    and runs left behind by a stopped process are resumed first.
+    """
+    now = datetime.now(pytz.timezone('America/Chicago'))
+    resume_interrupted_runs()
     
     try:
         with app.app_context():
             db = get_db()
+            shards = shard_leases.renew(db)
+            first_minute = dispatch_window(db, shards, now)
+            if first_minute is None:
+                return
+            where, params = due_users_query(now, shards, first_minute=first_minute)
             
-            # If user_id is provided, send only to that user
-            if user_id:
-                users = [db.execute('SELECT * FROM users WHERE id = ?', [user_id]).fetchone()]
-            else:
-                # Otherwise send to all users
-                users = db.execute('SELECT * FROM users').fetchall()
-            
-            if not users:
-                logging.info("[SCHEDULER] No users found to process")
+            # Most minutes have nobody due; don't start threads or record a run for them
+            if db.execute(f'SELECT 1 FROM users WHERE {where} LIMIT 1', params).fetchone() is None:
+                mark_dispatched(db, shards, now, shard_leases.owner)
                 return
             
-            for user in users:
-                if user is None:
-                    continue
-                    
-                try:
-                    user_dict = dict(user)
-                    weather_data = get_weather(zipcode=user_dict['zipcode'])
-                    message = generate_weather_message(user_dict, weather_data)
-                    
-                    result = send_text_message(user_dict['phone_number'], message)
-                    logging.info(f"[SCHEDULER] Message sent to {user_dict['phone_number']}: {result}")
-                    
-                except Exception as e:
-                    logging.error(f"[SCHEDULER] Error processing user: {str(e)}")
-                    continue
-                    
+            run_id = f"dispatch:{local_send_date()}:{now.strftime('%H%M')}:{shard_leases.owner}"
+            report = run_send_pipeline(where, params, run_id=run_id)
+            mark_dispatched(db, shards, now, shard_leases.owner)
+            if report and report['counters']['users_streamed']:
+                logger.info("[DISPATCHER] %s-%s in %s shards: %s", format_send_minute(first_minute, '%H:%M'),
+                            now.strftime('%H:%M'), len(shards), report['counters'])
     except Exception as e:
-        logging.error(f"[SCHEDULER] Critical error: {str(e)}")
+        logger.error("[DISPATCHER] Error dispatching %s: %s", now.strftime('%H:%M'), e)
 
-def get_user_preferred_time():
-    with app.app_context():
-        try:
-            db = get_db()
-            user = db.execute('SELECT preferred_time FROM users LIMIT 1').fetchone()
-            if user and user['preferred_time']:
-                time_str = user['preferred_time']
-                # Convert string to hour/minute
-                if ":" in time_str:
-                    if "AM" in time_str.upper() or "PM" in time_str.upper():
-                        dt = datetime.strptime(time_str, "%I:%M %p")
-                    else:
-                        dt = datetime.strptime(time_str, "%H:%M")
-                    return dt.hour, dt.minute
-            return 7, 30  # Default to 7:30 AM
-        except Exception as e:
-            logging.error(f"Error getting preferred time: {e}")
-            return 7, 30
+def backfill_missing_coordinates():
+    """Resolve coordinates the local index couldn't, off the request path."""
+    try:
+        with app.app_context():
+            if backfill_coordinates(get_db(), fallback=True):
+                profile_cache.clear()
+    except Exception as e:
+        logger.error("[GEOCODE] Error backfilling coordinates: %s", e)
+
+def resume_interrupted_runs():
+    """Finish today's runs that a stopped or crashed process left behind."""
+    try:
+        with app.app_context():
+            for run_id, where, params in resumable_runs(get_db(), local_send_date()):
+                logger.info("[RUNS] Resuming interrupted run %s", run_id)
+                run_send_pipeline(where, params, run_id)
+    except Exception as e:
+        logger.error("[RUNS] Error resuming interrupted runs: %s", e)
+
+def release_shard_leases():
+    """Hand this process's shards to the other workers, e.g. on shutdown."""
+    try:
+        with app.app_context():
+            shard_leases.release(get_db())
+    except Exception as e:
+        logger.error("[SHARDS] Error releasing leases: %s", e)
 
 # Global scheduler instance
 scheduler = None
 
+# This process's claim on the user shards, shared by every dispatcher tick
+shard_leases = ShardLeaseManager()
+
+# Jobs in a persistent store must reference their function by import path
+DISPATCH_FUNC_REF = 'app:dispatch_due_users'
+RESUME_FUNC_REF = 'app:resume_interrupted_runs'
+RESUME_JOB_ID = 'resume_interrupted_runs'
+BACKFILL_FUNC_REF = 'app:backfill_missing_coordinates'
+BACKFILL_JOB_ID = 'backfill_missing_coordinates'
+GEOCODE_BACKFILL_MINUTES = int(os.getenv('GEOCODE_BACKFILL_MINUTES', 15))
+
+def schedule_resume(scheduler):
+    """Run resume_interrupted_runs once, right after the scheduler starts.
+
+    Also schedules the periodic coordinate backfill.
+    """
+    scheduler.add_job(RESUME_FUNC_REF, 'date', id=RESUME_JOB_ID, replace_existing=True)
+    scheduler.add_job(BACKFILL_FUNC_REF, 'interval', minutes=GEOCODE_BACKFILL_MINUTES,
+                      id=BACKFILL_JOB_ID, replace_existing=True)
+
+def create_job_store(tablename):
+    """Persist scheduler jobs in the app database so restarts reuse them."""
+    return SQLAlchemyJobStore(url=f'sqlite:///{DATABASE}', tablename=tablename)
+
 def init_scheduler():
     global scheduler
     
@@ -697,49 +835,26 @@ def init_scheduler():
         scheduler.shutdown()
     
     scheduler = BackgroundScheduler(
+        jobstores={'default': create_job_store('apscheduler_jobs_web')},
         timezone=pytz.timezone('America/Chicago'),
         daemon=True
     )
     
+    # Pick up users added since the last boot before jobs can fire
+    try:
+        migrate_db()
+    except Exception as e:
+        logger.error("[SCHEDULER] Error migrating database: %s", e)
+    
     scheduler.start()
-    logging.info("[SCHEDULER] New scheduler started")
+    logger.info("[SCHEDULER] New scheduler started")
 
-    # Schedule jobs for each user based on their preferred time
+    # Persisted jobs are loaded by start(); only apply what changed
     try:
-        with app.app_context():
-            db = get_db()
-            users = db.execute('SELECT * FROM users').fetchall()
-            
-            for user in users:
-                user_dict = dict(user)
-                time_str = user_dict['preferred_time']
-                
-                # Parse the time
-                try:
-                    if ":" in time_str:
-                        if "AM" in time_str.upper() or "PM" in time_str.upper():
-                            dt = datetime.strptime(time_str, "%I:%M %p")
-                        else:
-                            dt = datetime.strptime(time_str, "%H:%M")
-                            
-                        hour, minute = dt.hour, dt.minute
-                        
-                        # Schedule job for this user
-                        job = scheduler.add_job(
-                            func=send_daily_weather_update,
-                            args=[user_dict['id']],
-                            trigger='cron',
-                            hour=hour,
-                            minute=minute,
-                            id=f'weather_job_{user_dict["id"]}',
-                            replace_existing=True
-                        )
-                        logging.info(f"[SCHEDULER] Scheduled job for user {user_dict['id']} at {hour:02d}:{minute:02d}")
-                except Exception as e:
-                    logging.error(f"[SCHEDULER] Error scheduling for user {user_dict['id']}: {e}")
-                    
+        reconcile_jobs(scheduler, DISPATCH_FUNC_REF)
     except Exception as e:
-        logging.error(f"[SCHEDULER] Error scheduling jobs: {e}")
+        logger.error("[SCHEDULER] Error reconciling jobs: %s", e)
+    schedule_resume(scheduler)
 
     return scheduler
 
@@ -769,21 +884,27 @@ def test_message_now():
     try:
         with app.app_context():
             db = get_db()
-            users = db.execute('SELECT * FROM users').fetchall()
-            
-            if not users:
+            if not count_users():
                 return jsonify({"status": "error", "message": "No users found"})
+            users = iter_users('contact', db)
             
+            local_date = local_send_date()
             results = []
             for user in users:
                 try:
-                    user_dict = dict(user)
-                    logging.info(f"[TEST] Sending message to user: {user_dict['phone_number']}")
+                    user_dict = user
+                    logger.info("[TEST] Sending message to user: %s", user_dict['phone_number'])
                     
-                    weather_data = get_weather(zipcode=user_dict['zipcode'])
-                    message = generate_weather_message(user_dict, weather_data)
+                    outcome = send_daily_message(db, user_dict, local_date)
+                    if outcome is None:
+                        results.append({
+                            "phone": user_dict['phone_number'],
+                            "success": False,
+                            "skipped": "already sent today"
+                        })
+                        continue
                     
-                    result = send_text_message(user_dict['phone_number'], message)
+                    result, message = outcome
                     results.append({
                         "phone": user_dict['phone_number'],
                         "success": result,
@@ -791,7 +912,7 @@ def test_message_now():
                     })
                     
                 except Exception as e:
-                    logging.error(f"[TEST] Error processing user: {str(e)}")
+                    logger.error("[TEST] Error processing user: %s", e)
                     results.append({
                         "phone": user_dict.get('phone_number', 'unknown'),
                         "success": False,
@@ -804,7 +925,7 @@ def test_message_now():
             })
             
     except Exception as e:
-        logging.error(f"[TEST] Error: {str(e)}")
+        logger.error("[TEST] Error: %s", e)
         return jsonify({"status": "error", "message": str(e)})
 
 @app.route('/scheduler-status')
@@ -829,17 +950,15 @@ def scheduler_status():
 def test_openai():
     """Test endpoint for OpenAI integration."""
     try:
-        logging.info("[TEST] Starting OpenAI test")
-        client = OpenAI(api_key=OPENAI_API_KEY)
-        
-        response = client.chat.completions.create(
+        logger.info("[TEST] Starting OpenAI test")
+        response = chat_completion(
             model="gpt-3.5-turbo",
             messages=[{"role": "user", "content": "Say 'OpenAI test successful' if you can read this."}],
             max_tokens=10
         )
         
         result = response.choices[0].message.content
-        logging.info(f"[TEST] OpenAI response: {result}")
+        logger.info("[TEST] OpenAI response: %s", result)
         
         return jsonify({
             "status": "success",
@@ -847,8 +966,8 @@ def test_openai():
             "api_key_present": bool(OPENAI_API_KEY)
         })
     except Exception as e:
-        logging.error(f"[TEST] OpenAI test failed: {str(e)}")
-        logging.exception("[TEST] Full exception details:")
+        logger.error("[TEST] OpenAI test failed: %s", e)
+        logger.exception("[TEST] Full exception details:")
         return jsonify({
             "status": "error",
             "error": str(e),
@@ -865,7 +984,7 @@ def logout():
 def test_scheduler():
     """Test endpoint to trigger the scheduler immediately."""
     try:
-        logging.info("[TEST] Adding immediate test job")
+        logger.info("[TEST] Adding immediate test job")
         run_date = datetime.now() + timedelta(seconds=10)
         
         scheduler.add_job(
@@ -876,15 +995,15 @@ def test_scheduler():
             replace_existing=True
         )
         
-        logging.info(f"[TEST] Job scheduled for: {run_date}")
+        logger.info("[TEST] Job scheduled for: %s", run_date)
         return jsonify({
             "status": "success",
             "message": "Test job scheduled",
             "scheduled_time": run_date.strftime("%Y-%m-%d %H:%M:%S")
         })
     except Exception as e:
-        logging.error(f"[TEST] Scheduler test error: {str(e)}")
-        logging.exception("[TEST] Full exception details:")
+        logger.error("[TEST] Scheduler test error: %s", e)
+        logger.exception("[TEST] Full exception details:")
         return jsonify({
             "status": "error",
             "message": str(e)
@@ -906,8 +1025,7 @@ def test_all():
     
     # Test OpenAI
     try:
-        client = OpenAI(api_key=OPENAI_API_KEY)
-        response = client.chat.completions.create(
+        response = chat_completion(
             model="gpt-3.5-turbo",
             messages=[{"role": "user", "content": "Test"}],
             max_tokens=5
@@ -929,74 +1047,59 @@ def test_all():
 
 @app.route('/schedule-user-jobs')
 def schedule_user_jobs():
-    """Schedule individual jobs for each user."""
+    """Replace per-user jobs with the single minute dispatcher."""
     try:
+        migrate_db()
         with app.app_context():
-            db = get_db()
-            users = db.execute('SELECT * FROM users').fetchall()
-            logging.info(f"[SCHEDULER] Found {len(users)} users to schedule")
-            
-            for user in users:
-                try:
-                    user_dict = dict(user)
-                    logging.info(f"[SCHEDULER] Processing user: {user_dict}")
-                    
-                    preferred_time = user_dict['preferred_time']
-                    if not preferred_time:
-                        logging.error(f"[SCHEDULER] No preferred time for user {user_dict['id']}")
-                        continue
-                        
-                    try:
-                        if ":" in preferred_time:
-                            hour, minute = map(int, preferred_time.split(":"))
-                        else:
-                            logging.error(f"[SCHEDULER] Invalid time format: {preferred_time}")
-                            continue
-                            
-                        job = scheduler.add_job(
-                            func=send_daily_weather_update,
-                            trigger='cron',
-                            hour=hour,
-                            minute=minute,
-                            args=[user_dict['id']],
-                            id=f'weather_update_{user_dict["id"]}',
-                            replace_existing=True
-                        )
-                        logging.info(f"[SCHEDULER] Job scheduled for user {user_dict['id']} at {hour}:{minute}")
-                        logging.info(f"[SCHEDULER] Next run: {job.next_run_time}")
-                    except ValueError as e:
-                        logging.error(f"[SCHEDULER] Time parsing error for user {user_dict['id']}: {e}")
-                except Exception as e:
-                    logging.error(f"[SCHEDULER] Error processing user {user_dict['id']}: {e}")
-                    logging.exception("[SCHEDULER] Full exception details:")
-            
-            # Log all scheduled jobs
-            logging.info("[SCHEDULER] Current jobs:")
-            scheduler.print_jobs()
-            
-            return jsonify({"status": "success", "users_processed": len(users)})
+            user_count = count_users()
+        
+        removed = remove_legacy_jobs(scheduler)
+        job = schedule_dispatcher(scheduler, DISPATCH_FUNC_REF)
+        
+        # Log all scheduled jobs
+        logger.info("[SCHEDULER] Current jobs:")
+        scheduler.print_jobs()
+        
+        return jsonify({
+            "status": "success",
+            "users_processed": user_count,
+            "legacy_jobs_removed": removed,
+            "dispatcher_next_run": str(job.next_run_time)
+        })
     except Exception as e:
-        logging.error(f"[SCHEDULER] Error in schedule_user_jobs: {e}")
-        logging.exception("[SCHEDULER] Full exception details:")
+        logger.error("[SCHEDULER] Error in schedule_user_jobs: %s", e)
+        logger.exception("[SCHEDULER] Full exception details:")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/test-scheduler-now')
 def test_scheduler_now():
     """Force the scheduler to run immediately."""
     try:
-        logging.info("[TEST] Running scheduler test immediately")
+        logger.info("[TEST] Running scheduler test immediately")
         send_daily_weather_update()
         return jsonify({
             "status": "success",
             "message": "Scheduler test completed - check logs for details"
         })
     except Exception as e:
-        logging.error(f"[TEST] Scheduler test failed: {str(e)}")
+        logger.error("[TEST] Scheduler test failed: %s", e)
         return jsonify({
             "status": "error",
             "message": str(e)
         }), 500
 
+@app.route('/simulate-daily-run')
+def simulate_daily_run_report():
+    """Dry-run the daily send for every user and report projected throughput."""
+    try:
+        report = send_daily_weather_update(dry_run=True)
+        if report is None:
+            return jsonify({"status": "error", "message": "Dry run failed - check logs for details"}), 500
+        return jsonify(report)
+    except Exception as e:
+        logger.error("[TEST] Dry run failed: %s", e)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
 @app.route('/schedule-test')
 def schedule_test():
     """Schedule a test job for 1 minute from now."""
@@ -1008,9 +1111,9 @@ def schedule_test():
         test_time = datetime.now(pytz.timezone('America/Chicago')) + timedelta(minutes=1)
         
         # First test immediate send
-        logging.info(f"[TEST] Testing immediate send for user {user_id}")
+        logger.info("[TEST] Testing immediate send for user %s", user_id)
         immediate_result = send_daily_weather_update(user_id)
-        logging.info(f"[TEST] Immediate send result: {immediate_result}")
+        logger.info("[TEST] Immediate send result: %s", immediate_result)
         
         # Then schedule future job
         job = scheduler.add_job(
@@ -1029,8 +1132,8 @@ def schedule_test():
             "next_run": str(job.next_run_time)
         })
     except Exception as e:
-        logging.error(f"[TEST] Scheduler test error: {str(e)}")
-        logging.exception("[TEST] Full stack trace:")
+        logger.error("[TEST] Scheduler test error: %s", e)
+        logger.exception("[TEST] Full stack trace:")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/verify-twilio')
@@ -1046,9 +1149,7 @@ def verify_twilio():
         twilio_number = os.getenv("TWILIO_PHONE_NUMBER")
         
         # Get user phone number
-        db = get_db()
-        user = db.execute('SELECT phone_number FROM users WHERE id = ?', 
-                         [session['user_id']]).fetchone()
+        user = get_user(session['user_id'], view='contact')
         
         if not user:
             return jsonify({"error": "User not found"}), 404
@@ -1082,23 +1183,29 @@ def test_send_now():
         # Get all users from database
         with app.app_context():
             db = get_db()
-            users = db.execute('SELECT * FROM users').fetchall()
-            
-            if not users:
+            if not count_users():
                 return jsonify({"error": "No users found in database"})
+            users = iter_users('contact', db)
             
+            local_date = local_send_date()
             results = []
             for user in users:
                 try:
-                    user_dict = dict(user)
-                    logging.info(f"[TEST] Processing user: {user_dict['phone_number']}")
-                    
-                    weather_data = get_weather(zipcode=user_dict['zipcode'])
-                    message = generate_weather_message(user_dict, weather_data)
+                    user_dict = user
+                    logger.info("[TEST] Processing user: %s", user_dict['phone_number'])
                     
-                    # Try to send message
-                    success = send_text_message(user_dict['phone_number'], message)
+                    # Try to send message, unless today's send already happened
+                    outcome = send_daily_message(db, user_dict, local_date)
+                    if outcome is None:
+                        results.append({
+                            "user_id": user_dict['id'],
+                            "phone": user_dict['phone_number'],
+                            "success": False,
+                            "skipped": "already sent today"
+                        })
+                        continue
                     
+                    success, message = outcome
                     results.append({
                         "user_id": user_dict['id'],
                         "phone": user_dict['phone_number'],
@@ -1106,10 +1213,10 @@ def test_send_now():
                         "message": message
                     })
                     
-                    logging.info(f"[TEST] Message sent: {success}")
+                    logger.info("[TEST] Message sent: %s", success)
                     
                 except Exception as e:
-                    logging.error(f"[TEST] Error for user {user_dict.get('id')}: {str(e)}")
+                    logger.error("[TEST] Error for user %s: %s", user_dict.get('id'), e)
                     results.append({
                         "user_id": user_dict.get('id'),
                         "error": str(e)
@@ -1126,20 +1233,24 @@ def test_send_now():
             })
             
     except Exception as e:
-        logging.error(f"[TEST] Critical error: {str(e)}")
+        logger.error("[TEST] Critical error: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route('/force-schedule')
 def force_schedule():
-    """Force scheduler to reinitialize and show all scheduled jobs."""
+    """Rebuild every user's send minute and reinitialize the scheduler."""
     global scheduler
     
     try:
+        with app.app_context():
+            rebuilt = rebuild_schedule(get_db())
+            profile_cache.clear()
         scheduler = init_scheduler()
         jobs = scheduler.get_jobs()
         
         return jsonify({
             'scheduler_running': scheduler.running,
+            'users_rebuilt': rebuilt,
             'jobs': [{
                 'id': job.id,
                 'name': job.name,
@@ -1152,32 +1263,24 @@ def force_schedule():
 if __name__ == '__main__':
     with app.app_context():
         if not os.path.exists(DATABASE):
-            logging.info("[INIT] Creating new database")
+            logger.info("[INIT] Creating new database")
             init_db()
         else:
             try:
                 db = get_db()
                 db.execute("SELECT 1 FROM users LIMIT 1")
-                logging.info("[INIT] Database tables verified")
+                logger.info("[INIT] Database tables verified")
             except sqlite3.OperationalError:
-                logging.info("[INIT] Tables missing, initializing database")
+                logger.info("[INIT] Tables missing, initializing database")
                 init_db()
 
         scheduler = init_scheduler()
-        
-        # Schedule initial job
-        try:
-            hour, minute = get_user_preferred_time()
-            job = scheduler.add_job(
-                func=send_daily_weather_update,
-                trigger='cron',
-                hour=hour,
-                minute=minute,
-                id='daily_weather_job',
-                replace_existing=True
-            )
-            logging.info(f"[SCHEDULER] Initial job scheduled for {hour:02d}:{minute:02d}")
-        except Exception as e:
-            logging.error(f"[SCHEDULER] Initial job scheduling failed: {e}")
 
+    def drain_and_exit():
+        # Wait for in-flight sends, then hand over shards and runs at once
+        scheduler.shutdown(wait=True)
+        release_shard_leases()
+        sys.exit(0)
+
+    install_shutdown_handler(drain_and_exit)
     app.run(debug=True, host='0.0.0.0', port=int(os.environ.get("PORT", 5001)))
\ No newline at end of file
@@ -0,0 +1,161 @@
+"""Failed-login tracking for brute-force protection.
+
+Counts live in a bounded in-process LRU and decay with a half-life, so
+the login path never waits on the network. When ``RATELIMIT_STORAGE_URL``
+points at Redis, every change is also queued for a background thread.
+That thread applies the changes to shared Redis scores (write-behind)
+and folds the scores it gets back into the local counts, so failures seen
+by other workers still count here, a moment later. The shared scores
+decay with the same half-life, applied in a Lua script, so a client's
+count means the same thing whichever side it came from.
+
+If Redis is down, the local counts keep blocking attackers on their own.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+import redis
+from config import get_config
+
+logger = logging.getLogger(__name__)
+
+BRUTE_FORCE_THRESHOLD = int(os.getenv('BRUTE_FORCE_THRESHOLD', 5))
+BRUTE_FORCE_HALF_LIFE = int(os.getenv('BRUTE_FORCE_HALF_LIFE', 900))
+BRUTE_FORCE_WINDOW = int(os.getenv('BRUTE_FORCE_WINDOW', 3600))
+BRUTE_FORCE_MAX_KEYS = int(os.getenv('BRUTE_FORCE_MAX_KEYS', 10000))
+
+# KEYS[1] = score hash; ARGV = half-life, expiry (seconds).
+# Decays the stored score to now, adds one failure and returns the score
+# as a string, since Lua numbers come back from Redis as integers.
+RECORD_FAILURE_SCRIPT = '''
+local half_life = tonumber(ARGV[1])
+local now = redis.call('TIME')
+local now_s = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'score', 'updated')
+local score = tonumber(state[1]) or 0
+local updated = tonumber(state[2]) or now_s
+score = score * math.pow(0.5, (now_s - updated) / half_life) + 1
+redis.call('HSET', KEYS[1], 'score', tostring(score), 'updated', tostring(now_s))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return tostring(score)
+'''
+
+class FailedLoginTracker:
+    """Decaying failure counts per (phone, ip), optionally shared through Redis."""
+
+    def __init__(self, redis_url=None, threshold=BRUTE_FORCE_THRESHOLD, half_life=BRUTE_FORCE_HALF_LIFE,
+                 window=BRUTE_FORCE_WINDOW, max_keys=BRUTE_FORCE_MAX_KEYS):
+        self.threshold = threshold
+        self.half_life = half_life
+        self.window = window
+        self.max_keys = max_keys
+        self.counts = OrderedDict()
+        self.lock = threading.Lock()
+        self.redis = None
+        self.record_script = None
+        self.pending = queue.Queue(maxsize=10000)
+        self.writer = None
+        if redis_url:
+            self.redis = redis.Redis(connection_pool=redis.ConnectionPool.from_url(
+                redis_url, socket_timeout=1, socket_connect_timeout=1
+            ))
+            self.record_script = self.redis.register_script(RECORD_FAILURE_SCRIPT)
+
+    def _key(self, phone, ip):
+        # Scores are hashes now; the old integer counters lived under failed_login:
+        return f'failed_login_score:{phone}:{ip}'
+
+    def _decayed(self, key, now):
+        entry = self.counts.get(key)
+        if entry is None:
+            return 0.0
+        score, updated = entry
+        return score * 0.5 ** ((now - updated) / self.half_life)
+
+    def _set(self, key, score, now):
+        self.counts[key] = (score, now)
+        self.counts.move_to_end(key)
+        while len(self.counts) > self.max_keys:
+            self.counts.popitem(last=False)
+
+    def record_failure(self, phone, ip):
+        """Count a failed login; returns the current (decayed) count."""
+        key = self._key(phone, ip)
+        now = time.monotonic()
+        with self.lock:
+            score = self._decayed(key, now) + 1
+            self._set(key, score, now)
+        self._write_behind(('incr', key))
+        return score
+
+    def is_blocked(self, phone, ip):
+        """True once about ``threshold`` failures have piled up recently."""
+        key = self._key(phone, ip)
+        with self.lock:
+            # Failures in quick succession have decayed slightly below a whole count
+            return self._decayed(key, time.monotonic()) > self.threshold - 1
+
+    def clear(self, phone, ip):
+        """Forget failures after a successful login."""
+        key = self._key(phone, ip)
+        with self.lock:
+            self.counts.pop(key, None)
+        self._write_behind(('delete', key))
+
+    def _write_behind(self, op):
+        if self.redis is None:
+            return
+        if self.writer is None:
+            with self.lock:
+                if self.writer is None:
+                    self.writer = threading.Thread(target=self._flush_forever, name='failed-login-writer', daemon=True)
+                    self.writer.start()
+        try:
+            self.pending.put_nowait(op)
+        except queue.Full:
+            # The local tier still has the count; only sharing is delayed
+            logger.warning("[BRUTEFORCE] Write-behind queue full, dropping update")
+
+    def _flush_forever(self):
+        while True:
+            ops = [self.pending.get()]
+            while len(ops) < 100:
+                try:
+                    ops.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.flush(ops)
+            except redis.RedisError as e:
+                logger.warning("[BRUTEFORCE] Redis unavailable, tracking locally: %s", e)
+                time.sleep(1)
+
+    def flush(self, ops):
+        """Apply queued changes in one pipeline and merge the shared scores back."""
+        pipe = self.redis.pipeline(transaction=False)
+        for action, key in ops:
+            if action == 'incr':
+                self.record_script(keys=[key], args=[self.half_life, self.window], client=pipe)
+            else:
+                pipe.delete(key)
+        results = pipe.execute()
+
+        now = time.monotonic()
+        with self.lock:
+            for (action, key), result in zip(ops, results):
+                if action != 'incr':
+                    continue
+                # Both scores decay alike, so the larger one has seen more
+                # failures; other workers' failures arrive this way
+                shared = float(result)
+                if shared > self._decayed(key, now):
+                    self._set(key, shared, now)
+
+def create_tracker(config):
+    storage_url = getattr(config, 'RATELIMIT_STORAGE_URL', '')
+    return FailedLoginTracker(storage_url if storage_url.startswith(('redis://', 'rediss://')) else None)
+
+failed_logins = create_tracker(get_config())
@@ -0,0 +1,207 @@
+"""Bulk user import and export.
+
+Import reads CSV or JSON Lines one row at a time and writes users in
+batches, with one transaction per batch. Within a batch, passwords are
+hashed on a thread pool (PBKDF2 releases the GIL) and coordinates come
+from the local ZIP index, so the network is never touched::
+
+    python bulk.py import cohort.csv
+    python bulk.py export users.jsonl
+
+Rows need ``phone`` and either ``password`` or a ``password_hash`` taken
+from an earlier export (``--include-password-hash``). ``zipcode``,
+``preferred_time``, ``temperature_sensitivity`` and ``temperature_unit``
+(``F`` unless given) are optional. Rows with
+a phone number that is already registered are skipped, and invalid rows
+are logged and skipped.
+
+Export streams rows from a cursor straight to the output file.
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from werkzeug.security import generate_password_hash
+from passwords import PASSWORD_HASH_METHOD
+from database import connect
+from dispatcher import format_send_minute, parse_preferred_time, DEFAULT_SEND_MINUTE
+from geocode import geocode_zip
+from logconfig import configure_logging
+from preferences import TEMPERATURE_UNITS
+
+logger = logging.getLogger(__name__)
+
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 1000))
+IMPORT_HASH_WORKERS = int(os.getenv('IMPORT_HASH_WORKERS', os.cpu_count() or 4))
+
+EXPORT_COLUMNS = ('id', 'phone_number', 'zipcode', 'preferred_time', 'temperature_sensitivity',
+                  'latitude', 'longitude', 'temperature_unit')
+
+def file_format(path, fmt=None):
+    """Pick csv or jsonl from an explicit format or the file extension."""
+    if fmt:
+        return fmt
+    return 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+def read_rows(f, fmt):
+    """Yield (line number, row) from an open CSV or JSONL file.
+
+    JSONL rows are yielded as raw lines and parsed by prepare_row, so a bad
+    line is skipped like any other invalid row.
+    """
+    if fmt == 'jsonl':
+        for line_no, line in enumerate(f, 1):
+            if line.strip():
+                yield line_no, line
+    else:
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+
+def normalize_phone(phone):
+    """Return the E.164 form of a 10-digit US number, or None.
+
+    Same rules as app.format_phone_number, without its per-call logging.
+    """
+    digits = ''.join(filter(str.isdigit, str(phone or '')))
+    if len(digits) == 11 and digits.startswith('1'):
+        digits = digits[1:]
+    return f'+1{digits}' if len(digits) == 10 else None
+
+def prepare_row(row):
+    """Validate one input row; returns the user fields or raises ValueError."""
+    if isinstance(row, str):
+        # json.JSONDecodeError is a ValueError
+        row = json.loads(row)
+    if not isinstance(row, dict):
+        raise ValueError(f"expected an object, got {type(row).__name__}")
+    phone = normalize_phone(row.get('phone') or row.get('phone_number'))
+    if phone is None:
+        raise ValueError(f"invalid phone number {row.get('phone')!r}")
+    if not row.get('password') and not row.get('password_hash'):
+        raise ValueError("missing password")
+    send_minute = parse_preferred_time(row.get('preferred_time'))
+    temperature_unit = row.get('temperature_unit') or 'F'
+    if temperature_unit not in TEMPERATURE_UNITS:
+        raise ValueError(f"invalid temperature unit {temperature_unit!r}")
+    return {
+        'phone_number': phone,
+        'password': row.get('password'),
+        'password_hash': row.get('password_hash'),
+        'zipcode': (row.get('zipcode') or '').strip() or None,
+        'send_minute': DEFAULT_SEND_MINUTE if send_minute is None else send_minute,
+        'temperature_sensitivity': row.get('temperature_sensitivity') or 'Normal',
+        'temperature_unit': temperature_unit
+    }
+
+def hash_password(user):
+    return user['password_hash'] or generate_password_hash(user['password'], method=PASSWORD_HASH_METHOD)
+
+def import_users(db, rows, batch_size=IMPORT_BATCH_SIZE, workers=IMPORT_HASH_WORKERS):
+    """Insert users from (line number, row) pairs; returns a summary dict."""
+    started = time.perf_counter()
+    summary = {'read': 0, 'imported': 0, 'duplicates': 0, 'invalid': 0}
+    coordinates = {}
+    rows = iter(rows)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            summary['read'] += len(batch)
+
+            users = []
+            for line_no, row in batch:
+                try:
+                    users.append(prepare_row(row))
+                except ValueError as e:
+                    summary['invalid'] += 1
+                    logger.warning("[IMPORT] Skipping line %s: %s", line_no, e)
+
+            for user in users:
+                zipcode = user['zipcode']
+                if zipcode not in coordinates:
+                    coordinates[zipcode] = geocode_zip(zipcode) if zipcode else (None, None)
+            hashes = executor.map(hash_password, users)
+
+            before = db.total_changes
+            db.executemany(
+                '''INSERT OR IGNORE INTO users
+                   (phone_number, password, zipcode, preferred_time, send_minute,
+                    temperature_sensitivity, latitude, longitude, temperature_unit)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                [
+                    (user['phone_number'], password_hash, user['zipcode'],
+                     format_send_minute(user['send_minute'], '%H:%M'), user['send_minute'],
+                     user['temperature_sensitivity'], *coordinates[user['zipcode']],
+                     user['temperature_unit'])
+                    for user, password_hash in zip(users, hashes)
+                ]
+            )
+            db.commit()
+            inserted = db.total_changes - before
+            summary['imported'] += inserted
+            summary['duplicates'] += len(users) - inserted
+            logger.info("[IMPORT] %s users imported so far", summary['imported'])
+
+    summary['seconds'] = round(time.perf_counter() - started, 2)
+    return summary
+
+def export_users(db, f, fmt, include_password_hash=False, batch_size=IMPORT_BATCH_SIZE):
+    """Stream every user to an open file; returns the number written."""
+    columns = EXPORT_COLUMNS + (('password_hash',) if include_password_hash else ())
+    select = ', '.join(EXPORT_COLUMNS[:3]) + ', send_minute, ' + ', '.join(EXPORT_COLUMNS[4:])
+    if include_password_hash:
+        select += ', password AS password_hash'
+    cursor = db.execute(f'SELECT {select} FROM users ORDER BY id')
+
+    writer = csv.DictWriter(f, fieldnames=columns) if fmt == 'csv' else None
+    if writer:
+        writer.writeheader()
+    written = 0
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return written
+        for row in rows:
+            user = dict(row)
+            user['preferred_time'] = format_send_minute(user.pop('send_minute'), '%H:%M')
+            if writer:
+                writer.writerow(user)
+            else:
+                f.write(json.dumps(user) + '\n')
+        written += len(rows)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk user import and export")
+    parser.add_argument('command', choices=('import', 'export'))
+    parser.add_argument('path', help="CSV or JSONL file, '-' for stdin/stdout")
+    parser.add_argument('--format', choices=('csv', 'jsonl'))
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=IMPORT_HASH_WORKERS)
+    parser.add_argument('--include-password-hash', action='store_true',
+                        help="export password hashes so the file can be re-imported")
+    args = parser.parse_args(argv)
+    fmt = file_format(args.path, args.format)
+    db = connect()
+
+    if args.command == 'import':
+        f = sys.stdin if args.path == '-' else open(args.path, newline='')
+        with f:
+            summary = import_users(db, read_rows(f, fmt), args.batch_size, args.workers)
+        print(json.dumps(summary))
+    else:
+        f = sys.stdout if args.path == '-' else open(args.path, 'w', newline='')
+        with f:
+            written = export_users(db, f, fmt, args.include_password_hash, args.batch_size)
+        logger.info("[EXPORT] Wrote %s users", written)
+
+if __name__ == '__main__':
+    configure_logging()
+    main()
@@ -0,0 +1,75 @@
+"""Catch-up for dispatcher ticks missed while no process was awake.
+
+Every shard row in ``shard_leases`` remembers the last minute that was
+dispatched for it (``dispatched_through``). When the web process or the
+worker wakes up after sleeping through send times, the next tick selects
+every minute still owed since then as one range over the send_minute
+index, so late users go through the send pipeline in one batched pass
+instead of one job each. The daily_sends ledger drops anyone the range
+overlaps who was already texted.
+
+Minutes older than ``CATCHUP_GRACE_MINUTES`` are given up on, and the
+window never reaches back past local midnight, so a late catch-up can't
+send yesterday's message under today's date.
+"""
+import logging
+import math
+import os
+from dispatcher import minute_of_day
+
+logger = logging.getLogger(__name__)
+
+CATCHUP_GRACE_MINUTES = int(os.getenv('CATCHUP_GRACE_MINUTES', 120))
+
+def ensure_catchup(db):
+    """Add shard_leases.dispatched_through to databases created before it."""
+    columns = {row[1] for row in db.execute('PRAGMA table_info(shard_leases)')}
+    if 'dispatched_through' not in columns:
+        db.execute('ALTER TABLE shard_leases ADD COLUMN dispatched_through REAL')
+    db.commit()
+
+def _shard_params(shards):
+    shards = sorted(shards)
+    return ','.join('?' * len(shards)), shards
+
+def dispatch_window(db, shards, now, grace_minutes=CATCHUP_GRACE_MINUTES):
+    """Return the first minute of day still owed to the given shards.
+
+    The tick then covers every minute from it up to ``now``. Returns
+    ``None`` when ``now`` was already dispatched or no shards are held.
+    """
+    if not shards:
+        return None
+    placeholders, params = _shard_params(shards)
+    watermark = db.execute(
+        f'SELECT MIN(dispatched_through) FROM shard_leases WHERE shard IN ({placeholders})',
+        params
+    ).fetchone()[0]
+
+    current = math.floor(now.timestamp() / 60) * 60
+    if watermark is None:
+        # Never dispatched before: start with the current minute
+        return minute_of_day(now)
+    owed_from = max(
+        watermark + 60,
+        current - grace_minutes * 60,
+        now.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    )
+    if owed_from > current:
+        return None
+    missed = int((current - owed_from) // 60)
+    if missed:
+        logger.info("[CATCHUP] Catching up %s missed minutes before %s", missed, now.strftime('%H:%M'))
+    return minute_of_day(now) - missed
+
+def mark_dispatched(db, shards, now, owner):
+    """Record that every minute up to ``now`` was dispatched for these shards."""
+    if not shards:
+        return
+    placeholders, params = _shard_params(shards)
+    db.execute(
+        f'''UPDATE shard_leases SET dispatched_through = ?
+            WHERE owner = ? AND shard IN ({placeholders})''',
+        [math.floor(now.timestamp() / 60) * 60, owner] + params
+    )
+    db.commit()
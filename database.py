@@ -0,0 +1,107 @@
+"""SQLite connections for the web app, the scheduler and the send pipeline.
+
+Every connection is opened with the same tuning:
+
+* WAL journaling, so readers never wait for the writer and the scheduler
+  can record sends while requests are served
+* ``synchronous=NORMAL``, which is safe under WAL and skips an fsync per commit
+* a larger page cache and memory-mapped reads
+* a busy timeout, so concurrent writers wait their turn instead of failing
+  with "database is locked"
+* a per-connection cache of prepared statements
+* a ``db`` tracing span around each statement run during a request
+
+Connections are pooled rather than opened per request. An app context
+checks one out on first use and hands it back on teardown, so a connection
+is only ever used by one thread at a time, and the statement cache and
+page cache survive from one request (or scheduler tick) to the next.
+"""
+import logging
+import os
+import queue
+import sqlite3
+from flask import g
+from tracing import TracedConnection
+
+logger = logging.getLogger(__name__)
+
+DATABASE = os.getenv('DATABASE_PATH', 'jacket_app.db')
+
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', 16384))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 128 * 1024 * 1024))
+SQLITE_CACHED_STATEMENTS = int(os.getenv('SQLITE_CACHED_STATEMENTS', 256))
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 8))
+
+def connect(path=DATABASE):
+    """Open a new tuned connection, e.g. for threads outside an app context."""
+    db = sqlite3.connect(
+        path,
+        timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+        cached_statements=SQLITE_CACHED_STATEMENTS,
+        check_same_thread=False,
+        factory=TracedConnection
+    )
+    db.row_factory = sqlite3.Row
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = NORMAL')
+    db.execute(f'PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}')
+    db.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_SIZE}')
+    db.execute(f'PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}')
+    db.execute('PRAGMA temp_store = MEMORY')
+    return db
+
+class ConnectionPool:
+    """Keeps up to ``size`` idle connections for reuse.
+
+    A connection belongs to the thread that acquired it until it is
+    released. Extra connections are opened when the pool is empty and
+    closed when it is full, so the pool never blocks a caller.
+    """
+
+    def __init__(self, path=DATABASE, size=DB_POOL_SIZE):
+        self.path = path
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return connect(self.path)
+
+    def release(self, db):
+        """Return a connection, rolling back anything left uncommitted."""
+        try:
+            if db.in_transaction:
+                db.rollback()
+            self.idle.put_nowait(db)
+        except (queue.Full, sqlite3.Error) as e:
+            if not isinstance(e, queue.Full):
+                logger.warning("[DB] Discarding pooled connection: %s", e)
+            db.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+pool = ConnectionPool()
+
+def get_db():
+    """Return this app context's connection, checking one out of the pool."""
+    db = getattr(g, '_database', None)
+    if db is None:
+        db = g._database = pool.acquire()
+    return db
+
+def release_db(exception=None):
+    """Hand the app context's connection back to the pool."""
+    db = g.pop('_database', None)
+    if db is not None:
+        pool.release(db)
+
+def init_app(app):
+    """Return pooled connections when each app context ends."""
+    app.teardown_appcontext(release_db)
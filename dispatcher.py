@@ -0,0 +1,207 @@
+"""Minute-bucket dispatcher for the daily weather texts.
+
+A single cron job fires once a minute and looks up, through the
+``(send_minute, id)`` index on ``users``, which users are due in that
+minute. The due rows are handed to the send pipeline as one batch, so the
+scheduler holds one trigger no matter how many users are registered.
+
+``send_minute`` is the preferred time as minutes after midnight in the
+scheduler timezone. It is derived once from the ``preferred_time`` string
+when that is written, so no hot path has to parse times again.
+"""
+import logging
+from datetime import datetime, time
+from apscheduler.triggers.cron import CronTrigger
+from pipeline import SEND_COLUMNS, SEND_ORDER
+from shards import shard_filter_sql, SEND_SHARD_COUNT
+
+logger = logging.getLogger(__name__)
+
+DISPATCH_JOB_ID = 'weather_dispatcher'
+
+# Job ids created by earlier versions of init_scheduler, /schedule-user-jobs,
+# /profile and app startup.
+LEGACY_JOB_PREFIXES = ('weather_job_', 'weather_update_')
+LEGACY_JOB_IDS = ('daily_weather_job',)
+
+DEFAULT_SEND_MINUTE = 7 * 60 + 30
+
+SEND_MINUTE_INDEX_SQL = (
+    'CREATE INDEX IF NOT EXISTS idx_users_send_minute '
+    'ON users (send_minute, id)'
+)
+
+def parse_preferred_time(value):
+    """Convert a "%H:%M" or "%I:%M %p" string to minutes after midnight."""
+    if not value:
+        return None
+    value = value.strip().upper()
+    for fmt in ('%H:%M', '%I:%M %p'):
+        try:
+            dt = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return dt.hour * 60 + dt.minute
+    return None
+
+def format_send_minute(send_minute, fmt='%I:%M %p'):
+    """Format minutes after midnight for display, defaulting to 07:30 AM."""
+    if send_minute is None:
+        send_minute = DEFAULT_SEND_MINUTE
+    hour, minute = divmod(send_minute, 60)
+    return time(hour, minute).strftime(fmt)
+
+def minute_of_day(now):
+    """Return the minutes after midnight of a datetime."""
+    return now.hour * 60 + now.minute
+
+def migrate_send_minute(db):
+    """Add users.send_minute, backfill it from preferred_time and index it."""
+    columns = {row[1] for row in db.execute('PRAGMA table_info(users)')}
+    if 'send_minute' not in columns:
+        db.execute('ALTER TABLE users ADD COLUMN send_minute INTEGER')
+        logger.info("[DISPATCHER] Added send_minute column to users")
+
+    # Only rows that were never normalized need parsing
+    rows = db.execute(
+        'SELECT id, preferred_time FROM users WHERE send_minute IS NULL'
+    ).fetchall()
+    updates = []
+    for user_id, preferred_time in rows:
+        send_minute = parse_preferred_time(preferred_time)
+        if send_minute is None:
+            logger.warning("[DISPATCHER] Unparseable preferred_time %r for user %s, using default",
+                           preferred_time, user_id)
+            send_minute = DEFAULT_SEND_MINUTE
+        updates.append((send_minute, user_id))
+    db.executemany('UPDATE users SET send_minute = ? WHERE id = ?', updates)
+    if updates:
+        logger.info("[DISPATCHER] Backfilled send_minute for %s users", len(updates))
+
+    db.execute('DROP INDEX IF EXISTS idx_users_preferred_time')
+    db.execute(SEND_MINUTE_INDEX_SQL)
+    db.commit()
+    return len(updates)
+
+def reschedule_user(db, user_id, send_minute):
+    """Move one user's daily send to a new minute.
+
+    This touches a single row and its index entry. The dispatcher picks the
+    new minute up on its next tick, so no scheduler job has to change.
+    """
+    db.execute(
+        'UPDATE users SET preferred_time = ?, send_minute = ? WHERE id = ?',
+        [format_send_minute(send_minute, '%H:%M'), send_minute, user_id]
+    )
+    db.commit()
+    logger.info("[DISPATCHER] User %s rescheduled to %s", user_id, format_send_minute(send_minute, '%H:%M'))
+
+def rebuild_schedule(db):
+    """Re-derive send_minute for every user from preferred_time.
+
+    This scans the whole table and is meant for administrative rebuilds
+    only; profile edits go through reschedule_user.
+    """
+    db.execute('UPDATE users SET send_minute = NULL')
+    return migrate_send_minute(db)
+
+def due_users_query(now, shards=None, shard_count=SEND_SHARD_COUNT, first_minute=None):
+    """Build the condition selecting users due in the minute of ``now``.
+
+    With ``first_minute`` every minute from it up to ``now`` is selected,
+    which is how missed ticks are caught up. When ``shards`` is given only
+    users in those shards are selected. Returns ``(where, params)``, or
+    ``None`` when no shards are held.
+    """
+    last_minute = minute_of_day(now)
+    if first_minute is None or first_minute >= last_minute:
+        where = 'send_minute = ?'
+        params = [last_minute]
+    else:
+        where = 'send_minute BETWEEN ? AND ?'
+        params = [first_minute, last_minute]
+    if shards is not None:
+        if not shards:
+            return None
+        condition, shard_params = shard_filter_sql(shards, shard_count)
+        where += f' AND {condition}'
+        params += shard_params
+    return where, params
+
+def due_users(db, now, shards=None, shard_count=SEND_SHARD_COUNT, first_minute=None):
+    """Fetch the users due in the minute of ``now``, or since first_minute."""
+    due = due_users_query(now, shards, shard_count, first_minute)
+    if due is None:
+        return []
+    where, params = due
+    return db.execute(f'SELECT {SEND_COLUMNS} FROM users WHERE {where} {SEND_ORDER}', params).fetchall()
+
+def remove_legacy_jobs(scheduler):
+    """Drop per-user and all-user jobs left over from before the dispatcher."""
+    removed = 0
+    for job in scheduler.get_jobs():
+        if job.id.startswith(LEGACY_JOB_PREFIXES) or job.id in LEGACY_JOB_IDS:
+            scheduler.remove_job(job.id)
+            removed += 1
+    if removed:
+        logger.info("[DISPATCHER] Removed %s legacy jobs", removed)
+    return removed
+
+def dispatcher_job_options():
+    """Return the job options the dispatcher is scheduled with."""
+    return {
+        'name': 'Weather Dispatcher',
+        'coalesce': True,
+        'max_instances': 1,
+        'misfire_grace_time': 30
+    }
+
+def schedule_dispatcher(scheduler, func):
+    """Add (or replace) the once-a-minute dispatcher job.
+
+    ``func`` should be a textual reference such as ``'app:dispatch_due_users'``
+    when the scheduler uses a persistent job store.
+    """
+    job = scheduler.add_job(
+        func=func,
+        trigger='cron',
+        minute='*',
+        id=DISPATCH_JOB_ID,
+        replace_existing=True,
+        **dispatcher_job_options()
+    )
+    # Jobs added before the scheduler starts have no next_run_time yet
+    logger.info("[DISPATCHER] Dispatcher scheduled, next run: %s", getattr(job, 'next_run_time', 'on start'))
+    return job
+
+def dispatcher_is_current(job, func_ref):
+    """Check whether a persisted dispatcher job matches the current setup."""
+    options = dispatcher_job_options()
+    expected_trigger = CronTrigger(minute='*', timezone=job.trigger.timezone)
+    return (
+        job.func_ref == func_ref
+        and str(job.trigger) == str(expected_trigger)
+        and all(getattr(job, key) == value for key, value in options.items())
+    )
+
+def reconcile_jobs(scheduler, func_ref):
+    """Apply only the job changes needed since the last boot.
+
+    The scheduler must already be started so its persistent job store is
+    loaded. Legacy jobs are removed and the dispatcher is added or replaced
+    only when it is missing or out of date; an up-to-date store is left
+    untouched. User schedules live in ``users.send_minute``, so nothing here
+    scales with the number of registered users.
+    """
+    changes = {'removed': remove_legacy_jobs(scheduler), 'added': 0, 'updated': 0}
+
+    job = scheduler.get_job(DISPATCH_JOB_ID)
+    if job is None:
+        schedule_dispatcher(scheduler, func_ref)
+        changes['added'] = 1
+    elif not dispatcher_is_current(job, func_ref):
+        schedule_dispatcher(scheduler, func_ref)
+        changes['updated'] = 1
+
+    logger.info("[DISPATCHER] Job store reconciled: %s", changes)
+    return changes
@@ -0,0 +1,225 @@
+"""Offline ZIP code to centroid lookup.
+
+The index is a small binary file that is memory-mapped on first use::
+
+    b'ZIPC' | uint32 count | uint32 zips[count] | float32 lats[count] | float32 lons[count]
+
+ZIPs are sorted, so a lookup is one binary search over the mapped array and
+never touches the network. All ~34k US ZCTAs fit in about 400 KB.
+
+Build it from the Census Gazetteer ZCTA file (tab separated, with GEOID,
+INTPTLAT and INTPTLONG columns). The source can be a local .txt or .zip, or
+a URL, and defaults to ``GAZETTEER_URL``. render.yaml runs this on every
+build, but a failed download only logs a warning and doesn't fail the
+deploy. Without the index, every ZIP is left to the backfill below::
+
+    python geocode.py build [2023_Gaz_zcta_national.zip]
+
+Then fill in coordinates for users registered before it existed::
+
+    python geocode.py backfill
+
+Requests only ever use the index. ZIPs missing from it are left without
+coordinates. The scheduler's periodic backfill then resolves them through
+Nominatim, unless ``GEOCODE_FALLBACK=none``. Only successful lookups are
+cached, so a transient Nominatim error is retried on the next pass.
+"""
+import array
+import bisect
+import csv
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import urllib.request
+import zipfile
+from functools import lru_cache
+from logconfig import configure_logging
+from monitoring import track_api_request
+
+logger = logging.getLogger(__name__)
+
+ZIP_INDEX_PATH = os.getenv(
+    'ZIP_INDEX_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'zip_centroids.bin')
+)
+GEOCODE_FALLBACK = os.getenv('GEOCODE_FALLBACK', 'nominatim')
+GAZETTEER_URL = os.getenv(
+    'GAZETTEER_URL',
+    'https://www2.census.gov/geo/docs/maps-data/data/gazetteer/2023_Gazetteer/2023_Gaz_zcta_national.zip'
+)
+
+INDEX_MAGIC = b'ZIPC'
+HEADER = struct.Struct('<4sI')
+
+class ZipIndex:
+    """Read-only view over a memory-mapped centroid index."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = HEADER.unpack_from(self.map)
+        if magic != INDEX_MAGIC or len(self.map) != HEADER.size + count * 12:
+            raise ValueError(f"{path} is not a ZIP centroid index")
+        view = memoryview(self.map)[HEADER.size:]
+        self.zips = view[:count * 4].cast('I')
+        self.lats = view[count * 4:count * 8].cast('f')
+        self.lons = view[count * 8:].cast('f')
+
+    def __len__(self):
+        return len(self.zips)
+
+    def lookup(self, zipcode):
+        """Return (lat, lon) for a ZIP, or None if it isn't indexed."""
+        key = normalize_zip(zipcode)
+        if key is None:
+            return None
+        i = bisect.bisect_left(self.zips, key)
+        if i == len(self.zips) or self.zips[i] != key:
+            return None
+        return round(self.lats[i], 6), round(self.lons[i], 6)
+
+def normalize_zip(zipcode):
+    """Return the 5-digit ZIP as an int, ignoring any ZIP+4 suffix."""
+    digits = str(zipcode or '').strip().split('-')[0]
+    if len(digits) != 5 or not digits.isdigit():
+        return None
+    return int(digits)
+
+def write_zip_index(rows, path):
+    """Write (zipcode, lat, lon) rows as an index file; returns the ZIP count."""
+    centroids = {}
+    for zipcode, lat, lon in rows:
+        key = normalize_zip(zipcode)
+        if key is not None:
+            centroids[key] = (float(lat), float(lon))
+    keys = sorted(centroids)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(INDEX_MAGIC, len(keys)))
+        f.write(array.array('I', keys).tobytes())
+        f.write(array.array('f', (centroids[k][0] for k in keys)).tobytes())
+        f.write(array.array('f', (centroids[k][1] for k in keys)).tobytes())
+    return len(keys)
+
+def read_gazetteer(path):
+    """Yield (zipcode, lat, lon) from a Census Gazetteer ZCTA file or its .zip."""
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            name = next(name for name in archive.namelist() if name.endswith('.txt'))
+            with archive.open(name) as f:
+                yield from _gazetteer_rows(line.decode('utf-8') for line in f)
+    else:
+        with open(path, newline='') as f:
+            yield from _gazetteer_rows(f)
+
+def _gazetteer_rows(lines):
+    reader = csv.reader(lines, delimiter='\t')
+    header = [name.strip() for name in next(reader)]
+    zip_col, lat_col, lon_col = (header.index(name) for name in ('GEOID', 'INTPTLAT', 'INTPTLONG'))
+    for row in reader:
+        yield row[zip_col].strip(), row[lat_col].strip(), row[lon_col].strip()
+
+def build_zip_index(source=GAZETTEER_URL, path=ZIP_INDEX_PATH):
+    """Build the index from a Gazetteer file or URL; returns the ZIP count."""
+    if not source.startswith(('http://', 'https://')):
+        return write_zip_index(read_gazetteer(source), path)
+    with tempfile.NamedTemporaryFile(suffix='.zip') as download:
+        with urllib.request.urlopen(source, timeout=60) as response:
+            download.write(response.read())
+        download.flush()
+        return write_zip_index(read_gazetteer(download.name), path)
+
+_index = None
+_index_loaded = False
+_index_lock = threading.Lock()
+
+def get_zip_index():
+    """Map the index on first use; None when no index is installed."""
+    global _index, _index_loaded
+    if not _index_loaded:
+        with _index_lock:
+            if not _index_loaded:
+                try:
+                    _index = ZipIndex(ZIP_INDEX_PATH)
+                    logger.info("[GEOCODE] Loaded %s ZIP centroids", len(_index))
+                except (OSError, ValueError) as e:
+                    logger.warning("[GEOCODE] No ZIP index available (%s), using %s", e, GEOCODE_FALLBACK)
+                _index_loaded = True
+    return _index
+
+@track_api_request('nominatim', 'geocode', payload_size=lambda location: len(str(location.raw)) if location else 0)
+def _nominatim_geocode(zipcode):
+    from geopy.geocoders import Nominatim
+
+    return Nominatim(user_agent="jacket-app").geocode({"postalcode": zipcode, "country": "US"})
+
+@lru_cache(maxsize=4096)
+def _nominatim(zipcode):
+    # Errors propagate, so lru_cache only keeps answers
+    location = _nominatim_geocode(zipcode)
+    return (location.latitude, location.longitude) if location else None
+
+def geocode_zip(zipcode, fallback=False):
+    """Return (lat, lon) for a US ZIP code, or (None, None).
+
+    Only the local index is used unless ``fallback`` is set, which may
+    call Nominatim and should stay off request paths.
+    """
+    index = get_zip_index()
+    coordinates = index.lookup(zipcode) if index is not None else None
+    if coordinates is None and fallback and GEOCODE_FALLBACK == 'nominatim' and normalize_zip(zipcode):
+        try:
+            coordinates = _nominatim(f'{normalize_zip(zipcode):05d}')
+        except Exception as e:
+            logger.error("Error fetching coordinates: %s", e)
+    return coordinates or (None, None)
+
+def backfill_coordinates(db, batch_size=500, fallback=False):
+    """Set latitude/longitude for users that have a zipcode but no coordinates.
+
+    Each distinct ZIP is resolved once. Returns the number of users updated.
+    """
+    if not fallback and get_zip_index() is None:
+        return 0
+    rows = db.execute(
+        'SELECT id, zipcode FROM users WHERE latitude IS NULL AND zipcode IS NOT NULL'
+    ).fetchall()
+    resolved = {}
+    updates = []
+    updated = 0
+    for user_id, zipcode in rows:
+        if zipcode not in resolved:
+            resolved[zipcode] = geocode_zip(zipcode, fallback)
+        lat, lon = resolved[zipcode]
+        if lat is None:
+            continue
+        updates.append((lat, lon, user_id))
+        if len(updates) >= batch_size:
+            db.executemany('UPDATE users SET latitude = ?, longitude = ? WHERE id = ?', updates)
+            db.commit()
+            updated += len(updates)
+            updates = []
+    if updates:
+        db.executemany('UPDATE users SET latitude = ?, longitude = ? WHERE id = ?', updates)
+        db.commit()
+        updated += len(updates)
+    if rows:
+        logger.info("[GEOCODE] Backfilled coordinates for %s/%s users", updated, len(rows))
+    return updated
+
+if __name__ == '__main__':
+    configure_logging()
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    if command == 'build' and len(sys.argv) <= 3:
+        count = build_zip_index(*sys.argv[2:])
+        print(f"Wrote {count} ZIP centroids to {ZIP_INDEX_PATH}")
+    elif command == 'backfill':
+        from database import connect
+
+        print(f"Updated {backfill_coordinates(connect(), fallback=True)} users")
+    else:
+        print("usage: python geocode.py build [gazetteer .txt, .zip or URL] | backfill")
+        sys.exit(2)
@@ -0,0 +1,110 @@
+"""Exactly-once ledger for the daily weather texts.
+
+Every path that sends the daily message first claims the
+``(user_id, local_date)`` row in ``daily_sends``. The claim is a single
+``INSERT OR IGNORE`` against the primary key, so when the dispatcher, the
+worker and a manual trigger race for the same user only one of them wins,
+and the losers stop before calling the weather, OpenAI or Twilio APIs.
+"""
+import logging
+
+from runs import RunTakenOver, hold_run
+
+logger = logging.getLogger(__name__)
+
+LEDGER_SCHEMA_SQL = '''
+CREATE TABLE IF NOT EXISTS daily_sends (
+    user_id INTEGER NOT NULL,
+    local_date TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'claimed',
+    run_id TEXT,
+    claimed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, local_date)
+) WITHOUT ROWID;
+'''
+
+STATUS_CLAIMED = 'claimed'
+STATUS_SENT = 'sent'
+
+def ensure_ledger(db):
+    """Create the daily_sends table if it does not exist yet."""
+    db.executescript(LEDGER_SCHEMA_SQL)
+    columns = {row[1] for row in db.execute('PRAGMA table_info(daily_sends)')}
+    if 'run_id' not in columns:
+        db.execute('ALTER TABLE daily_sends ADD COLUMN run_id TEXT')
+    db.commit()
+
+def claim_daily_send(db, user_id, local_date):
+    """Atomically claim today's send for a user; False if already claimed."""
+    cur = db.execute(
+        'INSERT OR IGNORE INTO daily_sends (user_id, local_date) VALUES (?, ?)',
+        [user_id, local_date]
+    )
+    db.commit()
+    if cur.rowcount != 1:
+        logger.info("[LEDGER] Send for user %s on %s already claimed, skipping", user_id, local_date)
+        return False
+    return True
+
+def mark_daily_send(db, user_id, local_date, status=STATUS_SENT):
+    """Record the outcome of a claimed send."""
+    db.execute(
+        '''UPDATE daily_sends SET status = ?, updated_at = CURRENT_TIMESTAMP
+           WHERE user_id = ? AND local_date = ?''',
+        [status, user_id, local_date]
+    )
+    db.commit()
+
+def release_daily_send(db, user_id, local_date):
+    """Give a claim back when nothing was sent, so a later run can retry."""
+    db.execute(
+        'DELETE FROM daily_sends WHERE user_id = ? AND local_date = ? AND status = ?',
+        [user_id, local_date, STATUS_CLAIMED]
+    )
+    db.commit()
+
+def claim_daily_sends(db, user_ids, local_date, run_id=None, owner=None):
+    """Claim today's send for a batch of users in one transaction.
+
+    A resumed run may take back its own claims that never reached an
+    outcome; every other existing claim is left alone. Returns the ids
+    that were claimed. With a ``run_id`` the batch is only claimed while
+    ``owner`` still holds the run, else ``RunTakenOver`` is raised.
+    """
+    # The heartbeat takes the write lock, so the run can't change hands mid-batch
+    if run_id is not None and not hold_run(db, run_id, owner):
+        db.rollback()
+        raise RunTakenOver(run_id)
+    claimed = []
+    for user_id in user_ids:
+        cur = db.execute(
+            '''INSERT INTO daily_sends (user_id, local_date, run_id) VALUES (?, ?, ?)
+               ON CONFLICT (user_id, local_date) DO UPDATE SET claimed_at = CURRENT_TIMESTAMP
+               WHERE daily_sends.status = ? AND daily_sends.run_id = excluded.run_id''',
+            [user_id, local_date, run_id, STATUS_CLAIMED]
+        )
+        if cur.rowcount == 1:
+            claimed.append(user_id)
+    db.commit()
+    skipped = len(user_ids) - len(claimed)
+    if skipped:
+        logger.info("[LEDGER] %s sends on %s already claimed, skipping", skipped, local_date)
+    return claimed
+
+def mark_daily_sends(db, user_ids, local_date, status=STATUS_SENT):
+    """Record the outcome of a batch of claimed sends."""
+    db.executemany(
+        '''UPDATE daily_sends SET status = ?, updated_at = CURRENT_TIMESTAMP
+           WHERE user_id = ? AND local_date = ?''',
+        [(status, user_id, local_date) for user_id in user_ids]
+    )
+    db.commit()
+
+def release_daily_sends(db, user_ids, local_date):
+    """Give back a batch of claims for which nothing was sent."""
+    db.executemany(
+        'DELETE FROM daily_sends WHERE user_id = ? AND local_date = ? AND status = ?',
+        [(user_id, local_date, STATUS_CLAIMED) for user_id in user_ids]
+    )
+    db.commit()
@@ -0,0 +1,129 @@
+"""Logging setup shared by the web app, the scheduler worker and the CLIs.
+
+Every record goes onto an in-memory queue. A ``QueueListener`` thread
+writes it to stderr and to ``LOG_FILE``, so request threads never wait on
+disk. When ``LOG_QUEUE_SIZE`` records are already waiting, new ones are
+dropped and counted rather than blocking the caller.
+
+``LOG_LEVEL`` sets the root level, optionally followed by per-logger
+levels::
+
+    LOG_LEVEL=INFO,pipeline=DEBUG,werkzeug=WARNING
+
+``LOG_SAMPLE`` keeps only a fraction of the INFO and DEBUG records from
+chatty loggers. Warnings and errors always pass::
+
+    LOG_SAMPLE=request_tracker=0.01,monitoring=0.1
+
+Log calls pass their arguments %-style (``logger.info("sent %s", sid)``),
+so filtered or sampled records are never formatted.
+"""
+import atexit
+import itertools
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_SAMPLE = os.getenv('LOG_SAMPLE', 'request_tracker=0.01')
+LOG_FILE = os.getenv('LOG_FILE', 'logs/jacket_app.log')
+LOG_FILE_MAX_BYTES = int(os.getenv('LOG_FILE_MAX_BYTES', 10 * 1024 * 1024))
+LOG_FILE_BACKUP_COUNT = int(os.getenv('LOG_FILE_BACKUP_COUNT', 5))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+def parse_levels(spec):
+    """Parse "INFO,pipeline=DEBUG" into (root level, {logger name: level})."""
+    root_level = logging.INFO
+    levels = {}
+    for part in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, level = part.rpartition('=')
+        if name:
+            levels[name.strip()] = level.strip().upper()
+        else:
+            root_level = level.upper()
+    return root_level, levels
+
+def parse_samples(spec):
+    """Parse "request_tracker=0.01" into {logger name: rate}."""
+    samples = {}
+    for part in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, rate = part.partition('=')
+        samples[name.strip()] = float(rate)
+    return samples
+
+class SamplingFilter(logging.Filter):
+    """Pass one in every 1/rate INFO or DEBUG records; warnings always pass."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.every = round(1 / rate) if rate > 0 else 0
+        self.seen = itertools.count()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        # next() on a count is atomic under the GIL
+        return bool(self.every) and next(self.seen) % self.every == 0
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+listener = None
+queue_handler = None
+
+def configure_logging(level=LOG_LEVEL, log_file=LOG_FILE, samples=LOG_SAMPLE):
+    """Route all logging through one background writer; later calls are no-ops."""
+    global listener, queue_handler
+    if listener is not None:
+        return listener
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        os.makedirs(os.path.dirname(log_file) or '.', exist_ok=True)
+        handlers.append(RotatingFileHandler(log_file, maxBytes=LOG_FILE_MAX_BYTES,
+                                            backupCount=LOG_FILE_BACKUP_COUNT))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    root.addHandler(queue_handler)
+
+    root_level, levels = parse_levels(level)
+    root.setLevel(root_level)
+    for name, logger_level in levels.items():
+        logging.getLogger(name).setLevel(logger_level)
+    # Filters only see records logged on that logger itself, not its children
+    for name, rate in parse_samples(samples).items():
+        logging.getLogger(name).addFilter(SamplingFilter(rate))
+
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_logging)
+    return listener
+
+def stop_logging():
+    """Write out whatever is still queued and stop the writer thread."""
+    global listener
+    if listener is None:
+        return
+    if queue_handler.dropped:
+        logging.getLogger(__name__).warning("Dropped %d log records while the queue was full",
+                                            queue_handler.dropped)
+    listener.stop()
+    listener = None
@@ -1,28 +1,29 @@
+"""Request metrics, latency histograms and the Prometheus /metrics endpoint.
+
+With several worker processes, set ``PROMETHEUS_MULTIPROC_DIR`` to an
+empty directory shared by all of them, including ``scheduler.py``, before
+they start. prometheus_client reads it at import. Each process then
+writes its samples to files there, and /metrics adds them up. Process
+metrics (CPU, memory, open files) keep a ``pid`` label per live process.
+Run ``scheduler.py`` with ``METRICS_PORT`` to scrape the worker directly
+when it doesn't share the directory with the web process.
+"""
+import atexit
 import os
+import math
+import threading
 import time
 import functools
 import logging
-from flask import request, g
-from logging.handlers import RotatingFileHandler
-from prometheus_client import Counter, Histogram, Info, Gauge
-from datetime import datetime
-
-# Ensure logs directory exists
-if not os.path.exists('logs'):
-    os.makedirs('logs')
-
-# Configure logging for monitoring
-logging.basicConfig(
-    handlers=[
-        RotatingFileHandler(
-            'logs/monitoring.log',
-            maxBytes=100000,
-            backupCount=3
-        )
-    ],
-    level=logging.INFO,
-    format='%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
-)
+from flask import request, g, jsonify, got_request_exception, Response
+from prometheus_client import (Counter, Histogram, Gauge, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST,
+                               ProcessCollector, generate_latest, multiprocess, start_http_server)
+from tracing import span
+
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+PROCESS_METRICS_INTERVAL = int(os.getenv('PROCESS_METRICS_INTERVAL', 15))
+
+logger = logging.getLogger(__name__)
 
 # Prometheus metrics
 REQUEST_COUNT = Counter(
@@ -43,89 +44,261 @@ ERROR_COUNT = Counter(
     ['error_type']
 )
 
-ACTIVE_USERS = Gauge(
-    'flask_active_users',
-    'Number of active users'
-)
-
 API_REQUEST_COUNT = Counter(
     'flask_api_request_count',
     'External API Request Count',
     ['api_name']
 )
 
-APP_INFO = Info('flask_app_info', 'Application information')
+UPSTREAM_LATENCY = Histogram(
+    'upstream_request_latency_seconds',
+    'Latency of calls to external APIs',
+    ['api', 'operation', 'status']
+)
+
+UPSTREAM_PAYLOAD_BYTES = Histogram(
+    'upstream_payload_bytes',
+    'Payload size of external API calls (response body, message body for SMS)',
+    ['api', 'operation'],
+    buckets=(64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+)
+
+UPSTREAM_RETRIES = Counter(
+    'upstream_retries',
+    'Retries taken by external API clients',
+    ['api', 'operation']
+)
+
+UPSTREAM_TOKENS = Counter(
+    'upstream_tokens',
+    'Tokens billed by external APIs',
+    ['api', 'operation', 'kind']
+)
+
+# Info metrics are dropped in multiprocess mode, so this is the gauge an Info
+# would have exported
+APP_INFO = Gauge(
+    'flask_app_info',
+    'Application information',
+    ['version', 'environment'],
+    multiprocess_mode='max'
+)
+
+# Latency histograms cover 100µs to 100s in buckets 2% apart, so any
+# percentile is reported within about 1% of the true value
+LATENCY_MIN_SECONDS = 1e-4
+LATENCY_MAX_SECONDS = 100.0
+LATENCY_BUCKET_GROWTH = 1.02
+LATENCY_BUCKETS = math.ceil(math.log(LATENCY_MAX_SECONDS / LATENCY_MIN_SECONDS) / math.log(LATENCY_BUCKET_GROWTH))
+
+class LatencyHistogram:
+    """Fixed-size, log-bucketed latency histogram (HDR style).
+
+    Memory is one counter per bucket no matter how many requests are
+    recorded, so it stays constant over any uptime.
+    """
+
+    def __init__(self):
+        # Index 0 holds everything under the minimum, the last index the overflow
+        self.counts = [0] * (LATENCY_BUCKETS + 2)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def _index(self, seconds):
+        if seconds <= LATENCY_MIN_SECONDS:
+            return 0
+        index = int(math.log(seconds / LATENCY_MIN_SECONDS) / math.log(LATENCY_BUCKET_GROWTH)) + 1
+        return min(index, LATENCY_BUCKETS + 1)
+
+    def record(self, seconds):
+        with self.lock:
+            self.counts[self._index(seconds)] += 1
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """Return the p-th percentile latency in seconds (0 when empty)."""
+        with self.lock:
+            if not self.count:
+                return 0.0
+            rank = max(1, math.ceil(p / 100 * self.count))
+            seen = 0
+            for index, bucket_count in enumerate(self.counts):
+                seen += bucket_count
+                if seen >= rank:
+                    break
+            # Midpoint of the bucket, which never exceeds the largest value seen
+            upper = LATENCY_MIN_SECONDS * LATENCY_BUCKET_GROWTH ** index
+            return min(upper / math.sqrt(LATENCY_BUCKET_GROWTH), self.max)
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count * 1000, 2) if self.count else 0.0,
+            'p50_ms': round(self.percentile(50) * 1000, 2),
+            'p90_ms': round(self.percentile(90) * 1000, 2),
+            'p99_ms': round(self.percentile(99) * 1000, 2),
+            'max_ms': round(self.max * 1000, 2)
+        }
 
 # Initialize metrics
 api_requests = {}
 response_times = {}
+response_times_lock = threading.Lock()
+
+def record_latency(endpoint, seconds):
+    """Add one request's latency to its endpoint's histogram."""
+    histogram = response_times.get(endpoint)
+    if histogram is None:
+        with response_times_lock:
+            histogram = response_times.setdefault(endpoint, LatencyHistogram())
+    histogram.record(seconds)
+
+def latency_stats():
+    """Return p50/p90/p99/max per endpoint."""
+    return {endpoint: histogram.snapshot() for endpoint, histogram in sorted(response_times.items())}
+
+def metrics_registry():
+    """Registry to expose: every process's samples in multiprocess mode, else this process's."""
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+process_metrics_pid = None
+process_metrics_lock = threading.Lock()
+
+def start_process_metrics(interval=PROCESS_METRICS_INTERVAL):
+    """Publish this process's CPU, memory and file metrics in multiprocess mode.
+
+    The default ProcessCollector only reports the process serving the
+    scrape, so a thread copies its samples into per-pid gauges instead.
+    Safe to call repeatedly; it starts once per process, forks included.
+    """
+    global process_metrics_pid
+    if not PROMETHEUS_MULTIPROC_DIR or process_metrics_pid == os.getpid():
+        return
+    with process_metrics_lock:
+        if process_metrics_pid == os.getpid():
+            return
+        process_metrics_pid = os.getpid()
+    atexit.register(multiprocess.mark_process_dead, process_metrics_pid)
+
+    collector = ProcessCollector(registry=None)
+    gauges = {}
+
+    def refresh():
+        while True:
+            for family in collector.collect():
+                for sample in family.samples:
+                    if sample.name not in gauges:
+                        gauges[sample.name] = Gauge(sample.name, family.documentation,
+                                                    multiprocess_mode='liveall', registry=None)
+                    gauges[sample.name].set(sample.value)
+            time.sleep(interval)
+
+    threading.Thread(target=refresh, name='process-metrics', daemon=True).start()
+
+def start_metrics_server(port):
+    """Serve /metrics on its own port, for processes without a Flask app."""
+    start_process_metrics()
+    start_http_server(port, registry=metrics_registry())
+    logger.info("[METRICS] Serving metrics on port %s", port)
+
+def record_exception(sender, exception, **extra):
+    ERROR_COUNT.labels(error_type=exception.__class__.__name__).inc()
 
 def init_metrics(app):
     """Initialize metrics collection"""
-    APP_INFO.info({
-        'version': app.config.get('VERSION', 'unknown'),
-        'environment': app.config.get('ENV', 'development'),
-        'start_time': datetime.now().isoformat()
-    })
+    APP_INFO.labels(
+        version=app.config.get('VERSION', 'unknown'),
+        environment=app.config.get('ENV', 'development')
+    ).set(1)
+    start_process_metrics()
 
     @app.before_request
     def before_request():
-        g.start_time = time.time()
+        # Forked workers need their own process metrics thread
+        start_process_metrics()
+        g.start_time = time.perf_counter()
 
     @app.after_request
     def after_request(response):
-        # Record request latency
-        latency = time.time() - g.start_time
-        REQUEST_LATENCY.labels(endpoint=request.endpoint).observe(latency)
-        
-        # Record request count
+        # Unmatched routes (404s) have no endpoint
+        endpoint = request.endpoint or 'unknown'
         REQUEST_COUNT.labels(
             method=request.method,
-            endpoint=request.endpoint,
+            endpoint=endpoint,
             status=response.status_code
         ).inc()
         
         if hasattr(g, 'start_time'):
-            elapsed = time.time() - g.start_time
-            endpoint = request.endpoint or 'unknown'
+            elapsed = time.perf_counter() - g.start_time
+            REQUEST_LATENCY.labels(endpoint=endpoint).observe(elapsed)
             
-            logging.info(
-                f"Request to {endpoint} completed in {elapsed:.2f}s "
-                f"with status {response.status_code}"
-            )
+            logger.debug("Request to %s completed in %.2fs with status %s", endpoint, elapsed, response.status_code)
 
             # Update metrics
-            if endpoint in response_times:
-                response_times[endpoint].append(elapsed)
-            else:
-                response_times[endpoint] = [elapsed]
+            record_latency(endpoint, elapsed)
 
         return response
 
-    @app.errorhandler(Exception)
-    def handle_error(error):
-        error_type = error.__class__.__name__
-        ERROR_COUNT.labels(error_type=error_type).inc()
-        app.logger.error(f"Error occurred: {error_type} - {str(error)}")
-        raise error
+    @app.route('/metrics')
+    def metrics():
+        """Prometheus exposition of every metric above."""
+        return Response(generate_latest(metrics_registry()), mimetype=CONTENT_TYPE_LATEST)
+
+    @app.route('/stats/latency')
+    def latency_stats_view():
+        """Per-endpoint latency percentiles as JSON."""
+        return jsonify(latency_stats())
+
+    # Count unhandled exceptions without taking over error handling;
+    # an errorhandler(Exception) would also swallow 404s and redirects
+    got_request_exception.connect(record_exception, app)
+
+def response_size(result):
+    """Body size in bytes of a requests or OpenAI raw response, else None."""
+    content = getattr(result, 'content', None)
+    return len(content) if isinstance(content, (bytes, str)) else None
+
+def record_token_usage(api_name, operation, usage):
+    """Count the prompt and completion tokens reported by an API response."""
+    if usage is None:
+        return
+    UPSTREAM_TOKENS.labels(api=api_name, operation=operation, kind='prompt').inc(usage.prompt_tokens or 0)
+    UPSTREAM_TOKENS.labels(api=api_name, operation=operation, kind='completion').inc(usage.completion_tokens or 0)
 
-def track_api_request(api_name):
-    """Decorator to track external API requests"""
+def track_api_request(api_name, operation='request', payload_size=response_size):
+    """Decorator to track external API requests
+
+    Records latency by api, operation and status, the payload size and the
+    retries the client took (a ``retries_taken`` attribute on the result,
+    as on OpenAI raw responses). Wrap the call that returns the raw
+    response so its size can be read, or pass ``payload_size``.
+    """
     def decorator(f):
         @functools.wraps(f)
         def wrapper(*args, **kwargs):
             API_REQUEST_COUNT.labels(api_name=api_name).inc()
-            start_time = time.time()
+            start_time = time.perf_counter()
             
             try:
-                result = f(*args, **kwargs)
+                with span(api_name, operation):
+                    result = f(*args, **kwargs)
                 status = 'success'
             except Exception as e:
                 status = 'error'
-                logging.error(f"API error in {api_name}: {str(e)}")
+                ERROR_COUNT.labels(error_type=e.__class__.__name__).inc()
+                logger.error("API error in %s %s: %s", api_name, operation, e)
                 raise
             finally:
-                elapsed = time.time() - start_time
+                elapsed = time.perf_counter() - start_time
+                UPSTREAM_LATENCY.labels(api=api_name, operation=operation, status=status).observe(elapsed)
                 
                 # Update metrics
                 if api_name not in api_requests:
@@ -134,19 +307,19 @@ def track_api_request(api_name):
                 api_requests[api_name][status] += 1
                 api_requests[api_name]['total_time'] += elapsed
                 
-                logging.info(
-                    f"API call to {api_name} completed in {elapsed:.2f}s "
-                    f"with status {status}"
-                )
+                logger.debug("API call to %s %s completed in %.2fs with status %s",
+                             api_name, operation, elapsed, status)
             
+            size = payload_size(result)
+            if size is not None:
+                UPSTREAM_PAYLOAD_BYTES.labels(api=api_name, operation=operation).observe(size)
+            retries = getattr(result, 'retries_taken', 0)
+            if retries:
+                UPSTREAM_RETRIES.labels(api=api_name, operation=operation).inc(retries)
             return result
         return wrapper
     return decorator
 
-def update_active_users(delta=1):
-    """Update the number of active users"""
-    ACTIVE_USERS.inc(delta)
-
 class RequestTracker:
     """Track detailed request information"""
     def __init__(self, app):
@@ -160,10 +333,9 @@ class RequestTracker:
         ip = request.remote_addr
         user_agent = request.headers.get('User-Agent')
         
-        self.logger.info(
-            f"Request - Endpoint: {endpoint}, Method: {method}, "
-            f"IP: {ip}, User-Agent: {user_agent}"
-        )
+        # Sampled through LOG_SAMPLE, request_tracker=0.01 by default
+        self.logger.info("Request - Endpoint: %s, Method: %s, IP: %s, User-Agent: %s",
+                         endpoint, method, ip, user_agent)
 
 def setup_monitoring(app):
     """Set up all monitoring components"""
@@ -177,49 +349,5 @@ def setup_monitoring(app):
     def track_request():
         tracker.track_request()
     
-    @app.before_request
-    def track_session():
-        if 'user_id' in request.args:
-            update_active_users(1)
-    
-    @app.teardown_request
-    def teardown_request(exception=None):
-        if exception:
-            ERROR_COUNT.labels(error_type=str(type(exception).__name__)).inc()
-    
-    # Setup logging
-    if not app.debug:
-        if not os.path.exists('logs'):
-            os.mkdir('logs')
-        file_handler = RotatingFileHandler(
-            'logs/jacket_app.log',
-            maxBytes=10240,
-            backupCount=10
-        )
-        file_handler.setFormatter(logging.Formatter(
-            '%(asctime)s %(levelname)s: %(message)s '
-            '[in %(pathname)s:%(lineno)d]'
-        ))
-        file_handler.setLevel(logging.INFO)
-        app.logger.addHandler(file_handler)
-        app.logger.setLevel(logging.INFO)
-        app.logger.info('Jacket App startup')
-
-# Utility functions for monitoring
-def log_weather_request(location, success):
-    """Log weather API requests"""
-    API_REQUEST_COUNT.labels(api_name='weather_api').inc()
-    if not success:
-        ERROR_COUNT.labels(error_type='WeatherAPIError').inc()
-
-def log_sms_request(success):
-    """Log SMS API requests"""
-    API_REQUEST_COUNT.labels(api_name='twilio_api').inc()
-    if not success:
-        ERROR_COUNT.labels(error_type='TwilioAPIError').inc()
-
-def log_gpt_request(success):
-    """Log OpenAI GPT API requests"""
-    API_REQUEST_COUNT.labels(api_name='openai_api').inc()
-    if not success:
-        ERROR_COUNT.labels(error_type='OpenAIAPIError').inc()
\ No newline at end of file
+    # app.logger propagates to the root logger set up by logconfig
+    app.logger.info('Jacket App startup')
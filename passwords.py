@@ -0,0 +1,123 @@
+"""Password hashing off the request threads.
+
+Hashes are CPU-bound. hashlib's PBKDF2 and scrypt release the GIL, so
+they run on a dedicated pool of ``PASSWORD_HASH_WORKERS`` threads, which
+lets other requests keep being served during a login burst. At most
+``PASSWORD_HASH_QUEUE`` hashes wait for a worker. Beyond that,
+``PasswordHasherBusy`` is raised right away, and the caller answers
+503 instead of piling up requests.
+
+``PASSWORD_HASH_METHOD`` takes any werkzeug method string, for example
+``pbkdf2:sha256:600000`` or ``scrypt:32768:8:1``. Hashes made with other
+parameters still verify, and ``needs_rehash`` tells login to upgrade them.
+
+Size the pool with ``python passwords.py benchmark``.
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from functools import cached_property
+from werkzeug.security import check_password_hash, generate_password_hash
+
+logger = logging.getLogger(__name__)
+
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'pbkdf2:sha256')
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', os.cpu_count() or 2))
+PASSWORD_HASH_QUEUE = int(os.getenv('PASSWORD_HASH_QUEUE', PASSWORD_HASH_WORKERS * 8))
+PASSWORD_HASH_TIMEOUT = float(os.getenv('PASSWORD_HASH_TIMEOUT', 10))
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many hashes are already queued."""
+
+def hash_method_of(password_hash):
+    """Return the full method prefix of a werkzeug hash."""
+    return password_hash.split('$', 1)[0]
+
+class PasswordHasher:
+    """Bounded executor for hashing and verifying passwords."""
+
+    def __init__(self, method=PASSWORD_HASH_METHOD, workers=PASSWORD_HASH_WORKERS,
+                 queue_size=PASSWORD_HASH_QUEUE, timeout=PASSWORD_HASH_TIMEOUT):
+        self.method = method
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def _run(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            logger.warning("[PASSWORDS] Hash queue full, rejecting request")
+            raise PasswordHasherBusy()
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise PasswordHasherBusy()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    @cached_property
+    def full_method(self):
+        # werkzeug fills in default parameters, e.g. the PBKDF2 iterations
+        return hash_method_of(generate_password_hash('', self.method))
+
+    def needs_rehash(self, password_hash):
+        """True when a stored hash was made with other parameters."""
+        return hash_method_of(password_hash) != self.full_method
+
+hasher = PasswordHasher()
+
+def benchmark(method=PASSWORD_HASH_METHOD, seconds=3.0, threads=None):
+    """Measure hashes per second on one thread and on ``threads`` threads."""
+    threads = threads or os.cpu_count() or 1
+
+    def run(thread_count):
+        counts = [0] * thread_count
+        deadline = time.perf_counter() + seconds
+
+        def worker(i):
+            while time.perf_counter() < deadline:
+                generate_password_hash('benchmark-password', method)
+                counts[i] += 1
+
+        workers = [threading.Thread(target=worker, args=(i,)) for i in range(thread_count)]
+        for worker_thread in workers:
+            worker_thread.start()
+        for worker_thread in workers:
+            worker_thread.join()
+        return sum(counts) / seconds
+
+    single = run(1)
+    parallel = run(threads)
+    return {
+        'method': hash_method_of(generate_password_hash('', method)),
+        'threads': threads,
+        'hashes_per_second_single_thread': round(single, 1),
+        'hashes_per_second_all_threads': round(parallel, 1),
+        'hashes_per_second_per_core': round(parallel / threads, 1),
+        'ms_per_hash': round(1000 / single, 1) if single else None
+    }
+
+if __name__ == '__main__':
+    if sys.argv[1:2] != ['benchmark']:
+        print("usage: python passwords.py benchmark [method] [seconds]")
+        sys.exit(2)
+
+    args = sys.argv[2:]
+    print(json.dumps(benchmark(
+        args[0] if args else PASSWORD_HASH_METHOD,
+        float(args[1]) if len(args) > 1 else 3.0
+    ), indent=2))
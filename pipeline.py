@@ -0,0 +1,491 @@
+"""Streaming, staged pipeline for the daily weather send.
+
+Users are streamed from a cursor ordered by zipcode and flow through these
+stages, connected by bounded queues. The source runs in one thread and the
+other stages each run in their own pool of worker threads:
+
+    source     stream users from the cursor, claim them in the ledger and
+               batch consecutive users that share a zipcode
+    weather    fetch the weather once per group
+    recommend  get a recommendation once per (temp, wind, condition) bucket
+    render     build each user's message
+    send       text each message
+
+The calling thread drains the last queue and records outcomes in the
+ledger. Memory stays bounded by the queue sizes and the group size rather
+than the number of users, and every stage keeps its own counters so it can
+be measured and tuned on its own.
+
+Runs given a ``run_id`` are checkpointed in ``send_runs`` (see runs.py) and
+stop reading new users once ``runs.shutdown_event`` is set. A heartbeat
+thread keeps the run marked alive while upstream calls are slow, and the
+whole pipeline stops as soon as another process has taken the run over.
+"""
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+from ledger import claim_daily_sends, mark_daily_sends, release_daily_sends
+from runs import (begin_run, checkpoint_run, finish_run, shutdown_event, RunTakenOver,
+                  RUN_COMPLETED, RUN_HEARTBEAT_SECONDS, RUN_INTERRUPTED)
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+# Columns the pipeline needs; ordering by zipcode lets users be grouped as
+# they stream past
+SEND_COLUMNS = 'id, phone_number, zipcode'
+SEND_ORDER = 'ORDER BY zipcode, id'
+
+ZIPCODE_INDEX_SQL = 'CREATE INDEX IF NOT EXISTS idx_users_zipcode ON users (zipcode, id)'
+
+def keyset_after(cursor):
+    """Return a condition selecting users after a (zipcode, id) cursor.
+
+    NULL zipcodes sort first, so they need their own branch.
+    """
+    if cursor is None:
+        return '1', []
+    zipcode, user_id = cursor
+    if zipcode is None:
+        return '((zipcode IS NULL AND id > ?) OR zipcode IS NOT NULL)', [user_id]
+    return '(zipcode > ? OR (zipcode = ? AND id > ?))', [zipcode, zipcode, user_id]
+
+def format_weather_message(weather_data, recommendation):
+    """Render the morning text for a weather reading and recommendation."""
+    temp_f = round(weather_data['main']['temp'])
+    temp_c = round((temp_f - 32) * 5.0 / 9.0)  # Convert to Celsius
+    condition = weather_data['weather'][0]['main']
+
+    return (
+        f"Good morning!\n"
+        f"Current Weather: {temp_f}°F ({temp_c}°C)\n"
+        f"Condition: {condition}\n"
+        f"Recommendation: {recommendation}"
+    )
+
+def recommendation_bucket(weather_data):
+    """Return the inputs a jacket recommendation depends on."""
+    return (
+        round(weather_data['main']['temp']),
+        round(weather_data['wind']['speed']),
+        weather_data['weather'][0]['main']
+    )
+
+class StageStats:
+    """Counters and timings for one pipeline stage."""
+
+    def __init__(self, name, workers, queue_size):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.items_in = 0
+        self.items_out = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+        self.lock = threading.Lock()
+
+    def as_dict(self):
+        return {
+            'stage': self.name,
+            'workers': self.workers,
+            'queue_size': self.queue_size,
+            'items_in': self.items_in,
+            'items_out': self.items_out,
+            'errors': self.errors,
+            'busy_seconds': round(self.busy_seconds, 4),
+            'max_queue_depth': self.max_queue_depth
+        }
+
+class SendPipeline:
+    """Runs one batch of users through the staged send.
+
+    ``providers`` supplies ``weather(zipcode)``,
+    ``recommend(temperature_f, wind_speed, condition)`` and
+    ``send(phone_number, body)``. ``connect`` opens a new database
+    connection for the source thread, since sqlite3 connections can't be
+    shared between threads. With ``record=False`` the ledger is neither
+    read nor written, which is how dry runs leave no trace.
+    """
+
+    def __init__(self, providers, connect, local_date, group_size=200, queue_size=64,
+                 claim_batch=200, weather_workers=4, send_workers=4, record=True,
+                 stop_event=shutdown_event, heartbeat_seconds=RUN_HEARTBEAT_SECONDS):
+        self.providers = providers
+        self.record = record
+        self.stop_event = stop_event
+        # Set when the run fails or is taken over; stages then drop their items
+        # so every thread can exit
+        self.aborted = threading.Event()
+        self.finished = threading.Event()
+        self.heartbeat_seconds = heartbeat_seconds
+        self.outcomes_drained = False
+        self.run_id = None
+        self.owner = None
+        self.interrupted = False
+        self.lost = False
+        self.groups = {}
+        self.groups_lock = threading.Lock()
+        self.connect = connect
+        self.local_date = local_date
+        self.group_size = group_size
+        self.queue_size = queue_size
+        self.claim_batch = claim_batch
+        self.worker_counts = {'weather': weather_workers, 'send': send_workers}
+        self.stats = {}
+        self.counters = {
+            'users_streamed': 0,
+            'users_claimed': 0,
+            'weather_calls': 0,
+            'recommendation_calls': 0,
+            'recommendation_cache_hits': 0,
+            'sms_calls': 0,
+            'sent': 0,
+            'failed': 0
+        }
+        self.counter_lock = threading.Lock()
+        self.recommendations = {}
+        self.recommendation_lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self.counter_lock:
+            self.counters[name] += amount
+
+    # Stages -------------------------------------------------------------
+
+    def stream_users(self, query, params):
+        """Yield claimed users from the cursor, claiming in small batches."""
+        db = self.connect()
+        try:
+            cursor = db.execute(query, params)
+            while True:
+                if self.stop_event.is_set() or self.aborted.is_set():
+                    self.interrupted = True
+                    logger.info("[PIPELINE] Stop requested, no longer reading users")
+                    break
+                rows = cursor.fetchmany(self.claim_batch)
+                if not rows:
+                    break
+                users = {row['id']: dict(row) for row in rows}
+                self.count('users_streamed', len(users))
+                if self.record:
+                    claimed = claim_daily_sends(db, list(users), self.local_date, self.run_id, self.owner)
+                else:
+                    claimed = list(users)
+                self.count('users_claimed', len(claimed))
+                for user_id in claimed:
+                    yield users[user_id]
+        finally:
+            db.close()
+
+    def group_users(self, users):
+        """Batch consecutive users sharing a zipcode, capped at group_size.
+
+        Groups are numbered in stream order so the sink can tell how far
+        every user has been handled.
+        """
+        group = None
+        seq = 0
+        for user in users:
+            if group and (user['zipcode'] != group['zipcode'] or len(group['users']) >= self.group_size):
+                yield self._register(group)
+                group = None
+            if group is None:
+                group = {'seq': seq, 'zipcode': user['zipcode'], 'users': []}
+                seq += 1
+            group['users'].append(user)
+        if group:
+            yield self._register(group)
+
+    def _register(self, group):
+        last = group['users'][-1]
+        with self.groups_lock:
+            self.groups[group['seq']] = {
+                'pending': len(group['users']),
+                'cursor': (last['zipcode'], last['id'])
+            }
+        return group
+
+    def resolve_weather(self, group):
+        self.count('weather_calls')
+        group['weather'] = self.providers.weather(group['zipcode'])
+        return [group]
+
+    def resolve_recommendation(self, group):
+        if 'error' in group:
+            return [group]
+        bucket = recommendation_bucket(group['weather'])
+        with self.recommendation_lock:
+            recommendation = self.recommendations.get(bucket)
+        if recommendation is None:
+            self.count('recommendation_calls')
+            recommendation = self.providers.recommend(*bucket)
+            with self.recommendation_lock:
+                self.recommendations[bucket] = recommendation
+        else:
+            self.count('recommendation_cache_hits')
+        group['recommendation'] = recommendation
+        return [group]
+
+    def render(self, group):
+        seq = group['seq']
+        if 'error' in group:
+            return [{'seq': seq, 'user': user, 'error': group['error']} for user in group['users']]
+        message = format_weather_message(group['weather'], group['recommendation'])
+        return [{'seq': seq, 'user': user, 'message': message} for user in group['users']]
+
+    def send(self, delivery):
+        if 'error' not in delivery:
+            self.count('sms_calls')
+            delivery['success'] = self.providers.send(delivery['user']['phone_number'], delivery['message'])
+        return [delivery]
+
+    # Plumbing -----------------------------------------------------------
+
+    def _stage_worker(self, stats, func, inbox, outbox, remaining):
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                with stats.lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                # The last worker forwards the end marker, the others pass it on
+                (outbox if last else inbox).put(_DONE)
+                return
+            if self.aborted.is_set():
+                continue
+            start = time.perf_counter()
+            try:
+                outputs = func(item)
+            except Exception as e:
+                logger.error("[PIPELINE] %s stage error: %s", stats.name, e)
+                item['error'] = str(e)
+                outputs = [item]
+                with stats.lock:
+                    stats.errors += 1
+            elapsed = time.perf_counter() - start
+            with stats.lock:
+                stats.items_in += 1
+                stats.items_out += len(outputs)
+                stats.busy_seconds += elapsed
+                stats.max_queue_depth = max(stats.max_queue_depth, inbox.qsize())
+            for output in outputs:
+                outbox.put(output)
+
+    def _source_worker(self, stats, query, params, outbox):
+        try:
+            groups = self.group_users(self.stream_users(query, params))
+            while True:
+                # Time only the reading and claiming, not waits on a full queue
+                start = time.perf_counter()
+                group = next(groups, None)
+                with stats.lock:
+                    stats.busy_seconds += time.perf_counter() - start
+                if group is None:
+                    break
+                with stats.lock:
+                    stats.items_in += len(group['users'])
+                    stats.items_out += 1
+                outbox.put(group)
+        except RunTakenOver:
+            self.lose()
+        except Exception as e:
+            logger.error("[PIPELINE] source stage error: %s", e)
+            with stats.lock:
+                stats.errors += 1
+            # Leave the run to be resumed rather than marking it complete
+            self.interrupted = True
+        finally:
+            outbox.put(_DONE)
+
+    def _heartbeat(self):
+        db = self.connect()
+        try:
+            while not self.finished.wait(self.heartbeat_seconds):
+                try:
+                    held = checkpoint_run(db, self.run_id, self.owner, None)
+                except sqlite3.Error as e:
+                    logger.warning("[PIPELINE] Heartbeat for run %s failed: %s", self.run_id, e)
+                    continue
+                if not held:
+                    self.lose()
+                    return
+        finally:
+            db.close()
+
+    def lose(self):
+        """Stop sending because another process now holds the run."""
+        if not self.lost:
+            logger.warning("[PIPELINE] Run %s was taken over by another process, stopping", self.run_id)
+        self.lost = True
+        self.interrupted = True
+        self.aborted.set()
+
+    def _start(self, threads):
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+    def run(self, db, where='1', params=(), run_id=None, owner=None):
+        """Send to every user matching ``where``; returns a run report.
+
+        ``db`` is the caller's connection, used to record outcomes. With a
+        ``run_id`` the run is checkpointed and, if it was interrupted
+        before, resumed after its last checkpoint. Returns ``None`` when the
+        run has already completed or is still running elsewhere.
+        """
+        started = time.perf_counter()
+        resume_after = None
+        if run_id and self.record:
+            resume_after = begin_run(db, run_id, self.local_date, where, params, owner)
+            if resume_after is False:
+                return None
+            self.run_id = run_id
+            self.owner = owner
+        keyset, keyset_params = keyset_after(resume_after)
+        query = f'SELECT {SEND_COLUMNS} FROM users WHERE ({where}) AND {keyset} {SEND_ORDER}'
+        params = list(params) + keyset_params
+
+        stages = [
+            ('weather', self.resolve_weather),
+            ('recommend', self.resolve_recommendation),
+            ('render', self.render),
+            ('send', self.send),
+        ]
+
+        source_stats = StageStats('source', 1, self.queue_size)
+        self.stats = {'source': source_stats}
+        inbox = queue.Queue(maxsize=self.queue_size)
+        threads = [threading.Thread(
+            target=self._source_worker, args=(source_stats, query, params, inbox),
+            name='pipeline-source'
+        )]
+        for name, func in stages:
+            workers = self.worker_counts.get(name, 1)
+            stats = StageStats(name, workers, self.queue_size)
+            self.stats[name] = stats
+            outbox = queue.Queue(maxsize=self.queue_size)
+            remaining = [workers]
+            for index in range(workers):
+                threads.append(threading.Thread(
+                    target=self._stage_worker, args=(stats, func, inbox, outbox, remaining),
+                    name=f'pipeline-{name}-{index}'
+                ))
+            inbox = outbox
+        if self.run_id:
+            threads.append(threading.Thread(target=self._heartbeat, name='pipeline-heartbeat'))
+        self._start(threads)
+
+        try:
+            self.record_outcomes(db, inbox)
+        except BaseException:
+            self.abort(db, inbox)
+            raise
+        finally:
+            self.finished.set()
+            for thread in threads:
+                thread.join()
+
+        if self.run_id and not self.lost:
+            finish_run(db, self.run_id, self.owner, RUN_INTERRUPTED if self.interrupted else RUN_COMPLETED)
+
+        report = self.report(time.perf_counter() - started)
+        logger.info("[PIPELINE] Run complete: %s", report['counters'])
+        return report
+
+    def abort(self, db, results):
+        """Wind the stages down after a failure and leave the run resumable."""
+        self.aborted.set()
+        self.interrupted = True
+        # Nobody else reads the last queue; empty it so the send workers can finish
+        while not self.outcomes_drained:
+            self.outcomes_drained = results.get() is _DONE
+        if self.run_id and not self.lost:
+            try:
+                finish_run(db, self.run_id, self.owner, RUN_INTERRUPTED)
+            except sqlite3.Error as e:
+                logger.error("[PIPELINE] Could not mark run %s interrupted: %s", self.run_id, e)
+
+    def record_outcomes(self, db, results, batch_size=100):
+        """Drain the send stage and write outcomes to the ledger in batches.
+
+        After each batch the run is checkpointed at the last group for which
+        it and every earlier group have all their outcomes recorded.
+        """
+        sent, failed = [], []
+        done_groups = set()
+        watermark = {'next_seq': 0, 'cursor': None}
+
+        def handled(seq, count=1):
+            with self.groups_lock:
+                group = self.groups[seq]
+                group['pending'] -= count
+                if group['pending'] == 0:
+                    done_groups.add(seq)
+
+        def advance():
+            with self.groups_lock:
+                while watermark['next_seq'] in done_groups:
+                    seq = watermark['next_seq']
+                    done_groups.discard(seq)
+                    watermark['cursor'] = self.groups.pop(seq)['cursor']
+                    watermark['next_seq'] += 1
+
+        def flush():
+            if self.record and sent:
+                mark_daily_sends(db, sent, self.local_date)
+            # After a takeover the new owner may already be retrying these
+            if self.record and failed and not self.lost:
+                release_daily_sends(db, failed, self.local_date)
+            self.count('sent', len(sent))
+            self.count('failed', len(failed))
+            sent.clear()
+            failed.clear()
+            # Outcomes are durable now, so the checkpoint may move past them
+            advance()
+            if self.run_id and not checkpoint_run(db, self.run_id, self.owner, watermark['cursor']):
+                self.lose()
+
+        while True:
+            delivery = results.get()
+            if delivery is _DONE:
+                self.outcomes_drained = True
+                break
+            if 'users' in delivery:
+                # A group that failed before it was split into deliveries
+                failed.extend(user['id'] for user in delivery['users'])
+                handled(delivery['seq'], len(delivery['users']))
+            elif delivery.get('success'):
+                sent.append(delivery['user']['id'])
+                handled(delivery['seq'])
+            else:
+                if 'error' in delivery:
+                    logger.error("[PIPELINE] User %s failed: %s", delivery['user']['id'], delivery['error'])
+                failed.append(delivery['user']['id'])
+                handled(delivery['seq'])
+            if len(sent) + len(failed) >= batch_size:
+                flush()
+        flush()
+
+    def report(self, wall_seconds):
+        """Summarize the run: stage stats, counters and cache hit rates."""
+        counters = self.counters
+        lookups = counters['recommendation_calls'] + counters['recommendation_cache_hits']
+        return {
+            'local_date': self.local_date,
+            'wall_seconds': round(wall_seconds, 4),
+            'counters': dict(counters),
+            'recommendation_cache_hit_rate': (
+                round(counters['recommendation_cache_hits'] / lookups, 4) if lookups else None
+            ),
+            # Share of users whose weather came from their zipcode group's fetch
+            'weather_group_hit_rate': (
+                round(1 - counters['weather_calls'] / counters['users_claimed'], 4)
+                if counters['users_claimed'] else None
+            ),
+            'stages': [stats.as_dict() for stats in self.stats.values()]
+        }
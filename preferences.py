@@ -1,50 +1,62 @@
-from flask import Blueprint, jsonify, request, session, g
+from functools import wraps
+from flask import Blueprint, jsonify, request, session
+import logging
 import sqlite3
+from users import get_profile, update_preferences as save_preferences
 
-def get_db():
-    if 'db' not in g:
-        g.db = sqlite3.connect('jacket_app.db')
-        g.db.row_factory = sqlite3.Row
-    return g.db
+logger = logging.getLogger(__name__)
+
+TEMPERATURE_UNITS = ('F', 'C')
+TEMPERATURE_SENSITIVITIES = ('Cold', 'Normal', 'Warm')
 
 preferences_bp = Blueprint('preferences', __name__)
 
-def init_user_preferences(user_id):
-    """Initialize preferences for new users"""
-    db = get_db()
-    try:
-        db.execute(
-            """INSERT OR IGNORE INTO user_preferences 
-               (user_id, temperature_unit, temperature_sensitivity)
-               VALUES (?, 'F', 'Normal')""",
-            [user_id]
-        )
-        db.commit()
-    except sqlite3.Error as e:
-        print(f"Error initializing user preferences: {e}")
+def migrate_preferences(db):
+    """Fold the old user_preferences table into columns on users."""
+    columns = {row[1] for row in db.execute('PRAGMA table_info(users)')}
+    if 'temperature_unit' not in columns:
+        db.execute("ALTER TABLE users ADD COLUMN temperature_unit TEXT DEFAULT 'F'")
+    legacy = db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_preferences'"
+    ).fetchone()
+    if legacy:
+        # Rows in user_preferences were the last word on both settings
+        # Correlated subqueries rather than UPDATE ... FROM, which needs SQLite 3.33
+        moved = db.execute(
+            '''UPDATE users SET
+                   temperature_unit = COALESCE(
+                       (SELECT p.temperature_unit FROM user_preferences AS p WHERE p.user_id = users.id),
+                       temperature_unit),
+                   temperature_sensitivity = COALESCE(
+                       (SELECT p.temperature_sensitivity FROM user_preferences AS p WHERE p.user_id = users.id),
+                       temperature_sensitivity)
+               WHERE id IN (SELECT user_id FROM user_preferences)'''
+        ).rowcount
+        db.execute('DROP TABLE user_preferences')
+        logger.info("[DB] Moved preferences for %s users onto users", moved)
+    db.commit()
+
+def get_user_preferences(user_id):
+    """Return a user's temperature unit and sensitivity, or None."""
+    profile = get_profile(user_id)
+    if profile is None:
+        return None
+    return {
+        'temperature_unit': profile['temperature_unit'] or 'F',
+        'temperature_sensitivity': profile['temperature_sensitivity'] or 'Normal'
+    }
 
 @preferences_bp.route('/api/preferences', methods=['GET'])
 def get_preferences():
     if 'user_id' not in session:
         return jsonify({'error': 'Not logged in'}), 401
-    db = get_db()
     try:
-        cur = db.execute(
-            """SELECT temperature_unit, temperature_sensitivity 
-               FROM user_preferences 
-               WHERE user_id = ?""",
-            [session['user_id']]
-        )
-        prefs = cur.fetchone()
+        prefs = get_user_preferences(session['user_id'])
         if prefs is None:
-            init_user_preferences(session['user_id'])
-            return jsonify({
-                'temperature_unit': 'F',
-                'temperature_sensitivity': 'Normal'
-            })
-        return jsonify(dict(prefs))
+            return jsonify({'error': 'User not found'}), 404
+        return jsonify(prefs)
     except sqlite3.Error as e:
-        print(f"Database error: {e}")
+        logger.error("[PREFERENCES] Database error: %s", e)
         return jsonify({'error': 'Database error'}), 500
 
 @preferences_bp.route('/api/preferences', methods=['POST'])
@@ -54,22 +66,15 @@ def update_preferences():
     data = request.get_json()
     temp_unit = data.get('temperature_unit', 'F')
     temp_sensitivity = data.get('temperature_sensitivity', 'Normal')
-    if temp_unit not in ['F', 'C']:
+    if temp_unit not in TEMPERATURE_UNITS:
         return jsonify({'error': 'Invalid temperature unit'}), 400
-    if temp_sensitivity not in ['Cold', 'Normal', 'Warm']:
+    if temp_sensitivity not in TEMPERATURE_SENSITIVITIES:
         return jsonify({'error': 'Invalid temperature sensitivity'}), 400
-    db = get_db()
     try:
-        db.execute(
-            """INSERT OR REPLACE INTO user_preferences 
-               (user_id, temperature_unit, temperature_sensitivity, updated_at)
-               VALUES (?, ?, ?, CURRENT_TIMESTAMP)""",
-            [session['user_id'], temp_unit, temp_sensitivity]
-        )
-        db.commit()
+        save_preferences(session['user_id'], temp_unit, temp_sensitivity)
         return jsonify({'status': 'success'})
     except sqlite3.Error as e:
-        print(f"Database error: {e}")
+        logger.error("[PREFERENCES] Database error: %s", e)
         return jsonify({'error': 'Database error'}), 500
 
 def with_user_preferences(f):
@@ -79,4 +84,4 @@ def with_user_preferences(f):
             prefs = get_user_preferences(session['user_id'])
             return f(prefs, *args, **kwargs)
         return f(None, *args, **kwargs)
-    return decorated_function
\ No newline at end of file
+    return decorated_function
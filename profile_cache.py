@@ -0,0 +1,114 @@
+"""Process-wide cache of user profiles for the hot read paths.
+
+The dashboard polls ``/weather``, ``/hourly_weather`` and
+``/weekly_weather``, and every poll used to re-read the user row. Profiles
+(location, units, sensitivity and send time) are now cached by user id
+and dropped whenever one of them is written, so the polls skip SQLite
+entirely.
+
+The backend follows the Flask config: ``CACHE_TYPE = 'redis'`` shares the
+cache across processes through ``CACHE_REDIS_URL``, and anything else uses
+an in-process LRU bounded by ``CACHE_THRESHOLD`` entries. Both expire
+entries after ``CACHE_DEFAULT_TIMEOUT`` seconds, as a backstop for writes
+that bypass invalidation.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+import redis
+from config import get_config
+
+logger = logging.getLogger(__name__)
+
+PROFILE_KEY_PREFIX = 'profile:'
+
+class MemoryBackend:
+    """LRU with per-entry expiry, safe to share between threads."""
+
+    def __init__(self, max_entries=1000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+            expires_at, profile = entry
+            if expires_at <= time.monotonic():
+                del self.entries[user_id]
+                return None
+            self.entries.move_to_end(user_id)
+            return profile
+
+    def set(self, user_id, profile):
+        with self.lock:
+            self.entries[user_id] = (time.monotonic() + self.ttl, profile)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class RedisBackend:
+    """Profiles stored as JSON under ``profile:<user_id>`` with a TTL.
+
+    Redis errors are logged and treated as misses, so an outage degrades
+    to reading SQLite rather than failing requests.
+    """
+
+    def __init__(self, url, ttl=300):
+        self.client = redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, user_id):
+        try:
+            value = self.client.get(f'{PROFILE_KEY_PREFIX}{user_id}')
+        except redis.RedisError as e:
+            logger.warning("[CACHE] Redis read failed: %s", e)
+            return None
+        return json.loads(value) if value else None
+
+    def set(self, user_id, profile):
+        try:
+            self.client.setex(f'{PROFILE_KEY_PREFIX}{user_id}', self.ttl, json.dumps(profile))
+        except redis.RedisError as e:
+            logger.warning("[CACHE] Redis write failed: %s", e)
+
+    def delete(self, user_id):
+        try:
+            self.client.delete(f'{PROFILE_KEY_PREFIX}{user_id}')
+        except redis.RedisError as e:
+            logger.error("[CACHE] Redis invalidation failed for user %s: %s", user_id, e)
+
+    def clear(self):
+        try:
+            keys = list(self.client.scan_iter(f'{PROFILE_KEY_PREFIX}*'))
+            if keys:
+                self.client.delete(*keys)
+        except redis.RedisError as e:
+            logger.error("[CACHE] Redis clear failed: %s", e)
+
+def create_backend(config):
+    """Pick the cache backend described by a config class."""
+    ttl = getattr(config, 'CACHE_DEFAULT_TIMEOUT', 300)
+    if getattr(config, 'CACHE_TYPE', 'simple') == 'redis':
+        logger.info("[CACHE] Using Redis profile cache")
+        return RedisBackend(config.CACHE_REDIS_URL, ttl)
+    return MemoryBackend(getattr(config, 'CACHE_THRESHOLD', 1000), ttl)
+
+profile_cache = create_backend(get_config())
+
+def invalidate_profile(user_id):
+    """Drop a user's cached profile after any write to it."""
+    profile_cache.delete(user_id)
@@ -0,0 +1,120 @@
+"""Rate limiting backends.
+
+``RATELIMIT_STORAGE_URL`` picks the backend:
+
+* ``redis://...`` shares limits across processes. Each check is a single
+  EVALSHA of a GCRA script (generic cell rate algorithm), so the read and
+  the update are atomic and cost one round trip over a pooled connection.
+* ``memory://`` keeps token buckets in this process, spread over
+  lock-striped shards so concurrent requests rarely contend.
+
+If Redis is unreachable, checks fall back to the in-process buckets, so
+limits keep applying with Redis down instead of failing open. After a
+failure Redis is skipped for ``RATELIMIT_REDIS_RETRY_SECONDS``, so requests
+don't each wait out a connect timeout, and the outage is logged once.
+"""
+import logging
+import math
+import os
+import threading
+import time
+import zlib
+import redis
+from config import get_config
+
+logger = logging.getLogger(__name__)
+
+RATELIMIT_REDIS_RETRY_SECONDS = float(os.getenv('RATELIMIT_REDIS_RETRY_SECONDS', 5))
+
+RATE_PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+# KEYS[1] = bucket key; ARGV = emission interval (ms), burst size.
+# Stores the theoretical arrival time (TAT) of the next request.
+GCRA_SCRIPT = '''
+local interval = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = redis.call('TIME')
+local now_ms = now[1] * 1000 + math.floor(now[2] / 1000)
+local tat = tonumber(redis.call('GET', KEYS[1]) or now_ms)
+if tat < now_ms then tat = now_ms end
+local allow_at = tat + interval - burst * interval
+if now_ms < allow_at then
+    return {0, allow_at - now_ms}
+end
+local new_tat = tat + interval
+redis.call('SET', KEYS[1], new_tat, 'PX', new_tat - now_ms)
+return {1, 0}
+'''
+
+def parse_rate(rate):
+    """Parse a rate such as "5 per minute" into (limit, period seconds)."""
+    count, _, unit = rate.strip().partition(' per ')
+    return int(count), RATE_PERIODS[unit.strip().rstrip('s')]
+
+class MemoryBackend:
+    """Token buckets held in this process, sharded by key."""
+
+    def __init__(self, shards=16, max_keys_per_shard=10000):
+        self.shards = [({}, threading.Lock()) for _ in range(shards)]
+        self.max_keys_per_shard = max_keys_per_shard
+
+    def hit(self, key, limit, period):
+        """Take one token; returns (allowed, retry_after seconds)."""
+        buckets, lock = self.shards[zlib.crc32(key.encode()) % len(self.shards)]
+        rate = limit / period
+        now = time.monotonic()
+        with lock:
+            tokens, updated = buckets.get(key, (limit, now))
+            tokens = min(limit, tokens + (now - updated) * rate)
+            if tokens < 1:
+                buckets[key] = (tokens, now)
+                return False, (1 - tokens) / rate
+            buckets[key] = (tokens - 1, now)
+            if len(buckets) > self.max_keys_per_shard:
+                self._evict(buckets, now, rate, limit)
+        return True, 0
+
+    def _evict(self, buckets, now, rate, limit):
+        # A bucket that has refilled holds no state worth keeping
+        for key, (tokens, updated) in list(buckets.items()):
+            if tokens + (now - updated) * rate >= limit:
+                del buckets[key]
+
+class RedisBackend:
+    """GCRA limits in Redis over one shared connection pool."""
+
+    def __init__(self, url, fallback=None, retry_seconds=RATELIMIT_REDIS_RETRY_SECONDS):
+        self.client = redis.Redis(connection_pool=redis.ConnectionPool.from_url(
+            url, socket_timeout=0.25, socket_connect_timeout=0.25
+        ))
+        self.script = self.client.register_script(GCRA_SCRIPT)
+        self.fallback = fallback or MemoryBackend()
+        self.retry_seconds = retry_seconds
+        # Circuit breaker: while open, checks go straight to the fallback
+        self.retry_at = 0.0
+        self.down = False
+
+    def hit(self, key, limit, period):
+        if time.monotonic() < self.retry_at:
+            return self.fallback.hit(key, limit, period)
+        interval = math.ceil(period * 1000 / limit)
+        try:
+            allowed, retry_ms = self.script(keys=[f'rate_limit:{key}'], args=[interval, limit])
+        except redis.RedisError as e:
+            self.retry_at = time.monotonic() + self.retry_seconds
+            if not self.down:
+                self.down = True
+                logger.warning("[RATELIMIT] Redis unavailable, limiting in process for now: %s", e)
+            return self.fallback.hit(key, limit, period)
+        if self.down:
+            self.down = False
+            logger.info("[RATELIMIT] Redis is reachable again")
+        return bool(allowed), retry_ms / 1000
+
+def create_backend(storage_url):
+    """Build the backend for a RATELIMIT_STORAGE_URL."""
+    if storage_url.startswith(('redis://', 'rediss://')):
+        return RedisBackend(storage_url)
+    return MemoryBackend()
+
+limiter = create_backend(get_config().RATELIMIT_STORAGE_URL)
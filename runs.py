@@ -0,0 +1,203 @@
+"""Checkpoints and graceful shutdown for send pipeline runs.
+
+Each run is recorded in ``send_runs`` along with the query it streams and a
+keyset cursor. The cursor is the ``(zipcode, id)`` of the last user such that
+every user up to it has a recorded outcome. A run interrupted by a deploy
+(SIGTERM) or a crash is resumed from that cursor by the next process to
+start, or by the dispatcher's next tick. Users past the cursor that the run had already claimed are claimed
+again by the same run, and everything else already sent is rejected by the
+ledger. Nothing is sent twice and nothing is dropped.
+
+The running process refreshes the run's heartbeat on a timer, so a slow
+upstream call doesn't make a live run look stale. Every heartbeat,
+checkpoint, claim batch and finish only applies while the run is still
+running under the same owner. When one of them fails, another process has
+taken the run over, and the old pipeline stops sending.
+
+On SIGTERM, ``shutdown_event`` is set. The pipeline source stops reading
+new users, the sends already in flight drain, and the run is left as
+``interrupted``.
+"""
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+RUN_STALE_SECONDS = int(os.getenv('RUN_STALE_SECONDS', 300))
+RUN_HEARTBEAT_SECONDS = int(os.getenv('RUN_HEARTBEAT_SECONDS', 30))
+RUN_RETENTION_DAYS = int(os.getenv('RUN_RETENTION_DAYS', 7))
+
+RUN_RUNNING = 'running'
+RUN_INTERRUPTED = 'interrupted'
+RUN_COMPLETED = 'completed'
+
+RUNS_SCHEMA_SQL = '''
+CREATE TABLE IF NOT EXISTS send_runs (
+    run_id TEXT PRIMARY KEY,
+    local_date TEXT NOT NULL,
+    where_sql TEXT NOT NULL,
+    params TEXT NOT NULL,
+    cursor_zipcode TEXT,
+    cursor_id INTEGER,
+    status TEXT NOT NULL,
+    owner TEXT,
+    started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_send_runs_date_status ON send_runs (local_date, status);
+'''
+
+# Set when the process is asked to stop; pipeline sources check it per batch
+shutdown_event = threading.Event()
+
+class RunTakenOver(Exception):
+    """Raised when a run is no longer held by the process working on it."""
+
+def ensure_runs(db):
+    """Create the send_runs table if it does not exist yet."""
+    db.executescript(RUNS_SCHEMA_SQL)
+    db.commit()
+
+def begin_run(db, run_id, local_date, where_sql, params, owner, now=None):
+    """Start a run, or take over an interrupted or stale one.
+
+    Returns the cursor to resume after (``None`` to start from the top), or
+    ``False`` when the run is already complete or still alive elsewhere.
+    """
+    now = time.time() if now is None else now
+    cur = db.execute(
+        '''INSERT OR IGNORE INTO send_runs
+           (run_id, local_date, where_sql, params, status, owner, updated_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?)''',
+        [run_id, local_date, where_sql, json.dumps(list(params)), RUN_RUNNING, owner, now]
+    )
+    if cur.rowcount == 1:
+        db.commit()
+        return None
+
+    cur = db.execute(
+        '''UPDATE send_runs SET status = ?, owner = ?, updated_at = ?
+           WHERE run_id = ? AND (status = ? OR (status = ? AND updated_at < ?))''',
+        [RUN_RUNNING, owner, now, run_id, RUN_INTERRUPTED, RUN_RUNNING, now - RUN_STALE_SECONDS]
+    )
+    db.commit()
+    if cur.rowcount != 1:
+        logger.info("[RUNS] Run %s is complete or active elsewhere, skipping", run_id)
+        return False
+
+    row = db.execute(
+        'SELECT cursor_zipcode, cursor_id FROM send_runs WHERE run_id = ?', [run_id]
+    ).fetchone()
+    logger.info("[RUNS] Resuming run %s after user %s", run_id, row[1])
+    return None if row[1] is None else (row[0], row[1])
+
+def hold_run(db, run_id, owner, cursor=None, now=None):
+    """Refresh the heartbeat (and cursor) of a run owner still holds.
+
+    Returns False when the run was interrupted or taken over. Doesn't
+    commit, so callers can make further writes depend on the result.
+    """
+    now = time.time() if now is None else now
+    if cursor is None:
+        cur = db.execute(
+            'UPDATE send_runs SET updated_at = ? WHERE run_id = ? AND owner IS ? AND status = ?',
+            [now, run_id, owner, RUN_RUNNING]
+        )
+    else:
+        cur = db.execute(
+            '''UPDATE send_runs SET cursor_zipcode = ?, cursor_id = ?, updated_at = ?
+               WHERE run_id = ? AND owner IS ? AND status = ?''',
+            [cursor[0], cursor[1], now, run_id, owner, RUN_RUNNING]
+        )
+    return cur.rowcount == 1
+
+def checkpoint_run(db, run_id, owner, cursor, now=None):
+    """Record progress (and a heartbeat); False if owner lost the run."""
+    held = hold_run(db, run_id, owner, cursor, now)
+    db.commit()
+    return held
+
+def finish_run(db, run_id, owner, status, now=None):
+    """Mark a run completed, or interrupted so another process resumes it.
+
+    Returns False, changing nothing, when owner no longer holds the run.
+    Completed runs older than ``RUN_RETENTION_DAYS`` are deleted on the way.
+    """
+    now = time.time() if now is None else now
+    cur = db.execute(
+        'UPDATE send_runs SET status = ?, updated_at = ? WHERE run_id = ? AND owner IS ?',
+        [status, now, run_id, owner]
+    )
+    if cur.rowcount != 1:
+        db.commit()
+        logger.warning("[RUNS] Run %s was taken over, not marking it %s", run_id, status)
+        return False
+    if status == RUN_COMPLETED:
+        db.execute(
+            'DELETE FROM send_runs WHERE status = ? AND updated_at < ?',
+            [RUN_COMPLETED, now - RUN_RETENTION_DAYS * 86400]
+        )
+    db.commit()
+    logger.info("[RUNS] Run %s %s", run_id, status)
+    return True
+
+def owner_alive(owner):
+    """False when owner is a host:pid on this host whose process has exited.
+
+    Owners on other hosts can't be checked and count as alive until their
+    run goes stale.
+    """
+    host, _, pid = (owner or '').rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def resumable_runs(db, local_date, now=None):
+    """List today's runs that were interrupted or whose owner stopped.
+
+    A running run counts as stopped when its heartbeat is stale, or at once
+    when its owner was a process on this host that no longer exists. That
+    way a crash followed by a quick restart doesn't wait out the timeout.
+    Such runs are marked interrupted, which lets begin_run take them over.
+    """
+    now = time.time() if now is None else now
+    rows = db.execute(
+        '''SELECT run_id, where_sql, params, status, owner, updated_at FROM send_runs
+           WHERE local_date = ? AND status IN (?, ?)''',
+        [local_date, RUN_INTERRUPTED, RUN_RUNNING]
+    ).fetchall()
+    runs = []
+    for run_id, where_sql, params, status, owner, updated_at in rows:
+        if status == RUN_RUNNING:
+            if updated_at >= now - RUN_STALE_SECONDS and owner_alive(owner):
+                continue
+            # Only the first process to notice gets to flip it
+            if db.execute(
+                'UPDATE send_runs SET status = ? WHERE run_id = ? AND status = ? AND owner IS ?',
+                [RUN_INTERRUPTED, run_id, RUN_RUNNING, owner]
+            ).rowcount != 1:
+                continue
+            db.commit()
+        runs.append((run_id, where_sql, json.loads(params)))
+    return runs
+
+def install_shutdown_handler(on_shutdown=None):
+    """Drain in-flight sends on SIGTERM before the process exits."""
+    def handle_sigterm(signum, frame):
+        logger.info("[RUNS] SIGTERM received, draining in-flight sends")
+        shutdown_event.set()
+        if on_shutdown:
+            on_shutdown()
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
@@ -1,9 +1,13 @@
 from apscheduler.schedulers.blocking import BlockingScheduler
-from app import send_daily_weather_update
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED, EVENT_SCHEDULER_STARTED
+from app import create_job_store, migrate_db, release_shard_leases, schedule_resume, DISPATCH_FUNC_REF
+from dispatcher import reconcile_jobs
+from runs import install_shutdown_handler
+from monitoring import start_metrics_server
+from logconfig import configure_logging
 from pytz import timezone, utc
 import logging
 from datetime import datetime, timedelta
-from dateutil import parser
 from sqlalchemy import create_engine, Column, Integer, String, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
@@ -20,61 +24,63 @@ import logging
 import os
 
 # Configure detailed logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 def log_job_status(event):
     """Log job execution status."""
     if event.exception:
-        logger.error(f'[JOB] Failed: {event.job_id}')
-        logger.error(f'[JOB] Exception: {event.exception}')
-        logger.error(f'[JOB] Traceback: {event.traceback}')
+        logger.error("[JOB] Failed: %s", event.job_id)
+        logger.error("[JOB] Exception: %s", event.exception)
+        logger.error("[JOB] Traceback: %s", event.traceback)
     else:
-        logger.info(f'[JOB] Completed: {event.job_id}')
-        logger.info(f'[JOB] Next run: {event.job.next_run_time}')
+        logger.info("[JOB] Completed: %s", event.job_id)
+        job = scheduler.get_job(event.job_id)
+        if job:
+            logger.info("[JOB] Next run: %s", job.next_run_time)
+
+def reconcile_on_start(event):
+    """Reconcile persisted jobs once start() has loaded the job store."""
+    reconcile_jobs(scheduler, DISPATCH_FUNC_REF)
+    schedule_resume(scheduler)
+    logger.info("[WORKER] Currently scheduled jobs:")
+    scheduler.print_jobs()
 
 # Initialize scheduler
-scheduler = BlockingScheduler(timezone=timezone('America/Chicago'))
-scheduler.add_listener(log_job_status)
+scheduler = BlockingScheduler(
+    jobstores={'default': create_job_store('apscheduler_jobs_worker')},
+    timezone=timezone('America/Chicago')
+)
+scheduler.add_listener(log_job_status, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+scheduler.add_listener(reconcile_on_start, EVENT_SCHEDULER_STARTED)
 
 if __name__ == "__main__":
     logger.info("[WORKER] Starting scheduler process")
-    logger.info(f"[WORKER] Process ID: {os.getpid()}")
+    logger.info("[WORKER] Process ID: %s", os.getpid())
     
     try:
-        # Start the scheduler first
-        scheduler.start()
+        migrate_db()
+        
+        # Job and upstream metrics; in multiprocess mode the web /metrics
+        # already includes them, this is for scraping the worker directly
+        if os.getenv('METRICS_PORT'):
+            start_metrics_server(int(os.getenv('METRICS_PORT')))
         
-        # Add the daily update job
-        job = scheduler.add_job(
-            func=send_daily_weather_update,
-            trigger='cron',
-            hour=7,
-            minute=30,
-            id='daily_weather_job',
-            name='Daily Weather Update',
-            replace_existing=True
-        )
-        logger.info(f"[WORKER] Daily job scheduled: {job}")
-        logger.info(f"[WORKER] Next run time: {job.next_run_time}")
+        # On SIGTERM stop reading users, let in-flight sends finish and
+        # leave the run checkpointed for whichever process starts next
+        install_shutdown_handler(lambda: scheduler.shutdown(wait=True))
         
-        # Add test job to verify setup
-        test_job = scheduler.add_job(
-            func=send_daily_weather_update,
-            trigger='date',
-            run_date=datetime.now() + timedelta(minutes=1),
-            id='startup_test_job'
-        )
-        logger.info(f"[WORKER] Test job scheduled for: {test_job.next_run_time}")
+        # Sends go through the minute dispatcher and the daily_sends ledger,
+        # so the web process and this worker can't text a user twice a day.
+        # The dispatcher job itself is persisted and reconciled on start.
+        # Each tick only sends to the shards this worker holds a lease on.
+        scheduler.start()
         
-        # Log all scheduled jobs
-        logger.info("[WORKER] Currently scheduled jobs:")
-        scheduler.print_jobs()
+        # start() returns on shutdown; let the other workers take over now
+        # instead of waiting for the leases to expire
+        release_shard_leases()
         
     except Exception as e:
-        logger.error(f"[WORKER] Startup error: {e}")
+        logger.error("[WORKER] Startup error: %s", e)
         logger.exception("[WORKER] Full exception details:")
         raise
\ No newline at end of file
@@ -1,5 +1,7 @@
 DROP TABLE IF EXISTS users;
 DROP TABLE IF EXISTS user_preferences;
+DROP TABLE IF EXISTS daily_sends;
+DROP TABLE IF EXISTS send_runs;
 
 CREATE TABLE IF NOT EXISTS users (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -9,16 +11,35 @@ CREATE TABLE IF NOT EXISTS users (
     latitude REAL,
     longitude REAL,
     preferred_time TEXT DEFAULT '07:30',
+    send_minute INTEGER DEFAULT 450,
     weather_notification_temp INTEGER DEFAULT 32,
     weather_notification_condition TEXT DEFAULT 'Snow',
-    temperature_sensitivity TEXT DEFAULT 'Normal'
+    temperature_sensitivity TEXT DEFAULT 'Normal',
+    temperature_unit TEXT DEFAULT 'F'
 );
+CREATE INDEX IF NOT EXISTS idx_users_send_minute ON users (send_minute, id);
+CREATE INDEX IF NOT EXISTS idx_users_zipcode ON users (zipcode, id);
 
-CREATE TABLE user_preferences (
-    user_id INTEGER PRIMARY KEY,
-    temperature_unit TEXT DEFAULT 'F',
-    temperature_sensitivity TEXT DEFAULT 'Normal',
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+CREATE TABLE IF NOT EXISTS daily_sends (
+    user_id INTEGER NOT NULL,
+    local_date TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'claimed',
+    run_id TEXT,
+    claimed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (user_id) REFERENCES users(id)
-);
\ No newline at end of file
+    PRIMARY KEY (user_id, local_date)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS send_runs (
+    run_id TEXT PRIMARY KEY,
+    local_date TEXT NOT NULL,
+    where_sql TEXT NOT NULL,
+    params TEXT NOT NULL,
+    cursor_zipcode TEXT,
+    cursor_id INTEGER,
+    status TEXT NOT NULL,
+    owner TEXT,
+    started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_send_runs_date_status ON send_runs (local_date, status);
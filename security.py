@@ -3,9 +3,14 @@ from functools import wraps
 from flask import request, abort, session, redirect, url_for
 import bleach
 from wtforms.validators import ValidationError
-from datetime import datetime, timedelta
+from datetime import datetime
+import math
+import os
+import time
 import redis
 import secrets
+from ratelimit import limiter
+from bruteforce import failed_logins
 
 def sanitize_input(text):
     """Sanitize input text to prevent XSS attacks"""
@@ -75,28 +80,20 @@ def get_remote_addr():
         return request.headers.get('X-Forwarded-For').split(',')[0].strip()
     return request.remote_addr
 
-def rate_limit_by_ip(limit=None, period=None):
+def rate_limit_by_ip(limit=None, period=None, methods=None):
+    """Allow ``limit`` requests per ``period`` seconds from each client IP.
+
+    With ``methods`` only those request methods count, e.g. ('POST',).
+    """
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            if not limit or not period:
+            if not limit or not period or (methods and request.method not in methods):
                 return f(*args, **kwargs)
 
-            ip = get_remote_addr()
-            key = f'rate_limit:{ip}:{f.__name__}'
-            try:
-                redis_client = redis.from_url('redis://localhost:6379/0')
-                current = int(redis_client.get(key) or 0)
-                
-                if current >= limit:
-                    return 'Too many requests', 429
-                
-                pipe = redis_client.pipeline()
-                pipe.incr(key)
-                pipe.expire(key, period)
-                pipe.execute()
-            except Exception as e:
-                print(f"Rate limiting error: {e}")
+            allowed, retry_after = limiter.hit(f'{get_remote_addr()}:{f.__name__}', limit, period)
+            if not allowed:
+                return 'Too many requests', 429, {'Retry-After': str(math.ceil(retry_after))}
 
             return f(*args, **kwargs)
         return decorated_function
@@ -122,6 +119,9 @@ def init_session():
     if 'csrf_token' not in session:
         session['csrf_token'] = secrets.token_hex(32)
 
+SESSION_IDLE_TIMEOUT = int(os.getenv('SESSION_IDLE_TIMEOUT', 24 * 3600))
+SESSION_ACTIVITY_GRANULARITY = int(os.getenv('SESSION_ACTIVITY_GRANULARITY', 300))
+
 class SecurityManager:
     def __init__(self, app=None):
         self.app = app
@@ -132,17 +132,24 @@ class SecurityManager:
     def init_app(self, app):
         self.app = app
         self.redis_client = redis.from_url(app.config.get('REDIS_URL', 'redis://localhost:6379/0'))
+        # The throttled last_active write below keeps the cookie fresh
+        app.config['SESSION_REFRESH_EACH_REQUEST'] = False
         
         @app.before_request
         def check_session_expiry():
             if 'user_id' in session:
+                now = int(time.time())
                 last_active = session.get('last_active')
-                if last_active:
-                    last_active = datetime.fromisoformat(last_active)
-                    if datetime.now() - last_active > timedelta(hours=24):
-                        session.clear()
-                        return redirect(url_for('login'))
-                session['last_active'] = datetime.now().isoformat()
+                if isinstance(last_active, str):
+                    # Sessions from before last_active was stored as epoch seconds
+                    last_active = int(datetime.fromisoformat(last_active).timestamp())
+                if last_active and now - last_active > SESSION_IDLE_TIMEOUT:
+                    session.clear()
+                    return redirect(url_for('login'))
+                # Writing the session re-signs and re-sends the cookie, so only
+                # do it once the stored time is more than the granularity old
+                if not last_active or now - last_active >= SESSION_ACTIVITY_GRANULARITY:
+                    session['last_active'] = now
 
     def require_login(self, f):
         @wraps(f)
@@ -153,28 +160,13 @@ class SecurityManager:
         return decorated_function
 
     def track_failed_login(self, username, ip):
-        key = f"failed_login:{username}:{ip}"
-        try:
-            attempts = self.redis_client.incr(key)
-            self.redis_client.expire(key, 3600)
-            return attempts
-        except:
-            return 0
+        return failed_logins.record_failure(username, ip)
 
     def check_brute_force(self, username, ip):
-        key = f"failed_login:{username}:{ip}"
-        try:
-            attempts = int(self.redis_client.get(key) or 0)
-            return attempts >= 5
-        except:
-            return False
+        return failed_logins.is_blocked(username, ip)
 
     def clear_failed_attempts(self, username, ip):
-        key = f"failed_login:{username}:{ip}"
-        try:
-            self.redis_client.delete(key)
-        except:
-            pass
+        failed_logins.clear(username, ip)
 
     def generate_reset_token(self, user_id):
         token = secrets.token_urlsafe(32)
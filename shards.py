@@ -0,0 +1,127 @@
+"""Lease-based shard ownership for the daily send.
+
+Users are partitioned into ``SEND_SHARD_COUNT`` shards by ``id % count``.
+Every process that runs the dispatcher (the web app and any number of
+``scheduler.py`` workers) renews its leases in the ``shard_leases`` table on
+each tick and only sends to users in the shards it holds. Leases expire
+after ``SHARD_LEASE_SECONDS``, so the shards of a crashed worker are picked
+up by the others, and the daily_sends ledger keeps the takeover from
+texting anyone twice.
+"""
+import logging
+import math
+import os
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+SEND_SHARD_COUNT = int(os.getenv('SEND_SHARD_COUNT', 16))
+SHARD_LEASE_SECONDS = int(os.getenv('SHARD_LEASE_SECONDS', 150))
+
+SHARD_SCHEMA_SQL = '''
+CREATE TABLE IF NOT EXISTS shard_leases (
+    shard INTEGER PRIMARY KEY,
+    owner TEXT,
+    expires_at REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS shard_workers (
+    owner TEXT PRIMARY KEY,
+    expires_at REAL NOT NULL
+);
+'''
+
+def ensure_shards(db, shard_count=SEND_SHARD_COUNT):
+    """Create the lease table and one row per shard."""
+    db.executescript(SHARD_SCHEMA_SQL)
+    db.executemany(
+        'INSERT OR IGNORE INTO shard_leases (shard) VALUES (?)',
+        [(shard,) for shard in range(shard_count)]
+    )
+    db.execute('DELETE FROM shard_leases WHERE shard >= ?', [shard_count])
+    db.commit()
+
+def shard_filter_sql(shards, shard_count=SEND_SHARD_COUNT, column='id'):
+    """Return a SQL condition and params limiting rows to the given shards."""
+    shards = sorted(shards)
+    placeholders = ','.join('?' * len(shards))
+    return f'({column} % ?) IN ({placeholders})', [shard_count] + shards
+
+class ShardLeaseManager:
+    """Claims, renews and releases this process's share of the shards."""
+
+    def __init__(self, shard_count=SEND_SHARD_COUNT, lease_seconds=SHARD_LEASE_SECONDS, owner=None):
+        self.shard_count = shard_count
+        self.lease_seconds = lease_seconds
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}'
+        self.owned = frozenset()
+
+    def renew(self, db, now=None):
+        """Renew held leases and claim or shed shards to reach a fair share.
+
+        Runs in one IMMEDIATE transaction so concurrent workers see each
+        other's claims. Returns the set of shards this process now owns.
+        """
+        now = time.time() if now is None else now
+        expires_at = now + self.lease_seconds
+
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # Heartbeat first, so workers without shards still count as live
+            db.execute(
+                'INSERT OR REPLACE INTO shard_workers (owner, expires_at) VALUES (?, ?)',
+                [self.owner, expires_at]
+            )
+            db.execute('DELETE FROM shard_workers WHERE expires_at <= ?', [now])
+            db.execute(
+                'UPDATE shard_leases SET expires_at = ? WHERE owner = ?',
+                [expires_at, self.owner]
+            )
+            owned = {row[0] for row in db.execute(
+                'SELECT shard FROM shard_leases WHERE owner = ?', [self.owner]
+            )}
+            live_workers = db.execute('SELECT COUNT(*) FROM shard_workers').fetchone()[0]
+            fair_share = math.ceil(self.shard_count / max(live_workers, 1))
+
+            if len(owned) < fair_share:
+                free = [row[0] for row in db.execute(
+                    '''SELECT shard FROM shard_leases
+                       WHERE owner IS NULL OR expires_at <= ?
+                       ORDER BY shard LIMIT ?''',
+                    [now, fair_share - len(owned)]
+                )]
+                db.executemany(
+                    'UPDATE shard_leases SET owner = ?, expires_at = ? WHERE shard = ?',
+                    [(self.owner, expires_at, shard) for shard in free]
+                )
+                owned.update(free)
+            elif len(owned) > fair_share:
+                # Hand surplus shards back so a newly started worker can take them
+                surplus = sorted(owned)[fair_share:]
+                self._release(db, surplus)
+                owned.difference_update(surplus)
+
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+        if owned != self.owned:
+            logger.info("[SHARDS] %s now owns %s/%s shards: %s",
+                        self.owner, len(owned), self.shard_count, sorted(owned))
+        self.owned = frozenset(owned)
+        return self.owned
+
+    def release(self, db):
+        """Give up every lease held by this process, e.g. on shutdown."""
+        self._release(db, self.owned)
+        db.execute('DELETE FROM shard_workers WHERE owner = ?', [self.owner])
+        db.commit()
+        logger.info("[SHARDS] %s released %s shards", self.owner, len(self.owned))
+        self.owned = frozenset()
+
+    def _release(self, db, shards):
+        db.executemany(
+            'UPDATE shard_leases SET owner = NULL, expires_at = 0 WHERE shard = ? AND owner = ?',
+            [(shard, self.owner) for shard in shards]
+        )
@@ -0,0 +1,103 @@
+"""Dry-run simulation of the daily send for capacity planning.
+
+The whole send pipeline runs against stand-in providers that return
+deterministic weather and never text anyone. The ledger is left untouched.
+The pipeline report is extended with a projection of how long the real run
+would take for the current user base, given typical upstream latencies.
+
+Run it with ``python simulation.py`` or through ``/simulate-daily-run``.
+"""
+import json
+import os
+import threading
+import time
+import zlib
+
+# Typical per-call latencies in seconds, used for the projection and, when
+# requested, to make the stand-in providers sleep like the real ones
+UPSTREAM_LATENCY = {
+    'weather': float(os.getenv('SIMULATED_WEATHER_LATENCY', 0.25)),
+    'recommend': float(os.getenv('SIMULATED_OPENAI_LATENCY', 0.8)),
+    'send': float(os.getenv('SIMULATED_TWILIO_LATENCY', 0.4)),
+}
+
+CONDITIONS = ('Clear', 'Clouds', 'Rain', 'Snow')
+
+class SimulatedProviders:
+    """Stand-ins for OpenWeatherMap, OpenAI and Twilio.
+
+    Weather is derived from the zipcode so that grouping and recommendation
+    caching behave as they would with real data.
+    """
+
+    def __init__(self, latency=None, sleep=False):
+        self.latency = dict(UPSTREAM_LATENCY, **(latency or {}))
+        self.sleep = sleep
+        self.calls = {'weather': 0, 'recommend': 0, 'send': 0}
+        self.lock = threading.Lock()
+
+    def _call(self, name):
+        with self.lock:
+            self.calls[name] += 1
+        if self.sleep:
+            time.sleep(self.latency[name])
+
+    def weather(self, zipcode):
+        self._call('weather')
+        seed = zlib.crc32(str(zipcode).encode())
+        return {
+            'main': {'temp': 10 + seed % 70, 'humidity': 40 + seed % 50},
+            'wind': {'speed': seed % 20},
+            'weather': [{'main': CONDITIONS[seed % len(CONDITIONS)], 'icon': '01d'}]
+        }
+
+    def recommend(self, temperature_f, wind_speed, condition):
+        self._call('recommend')
+        return f"[dry run] {temperature_f}°F, {condition}, {wind_speed} mph"
+
+    def send(self, phone_number, body):
+        self._call('send')
+        return True
+
+def project_run(report, latency=None):
+    """Estimate the wall-clock time of the real run from a dry-run report.
+
+    Stages overlap, so the run takes about as long as its slowest stage
+    (calls x latency / workers), plus one pass through every stage before
+    the first message goes out.
+    """
+    latency = dict(UPSTREAM_LATENCY, **(latency or {}))
+    counters = report['counters']
+    workers = {stage['stage']: stage['workers'] for stage in report['stages']}
+    calls = {
+        'weather': counters['weather_calls'],
+        'recommend': counters['recommendation_calls'],
+        'send': counters['sms_calls'],
+    }
+    stage_seconds = {
+        name: calls[name] * latency[name] / workers.get(name, 1)
+        for name in calls
+    }
+    bottleneck = max(stage_seconds, key=stage_seconds.get)
+    fill_seconds = sum(latency[name] for name in calls if calls[name])
+    return {
+        'assumed_latency_seconds': latency,
+        'stage_seconds': {name: round(value, 2) for name, value in stage_seconds.items()},
+        'bottleneck_stage': bottleneck,
+        'projected_wall_seconds': round(stage_seconds[bottleneck] + fill_seconds, 2)
+    }
+
+def simulate_daily_run(pipeline_factory, db, where='1', params=(), latency=None, sleep=False):
+    """Run the pipeline built by ``pipeline_factory(providers)`` as a dry run."""
+    providers = SimulatedProviders(latency, sleep)
+    report = pipeline_factory(providers).run(db, where, params)
+    report['dry_run'] = True
+    report['upstream_calls'] = dict(providers.calls)
+    report['projection'] = project_run(report, latency)
+    return report
+
+if __name__ == '__main__':
+    from app import app, send_daily_weather_update
+
+    with app.app_context():
+        print(json.dumps(send_daily_weather_update(dry_run=True), indent=2))
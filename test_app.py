@@ -1,8 +1,42 @@
+import io
+import json
 import os
+import threading
+import time
 import tempfile
+import zipfile
 import pytest
-from app import app, init_db
+import socket
+import subprocess
+import sys
+import sqlite3
+import pytz
+from datetime import datetime
+from app import app, init_db, get_db, connect_db, dispatch_due_users
+from dispatcher import due_users, migrate_send_minute, reschedule_user
+from ledger import claim_daily_send, claim_daily_sends, mark_daily_sends, release_daily_send
+from shards import ShardLeaseManager
+from pipeline import SendPipeline
+from users import find_user_by_phone, get_profile, get_user, update_contact, _identity_map
+import geocode
+import bulk
+from preferences import migrate_preferences
+from passwords import PasswordHasher, PasswordHasherBusy
+from werkzeug.security import generate_password_hash
+from ratelimit import MemoryBackend, RedisBackend, parse_rate
+import redis
+from bruteforce import FailedLoginTracker
+from catchup import dispatch_window, mark_dispatched
+from runs import begin_run, checkpoint_run, finish_run, resumable_runs, RUN_INTERRUPTED, RUN_RUNNING, RUN_STALE_SECONDS
 from security import validate_password_strength, sanitize_input
+from monitoring import LatencyHistogram, track_api_request
+from prometheus_client import REGISTRY
+import logging
+import queue
+from logconfig import DroppingQueueHandler, SamplingFilter, parse_levels
+import tracing
+from tracing import Trace, wants_server_timing
+from flask import g
 
 @pytest.fixture
 def client():
@@ -102,5 +136,570 @@ def test_rate_limiting(client):
         })
     assert rv.status_code == 429  # Too Many Requests
 
+def test_memory_rate_limiter_refills():
+    """Token buckets allow a burst, then refuse until tokens refill."""
+    backend = MemoryBackend(shards=4)
+    assert parse_rate('5 per minute') == (5, 60)
+    assert all(backend.hit('1.2.3.4:login', 5, 60)[0] for _ in range(5))
+    allowed, retry_after = backend.hit('1.2.3.4:login', 5, 60)
+    assert not allowed and 0 < retry_after <= 12
+    assert backend.hit('5.6.7.8:login', 5, 60)[0]
+
+def test_failed_logins_block_locally_and_decay():
+    """Failures block after the threshold without Redis and fade with the half-life."""
+    tracker = FailedLoginTracker(threshold=3, half_life=60)
+    for _ in range(3):
+        tracker.record_failure('+15550000000', '1.2.3.4')
+    assert tracker.is_blocked('+15550000000', '1.2.3.4')
+    assert not tracker.is_blocked('+15550000000', '5.6.7.8')
+    key = tracker._key('+15550000000', '1.2.3.4')
+    score, updated = tracker.counts[key]
+    tracker.counts[key] = (score, updated - 60)
+    assert not tracker.is_blocked('+15550000000', '1.2.3.4')
+    tracker.clear('+15550000000', '1.2.3.4')
+    assert not tracker.counts
+
+def test_session_activity_written_once_per_granularity(client):
+    """Authenticated polls only re-send the session cookie when last_active is stale."""
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+    first = client.get('/api/preferences')
+    assert 'Set-Cookie' in first.headers
+    second = client.get('/api/preferences')
+    assert 'Set-Cookie' not in second.headers
+
+def test_dispatcher_due_users(client):
+    """Legacy preferred_time strings are migrated and matched by minute."""
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO users (phone_number, password, preferred_time, send_minute) VALUES (?, ?, ?, NULL)',
+            [('+11111111111', 'x', '08:00 AM'), ('+12222222222', 'x', '08:00'),
+             ('+13333333333', 'x', '07:30')]
+        )
+        db.commit()
+        assert migrate_send_minute(db) == 3
+        due = due_users(db, datetime(2026, 1, 5, 8, 0))
+        assert sorted(user['phone_number'] for user in due) == ['+11111111111', '+12222222222']
+
+def test_reschedule_user(client):
+    """Rescheduling moves only that user to the new minute."""
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO users (phone_number, password) VALUES ('+11111111111', 'x')")
+        db.commit()
+        reschedule_user(db, 1, 6 * 60 + 15)
+        user = db.execute('SELECT preferred_time, send_minute FROM users WHERE id = 1').fetchone()
+        assert (user['preferred_time'], user['send_minute']) == ('06:15', 375)
+        assert [row['id'] for row in due_users(db, datetime(2026, 1, 5, 6, 15))] == [1]
+
+def test_daily_send_claimed_once(client):
+    """A user's daily send can only be claimed once per local date."""
+    with app.app_context():
+        db = get_db()
+        assert claim_daily_send(db, 1, '2026-01-05')
+        assert not claim_daily_send(db, 1, '2026-01-05')
+        assert claim_daily_send(db, 1, '2026-01-06')
+        release_daily_send(db, 1, '2026-01-05')
+        assert claim_daily_send(db, 1, '2026-01-05')
+
+def test_db_pool_reuses_tuned_connections(client):
+    """Connections run in WAL mode and go back to the pool after each context."""
+    with app.app_context():
+        first = get_db()
+        assert first.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        first.execute("INSERT INTO users (phone_number, password) VALUES ('+15550000000', 'x')")
+    with app.app_context():
+        db = get_db()
+        assert db is first
+        # Uncommitted work is rolled back before a connection is reused
+        assert db.execute('SELECT COUNT(*) FROM users').fetchone()[0] == 0
+
+def test_user_repository_projects_and_caches(client):
+    """Profile reads skip the password hash and hit the database once per request."""
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO users (phone_number, password, zipcode) VALUES ('+15550000000', 'hash', '53717')")
+        db.commit()
+    with app.test_request_context():
+        user = get_user(1)
+        assert user['zipcode'] == '53717' and 'password' not in user
+        assert get_user(1, view='location') is user
+        assert find_user_by_phone('+15550000000')['password'] == 'hash'
+        assert 'password' not in get_user(1)
+
+def test_profile_cache_survives_requests_until_written(client):
+    """Profiles are served from the cache until the user changes them."""
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO users (phone_number, password, zipcode) VALUES ('+15550000000', 'x', '53717')")
+        db.commit()
+    with app.test_request_context():
+        assert get_profile(1)['zipcode'] == '53717'
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE users SET zipcode = '60601' WHERE id = 1")
+        db.commit()
+    with app.test_request_context():
+        assert get_profile(1)['zipcode'] == '53717'
+        update_contact(1, '10001', '+15550000000')
+    with app.test_request_context():
+        assert get_profile(1)['zipcode'] == '10001'
+
+def test_zip_index_lookup_and_backfill(client, tmp_path, monkeypatch):
+    """ZIPs resolve from the local index, and users without coordinates get them."""
+    path = str(tmp_path / 'zips.bin')
+    assert geocode.write_zip_index([('60601', 41.8858, -87.6181), ('53717', 43.0735, -89.5183)], path) == 2
+    index = geocode.ZipIndex(path)
+    assert index.lookup('53717-1234') == pytest.approx((43.0735, -89.5183), abs=1e-4)
+    assert index.lookup('99999') is None
+    monkeypatch.setattr(geocode, '_index', index)
+    monkeypatch.setattr(geocode, '_index_loaded', True)
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO users (phone_number, password, zipcode) VALUES ('+15550000000', 'x', '60601')")
+        db.commit()
+        assert geocode.backfill_coordinates(db) == 1
+        assert db.execute('SELECT latitude FROM users').fetchone()[0] == pytest.approx(41.8858, abs=1e-4)
+
+def test_nominatim_fallback_caches_only_successes(tmp_path, monkeypatch):
+    """Requests never reach Nominatim, and a failed lookup is retried later."""
+    archive = tmp_path / 'gaz.zip'
+    with zipfile.ZipFile(archive, 'w') as z:
+        z.writestr('gaz.txt', 'GEOID\tALAND\tINTPTLAT\tINTPTLONG   \n53717\t1\t43.07\t-89.51\n')
+    assert list(geocode.read_gazetteer(str(archive))) == [('53717', '43.07', '-89.51')]
+
+    calls = []
+    class Location:
+        latitude, longitude = 41.88, -87.62
+    def lookup(zipcode):
+        calls.append(zipcode)
+        if len(calls) == 1:
+            raise TimeoutError('nominatim timed out')
+        return Location()
+    monkeypatch.setattr(geocode, '_nominatim_geocode', lookup)
+    monkeypatch.setattr(geocode, '_index', None)
+    monkeypatch.setattr(geocode, '_index_loaded', True)
+    geocode._nominatim.cache_clear()
+
+    assert geocode.geocode_zip('60601') == (None, None) and calls == []
+    assert geocode.geocode_zip('60601', fallback=True) == (None, None)
+    assert geocode.geocode_zip('60601', fallback=True) == (41.88, -87.62)
+    assert geocode.geocode_zip('60601', fallback=True) == (41.88, -87.62)
+    assert len(calls) == 2
+
+def test_bulk_import_and_export_round_trip(client):
+    """Imports skip duplicates and bad rows; exports stream back what was loaded."""
+    rows = [
+        {'phone': '608-555-0101', 'password': 'secret1', 'zipcode': '53717', 'preferred_time': '06:45',
+         'temperature_unit': 'C'},
+        {'phone': '(608) 555-0102', 'password': 'secret2'},
+        {'phone': '608-555-0101', 'password': 'again'},
+        {'phone': '12345', 'password': 'bad'},
+        {'phone': '608-555-0103', 'password': 'secret3', 'temperature_unit': 'K'},
+    ]
+    with app.app_context():
+        db = get_db()
+        summary = bulk.import_users(db, enumerate(rows, 1), batch_size=2, workers=2)
+        assert (summary['imported'], summary['duplicates'], summary['invalid']) == (2, 1, 2)
+
+        out = io.StringIO()
+        assert bulk.export_users(db, out, 'jsonl') == 2
+        first, second = [json.loads(line) for line in out.getvalue().splitlines()]
+        assert first['phone_number'] == '+16085550101' and first['preferred_time'] == '06:45'
+        assert (first['temperature_unit'], second['temperature_unit']) == ('C', 'F')
+        assert 'password_hash' not in first
+
+        # A full export imports back with every user's unit intact
+        out = io.StringIO()
+        bulk.export_users(db, out, 'jsonl', include_password_hash=True)
+        db.execute('DELETE FROM users')
+        db.commit()
+        out.seek(0)
+        assert bulk.import_users(db, bulk.read_rows(out, 'jsonl'), workers=1)['imported'] == 2
+        units = db.execute('SELECT temperature_unit FROM users ORDER BY phone_number').fetchall()
+        assert [unit for unit, in units] == ['C', 'F']
+
+def test_bulk_import_skips_malformed_jsonl_lines(client):
+    """A line that isn't a JSON object is counted invalid and the import carries on."""
+    lines = io.StringIO(
+        '{"phone": "608-555-0201", "password": "secret1"}\n'
+        'not json\n'
+        '[1, 2]\n'
+        '{"phone": "608-555-0202", "password": "secret2"}\n'
+    )
+    with app.app_context():
+        summary = bulk.import_users(get_db(), bulk.read_rows(lines, 'jsonl'), workers=1)
+        assert (summary['read'], summary['imported'], summary['invalid']) == (4, 2, 2)
+
+def test_preferences_migrate_onto_users(client):
+    """Legacy user_preferences rows move onto users and are served by the API."""
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO users (phone_number, password) VALUES ('+15550000000', 'x')")
+        db.execute("CREATE TABLE user_preferences (user_id INTEGER PRIMARY KEY, temperature_unit TEXT, temperature_sensitivity TEXT)")
+        db.execute("INSERT INTO user_preferences VALUES (1, 'C', 'Cold')")
+        db.commit()
+        migrate_preferences(db)
+        assert db.execute("SELECT name FROM sqlite_master WHERE name = 'user_preferences'").fetchone() is None
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+    assert client.get('/api/preferences').get_json() == {'temperature_unit': 'C', 'temperature_sensitivity': 'Cold'}
+    assert client.post('/api/preferences', json={'temperature_unit': 'F'}).status_code == 200
+    assert client.get('/api/preferences').get_json()['temperature_unit'] == 'F'
+
+def test_password_hasher_rehashes_and_sheds_load():
+    """Old parameters are flagged for rehash, and a full queue rejects new work."""
+    hasher = PasswordHasher('pbkdf2:sha256:1000', workers=1, queue_size=0)
+    old_hash = hasher._run(generate_password_hash, 'secret', 'pbkdf2:sha256:500')
+    assert hasher.verify(old_hash, 'secret') and hasher.needs_rehash(old_hash)
+    assert not hasher.needs_rehash(hasher.hash('secret'))
+
+    release = threading.Event()
+    blocker = threading.Thread(target=hasher._run, args=(release.wait,))
+    blocker.start()
+    time.sleep(0.05)
+    with pytest.raises(PasswordHasherBusy):
+        hasher.hash('secret')
+    release.set()
+    blocker.join()
+
+def test_shard_leases_split_due_users(client):
+    """Two workers split the shards and together cover every due user."""
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO users (phone_number, password) VALUES (?, ?)',
+            [(f'+1555000000{i}', 'x') for i in range(8)]
+        )
+        db.commit()
+        first = ShardLeaseManager(owner='worker-a')
+        second = ShardLeaseManager(owner='worker-b')
+        first.renew(db, now=0)
+        second.renew(db, now=1)
+        first.renew(db, now=2)
+        second.renew(db, now=3)
+        assert first.owned and second.owned and not first.owned & second.owned
+        due_at = datetime(2026, 1, 5, 7, 30)
+        ids = [row['id'] for row in due_users(db, due_at, first.owned)]
+        ids += [row['id'] for row in due_users(db, due_at, second.owned)]
+        assert sorted(ids) == list(range(1, 9))
+
+def test_catchup_covers_missed_minutes(client):
+    """A tick after an outage selects every minute since the last dispatch."""
+    tz = pytz.timezone('America/Chicago')
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO users (phone_number, password, send_minute) VALUES (?, ?, ?)',
+            [('+15550000001', 'x', 6 * 60), ('+15550000002', 'x', 7 * 60 + 10), ('+15550000003', 'x', 7 * 60 + 30)]
+        )
+        db.commit()
+        leases = ShardLeaseManager(shard_count=4, owner='worker')
+        shards = leases.renew(db)
+        mark_dispatched(db, shards, tz.localize(datetime(2026, 1, 5, 7, 0)), 'worker')
+
+        now = tz.localize(datetime(2026, 1, 5, 7, 30))
+        first_minute = dispatch_window(db, shards, now)
+        assert first_minute == 7 * 60 + 1
+        ids = [row['id'] for row in due_users(db, now, shards, 4, first_minute)]
+        assert sorted(ids) == [2, 3]
+
+        mark_dispatched(db, shards, now, 'worker')
+        assert dispatch_window(db, shards, now) is None
+
+class FakeProviders:
+    def __init__(self):
+        self.sent = []
+
+    def weather(self, zipcode):
+        return {'main': {'temp': 40.2}, 'wind': {'speed': 5.4}, 'weather': [{'main': 'Clouds'}]}
+
+    def recommend(self, temperature_f, wind_speed, condition):
+        return 'Bring a medium jacket.'
+
+    def send(self, phone_number, body):
+        self.sent.append(phone_number)
+        return True
+
+def test_send_pipeline_groups_and_dedupes(client):
+    """Weather is fetched per zipcode, recommendations per bucket, sends once a day."""
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO users (phone_number, password, zipcode) VALUES (?, ?, ?)',
+            [(f'+1555000000{i}', 'x', '53717' if i % 2 else '60601') for i in range(6)]
+        )
+        db.commit()
+        providers = FakeProviders()
+        report = SendPipeline(providers, connect_db, '2026-01-05', weather_workers=2).run(db)
+        assert report['counters']['weather_calls'] == 2
+        assert report['counters']['recommendation_calls'] == 1
+        assert report['counters']['sent'] == 6
+        assert len(providers.sent) == 6
+
+        rerun = SendPipeline(providers, connect_db, '2026-01-05').run(db)
+        assert rerun['counters']['users_claimed'] == 0
+        assert len(providers.sent) == 6
+
+def test_interrupted_run_resumes_after_checkpoint(client):
+    """A resumed run skips checkpointed users and retakes its own open claims."""
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO users (phone_number, password, zipcode) VALUES (?, ?, ?)',
+            [(f'+1555000000{i}', 'x', '53717') for i in range(5)]
+        )
+        db.commit()
+        # Users 1-2 were sent and checkpointed, user 3 was claimed when the run stopped
+        begin_run(db, 'daily:2026-01-05', '2026-01-05', '1', [], 'old-worker')
+        claim_daily_sends(db, [1, 2, 3], '2026-01-05', 'daily:2026-01-05', 'old-worker')
+        mark_daily_sends(db, [1, 2], '2026-01-05')
+        checkpoint_run(db, 'daily:2026-01-05', 'old-worker', ('53717', 2))
+        finish_run(db, 'daily:2026-01-05', 'old-worker', RUN_INTERRUPTED)
+
+        providers = FakeProviders()
+        pipeline = SendPipeline(providers, connect_db, '2026-01-05')
+        report = pipeline.run(db, run_id='daily:2026-01-05', owner='new-worker')
+        assert sorted(providers.sent) == ['+15550000002', '+15550000003', '+15550000004']
+        assert report['counters']['sent'] == 3
+        # Completed runs are not started again
+        assert SendPipeline(providers, connect_db, '2026-01-05').run(db, run_id='daily:2026-01-05') is None
+
+def test_failed_run_tears_down_stage_threads(client):
+    """If recording outcomes fails, every stage thread exits and the run stays resumable."""
+    class FailingPipeline(SendPipeline):
+        def record_outcomes(self, db, results, batch_size=100):
+            results.get()
+            raise sqlite3.OperationalError('database is locked')
+
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO users (phone_number, password, zipcode) VALUES (?, ?, ?)',
+            [(f'+1555{i:07d}', 'x', f'{53000 + i}') for i in range(50)]
+        )
+        db.commit()
+        pipeline = FailingPipeline(FakeProviders(), connect_db, '2026-01-06', queue_size=1, group_size=1)
+        with pytest.raises(sqlite3.OperationalError):
+            pipeline.run(db, run_id='daily:2026-01-06', owner='worker')
+        assert not [t for t in threading.enumerate() if t.name.startswith('pipeline-')]
+        status = db.execute("SELECT status FROM send_runs WHERE run_id = 'daily:2026-01-06'").fetchone()[0]
+        assert status == RUN_INTERRUPTED
+
+def test_crashed_run_resumes_after_quick_restart(client):
+    """A run whose process died is resumable at once, not after the stale timeout."""
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO users (phone_number, password, zipcode) VALUES (?, ?, ?)',
+            [(f'+1555000000{i}', 'x', '53717') for i in range(3)]
+        )
+        db.commit()
+        # The crashed run had claimed everyone and sent nothing; its heartbeat is fresh
+        begin_run(db, 'dispatch:2026-01-07:0700:x', '2026-01-07', '1', [], f'{socket.gethostname()}:{dead.pid}')
+        claim_daily_sends(db, [1, 2, 3], '2026-01-07', 'dispatch:2026-01-07:0700:x', f'{socket.gethostname()}:{dead.pid}')
+        begin_run(db, 'dispatch:2026-01-07:0701:x', '2026-01-07', '1', [], f'{socket.gethostname()}:{os.getpid()}')
+
+        runs = resumable_runs(db, '2026-01-07')
+        assert [run_id for run_id, _, _ in runs] == ['dispatch:2026-01-07:0700:x']
+        providers = FakeProviders()
+        SendPipeline(providers, connect_db, '2026-01-07').run(db, runs[0][1], runs[0][2], runs[0][0], 'new-worker')
+        assert len(providers.sent) == 3
+
+def test_taken_over_run_stops_sending(client):
+    """A slow run keeps its heartbeat fresh, and stops once another process takes it over."""
+    run_id = 'daily:2026-01-08'
+
+    class SlowProviders(FakeProviders):
+        def send(self, phone_number, body):
+            if not self.sent:
+                time.sleep(0.2)
+                conn = connect_db()
+                updated_at = conn.execute('SELECT updated_at FROM send_runs WHERE run_id = ?', [run_id]).fetchone()[0]
+                assert updated_at > started
+                # Another process decides the run is stale and takes it over
+                later = time.time() + RUN_STALE_SECONDS + 1
+                assert [run[0] for run in resumable_runs(conn, '2026-01-08', now=later)] == [run_id]
+                assert begin_run(conn, run_id, '2026-01-08', '1', [], 'new-worker', now=later) is None
+                conn.close()
+            return super().send(phone_number, body)
+
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO users (phone_number, password, zipcode) VALUES (?, ?, ?)',
+            [(f'+1556{i:07d}', 'x', f'{54000 + i}') for i in range(40)]
+        )
+        db.commit()
+        providers = SlowProviders()
+        pipeline = SendPipeline(providers, connect_db, '2026-01-08', group_size=1, queue_size=1,
+                                claim_batch=1, send_workers=1, heartbeat_seconds=0.01)
+        started = time.time()
+        pipeline.run(db, run_id=run_id, owner='old-worker')
+        # Only deliveries already inside the pipeline's queues can still go out
+        assert pipeline.lost and len(providers.sent) < 20
+        assert db.execute('SELECT owner, status FROM send_runs WHERE run_id = ?', [run_id]).fetchone()[:] == ('new-worker', RUN_RUNNING)
+        assert not finish_run(db, run_id, 'old-worker', RUN_INTERRUPTED)
+
+def test_dispatch_skips_minutes_with_nobody_due(client):
+    """An empty dispatcher tick records no run."""
+    count_runs = "SELECT COUNT(*) FROM send_runs WHERE run_id LIKE 'dispatch:%'"
+    with app.app_context():
+        before = get_db().execute(count_runs).fetchone()[0]
+    dispatch_due_users()
+    with app.app_context():
+        assert get_db().execute(count_runs).fetchone()[0] == before
+
+def test_dry_run_writes_nothing(client):
+    """A dry run reports upstream calls without claiming or texting."""
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO users (phone_number, password, zipcode) VALUES ('+11111111111', 'x', '53717')")
+        db.commit()
+    rv = client.get('/simulate-daily-run')
+    report = rv.get_json()
+    assert rv.status_code == 200
+    assert report['dry_run'] and report['upstream_calls']['send'] == 1
+    assert report['projection']['projected_wall_seconds'] > 0
+    with app.app_context():
+        assert get_db().execute('SELECT COUNT(*) FROM daily_sends').fetchone()[0] == 0
+
+def test_latency_histogram_percentiles():
+    """Percentiles come from fixed buckets and stay within a few percent."""
+    histogram = LatencyHistogram()
+    for ms in range(1, 1001):
+        histogram.record(ms / 1000)
+    buckets = len(histogram.counts)
+    for _ in range(1000):
+        histogram.record(0.5)
+    assert len(histogram.counts) == buckets
+    stats = histogram.snapshot()
+    assert stats['count'] == 2000 and stats['max_ms'] == 1000.0
+    assert abs(stats['p50_ms'] - 500) / 500 < 0.02
+    assert abs(stats['p99_ms'] - 980) / 980 < 0.02
+
+def test_metrics_endpoint(client):
+    """/metrics exposes request counts, and unknown routes still 404."""
+    assert client.get('/no-such-page').status_code == 404
+    rv = client.get('/metrics')
+    assert rv.status_code == 200
+    body = rv.get_data(as_text=True)
+    assert 'flask_request_count_total{endpoint="unknown",method="GET",status="404"}' in body
+    assert 'flask_active_users' not in body
+
+def test_track_api_request_records_upstream_metrics():
+    """Upstream calls record latency by status, payload size and retries."""
+    class RawResponse:
+        content = b'x' * 300
+        retries_taken = 2
+
+    @track_api_request('testapi', 'fetch')
+    def fetch(fail=False):
+        if fail:
+            raise ConnectionError('down')
+        return RawResponse()
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, dict(api='testapi', operation='fetch', **labels)) or 0
+
+    fetch()
+    with pytest.raises(ConnectionError):
+        fetch(fail=True)
+    assert sample('upstream_request_latency_seconds_count', status='success') == 1
+    assert sample('upstream_request_latency_seconds_count', status='error') == 1
+    assert sample('upstream_payload_bytes_sum') == 300
+    assert sample('upstream_retries_total') == 2
+
+def test_logging_levels_sampling_and_full_queue():
+    """Per-logger levels parse, sampling thins INFO only, and a full queue drops."""
+    assert parse_levels('WARNING,pipeline=debug') == ('WARNING', {'pipeline': 'DEBUG'})
+
+    def record(level):
+        return logging.LogRecord('request_tracker', level, __file__, 1, 'hit %s', ('x',), None)
+    sampler = SamplingFilter(0.1)
+    assert sum(sampler.filter(record(logging.INFO)) for _ in range(100)) == 10
+    assert all(sampler.filter(record(logging.ERROR)) for _ in range(5))
+
+    handler = DroppingQueueHandler(queue.Queue(1))
+    handler.handle(record(logging.INFO))
+    handler.handle(record(logging.INFO))
+    assert handler.dropped == 1 and handler.queue.get_nowait().getMessage() == 'hit x'
+
+def test_server_timing_breakdown(client, monkeypatch):
+    """Server-Timing is opt-in, shows template rendering, and queries record db spans."""
+    assert 'Server-Timing' not in client.get('/login').headers
+    monkeypatch.setattr(app, 'debug', True)
+    assert 'Server-Timing' not in client.get('/login').headers
+    with app.test_request_context('/', headers={'X-Server-Timing': 'let-me-see'}):
+        assert wants_server_timing('let-me-see')
+    with app.test_request_context('/', headers={'X-Server-Timing': 'guess'}):
+        assert not wants_server_timing('let-me-see')
+    monkeypatch.setattr(tracing, 'SERVER_TIMING', True)
+    header = client.get('/login').headers['Server-Timing']
+    assert 'template;dur=' in header and 'total;dur=' in header
+
+    with app.test_request_context('/'):
+        g._trace = Trace()
+        db = get_db()
+        db.execute('SELECT COUNT(*) FROM users').fetchone()
+        db.execute('SELECT 1').fetchone()
+        assert g._trace.totals()['db'][1] == 2
+
+def test_identity_map_replaces_cached_miss(client):
+    """A user cached as missing is filled in by a later lookup."""
+    with app.test_request_context('/'):
+        db = get_db()
+        db.execute("INSERT INTO users (phone_number, password, zipcode) VALUES ('+15550001111', 'x', '53717')")
+        db.commit()
+        user_id = db.execute("SELECT id FROM users WHERE phone_number = '+15550001111'").fetchone()[0]
+        _identity_map()[user_id] = None
+        assert find_user_by_phone('+15550001111', view='contact')['id'] == user_id
+        assert get_user(user_id, view='contact')['zipcode'] == '53717'
+
+def test_redis_rate_limit_circuit_breaker():
+    """After a Redis failure, checks skip Redis until the retry time passes."""
+    backend = RedisBackend('redis://127.0.0.1:1', retry_seconds=60)
+    calls = []
+    def failing_script(**kwargs):
+        calls.append(kwargs)
+        raise redis.ConnectionError('connection refused')
+    backend.script = failing_script
+    assert backend.hit('ip', 5, 60) == (True, 0)
+    assert backend.hit('ip', 5, 60) == (True, 0)
+    assert len(calls) == 1 and backend.down
+    backend.retry_at = 0
+    backend.hit('ip', 5, 60)
+    assert len(calls) == 2
+
+def test_shared_failed_login_scores_decay_after_merge():
+    """Scores merged back from Redis decay like local ones; the larger score wins."""
+    class FakePipeline:
+        def __init__(self, results):
+            self.results = results
+        def delete(self, key):
+            pass
+        def execute(self):
+            return self.results
+
+    tracker = FailedLoginTracker(threshold=3, half_life=60)
+    tracker.redis = type('FakeRedis', (), {'pipeline': lambda self, transaction: FakePipeline(['2.9'])})()
+    tracker.record_script = lambda keys, args, client: None
+    key = tracker._key('+15550000000', '1.2.3.4')
+    tracker.record_failure('+15550000000', '1.2.3.4')
+    tracker.flush([('incr', key)])
+    assert tracker.is_blocked('+15550000000', '1.2.3.4')
+
+    # One half-life later the shared failures have decayed below the threshold
+    score, updated = tracker.counts[key]
+    tracker.counts[key] = (score, updated - 60)
+    assert not tracker.is_blocked('+15550000000', '1.2.3.4')
+
+    tracker.redis = type('FakeRedis', (), {'pipeline': lambda self, transaction: FakePipeline(['0.5'])})()
+    tracker.flush([('incr', key)])
+    assert tracker._decayed(key, time.monotonic()) == pytest.approx(score / 2, rel=0.01)
+
 if __name__ == '__main__':
     pytest.main([__file__])
\ No newline at end of file
@@ -0,0 +1,194 @@
+"""Lightweight per-request tracing.
+
+Spans are timed around SQLite calls, upstream API calls, template
+rendering and JSON serialization. They are collected on the request and
+summed per name into a ``Server-Timing`` header, which browser dev tools
+show as the request's latency breakdown::
+
+    Server-Timing: db;dur=3.1;desc="7 calls", openweathermap;dur=212.4;desc="current", total;dur=236.0
+
+The header exposes internals, so it is only sent with ``SERVER_TIMING=1``
+or to requests whose ``X-Server-Timing`` header matches
+``SERVER_TIMING_TOKEN``. Debug mode doesn't turn it on, since production
+runs ``app.py`` with debug set.
+
+With ``TRACE_FILE`` set, every request is also written there as one JSON
+line with its individual spans. The writes go through a queue and a
+background thread, like the rest of the logging.
+
+Outside a request (the scheduler, the send pipeline threads) spans cost
+one context lookup and record nothing.
+"""
+import hmac
+import json
+import logging
+import os
+import queue
+import sqlite3
+import time
+from contextlib import contextmanager
+from logging.handlers import QueueListener, RotatingFileHandler
+from flask import before_render_template, g, has_request_context, request, template_rendered
+from flask.json.provider import DefaultJSONProvider
+from logconfig import DroppingQueueHandler, LOG_FILE_BACKUP_COUNT, LOG_FILE_MAX_BYTES, LOG_QUEUE_SIZE
+
+SERVER_TIMING = os.getenv('SERVER_TIMING', '0') == '1'
+SERVER_TIMING_TOKEN = os.getenv('SERVER_TIMING_TOKEN', '')
+TRACE_FILE = os.getenv('TRACE_FILE', '')
+TRACE_MAX_SPANS = int(os.getenv('TRACE_MAX_SPANS', 200))
+
+trace_logger = logging.getLogger('tracing.requests')
+
+class Trace:
+    """Spans recorded during one request."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = []
+        self.dropped = 0
+
+    def add(self, name, started, elapsed, desc=None):
+        # Loops over many rows would otherwise grow the span list without bound
+        if len(self.spans) < TRACE_MAX_SPANS:
+            self.spans.append((name, desc, started - self.start, elapsed))
+        else:
+            self.dropped += 1
+
+    def totals(self):
+        """Return {name: [total seconds, calls, desc]} in first-seen order."""
+        totals = {}
+        for name, desc, _, elapsed in self.spans:
+            entry = totals.setdefault(name, [0.0, 0, desc])
+            entry[0] += elapsed
+            entry[1] += 1
+        return totals
+
+def current_trace():
+    return g.get('_trace') if has_request_context() else None
+
+@contextmanager
+def span(name, desc=None):
+    """Time the enclosed block as a span of the current request, if any."""
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, started, time.perf_counter() - started, desc)
+
+class TracedConnection(sqlite3.Connection):
+    """sqlite3 connection that records a ``db`` span per statement and commit.
+
+    Rows fetched after execute returns are read outside the span.
+    """
+
+    def execute(self, *args):
+        if current_trace() is None:
+            return super().execute(*args)
+        with span('db'):
+            return super().execute(*args)
+
+    def executemany(self, *args):
+        if current_trace() is None:
+            return super().executemany(*args)
+        with span('db'):
+            return super().executemany(*args)
+
+    def commit(self):
+        if current_trace() is None:
+            return super().commit()
+        with span('db'):
+            return super().commit()
+
+class TracedJSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider with a ``json`` span around serialization."""
+
+    def dumps(self, obj, **kwargs):
+        with span('json'):
+            return super().dumps(obj, **kwargs)
+
+def server_timing(trace, total):
+    """Format a trace as a Server-Timing header value."""
+    metrics = []
+    for name, (elapsed, calls, desc) in trace.totals().items():
+        if calls > 1:
+            desc = f'{calls} calls'
+        metric = f'{name};dur={elapsed * 1000:.1f}'
+        metrics.append(f'{metric};desc="{desc}"' if desc else metric)
+    metrics.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(metrics)
+
+def wants_server_timing(token=SERVER_TIMING_TOKEN):
+    """Whether the current response may carry a Server-Timing header."""
+    if SERVER_TIMING:
+        return True
+    return bool(token) and hmac.compare_digest(request.headers.get('X-Server-Timing', ''), token)
+
+def trace_record(trace, total, response):
+    return {
+        'ts': time.time(),
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'duration_ms': round(total * 1000, 2),
+        'spans': [
+            {'name': name, 'desc': desc, 'start_ms': round(start * 1000, 2), 'duration_ms': round(elapsed * 1000, 2)}
+            for name, desc, start, elapsed in trace.spans
+        ],
+        'dropped_spans': trace.dropped
+    }
+
+trace_listener = None
+
+def start_trace_file(path):
+    """Send trace records to a JSON Lines file through a background writer."""
+    global trace_listener
+    if trace_listener is not None:
+        return
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    handler = RotatingFileHandler(path, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUP_COUNT)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    trace_logger.addHandler(DroppingQueueHandler(records))
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.propagate = False
+    trace_listener = QueueListener(records, handler)
+    trace_listener.start()
+
+def init_tracing(app, trace_file=TRACE_FILE):
+    """Collect spans for every request and report them when it finishes."""
+    app.json = TracedJSONProvider(app)
+    if trace_file:
+        start_trace_file(trace_file)
+
+    @app.before_request
+    def start_trace():
+        g._trace = Trace()
+
+    @app.after_request
+    def finish_trace(response):
+        trace = current_trace()
+        if trace is None:
+            return response
+        total = time.perf_counter() - trace.start
+        if wants_server_timing():
+            response.headers['Server-Timing'] = server_timing(trace, total)
+        if trace_listener is not None:
+            trace_logger.info('%s', json.dumps(trace_record(trace, total, response)))
+        return response
+
+    def template_started(sender, template, context, **extra):
+        g._template_started = time.perf_counter()
+
+    def template_finished(sender, template, context, **extra):
+        trace = current_trace()
+        started = g.pop('_template_started', None)
+        if trace is not None and started is not None:
+            trace.add('template', started, time.perf_counter() - started, template.name)
+
+    before_render_template.connect(template_started, app, weak=False)
+    template_rendered.connect(template_finished, app, weak=False)
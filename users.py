@@ -0,0 +1,140 @@
+"""Queries against the users table.
+
+Each use case reads only the columns it needs (its "view"), so pages that
+show a profile or fetch weather never load the password hash. The only
+view that includes the hash is ``credentials``, which is used to check a
+login and is never cached.
+
+Within a request, rows are kept in an identity map on ``flask.g``, keyed by
+user id. Asking twice for the same user, or for a view whose columns are
+already loaded, does not touch the database again. Writes through this
+module drop the cached row. Bulk paths use ``iter_users``, which streams
+projected rows in batches instead of materializing the whole table.
+
+``get_profile`` additionally goes through the cross-request profile cache
+(see profile_cache.py), so the dashboard's polls don't read SQLite at all.
+"""
+from flask import g
+from database import get_db
+from geocode import geocode_zip
+from profile_cache import invalidate_profile, profile_cache
+
+USER_VIEWS = {
+    'profile': ('id', 'phone_number', 'zipcode', 'send_minute', 'latitude', 'longitude',
+                'temperature_sensitivity', 'temperature_unit'),
+    'location': ('id', 'zipcode', 'latitude', 'longitude'),
+    'contact': ('id', 'phone_number', 'zipcode'),
+    'credentials': ('id', 'password'),
+}
+
+def _identity_map():
+    users = getattr(g, '_users', None)
+    if users is None:
+        users = g._users = {}
+    return users
+
+def _remember(user_id, columns):
+    """Merge loaded columns into the identity map, replacing a cached miss."""
+    users = _identity_map()
+    cached = users.get(user_id)
+    if cached is None:
+        cached = users[user_id] = {}
+    cached.update(columns)
+    return cached
+
+def _select(view):
+    return 'SELECT ' + ', '.join(USER_VIEWS[view]) + ' FROM users'
+
+def get_user(user_id, view='profile'):
+    """Return the user's columns for ``view`` as a dict, or None."""
+    users = _identity_map()
+    cached = users.get(user_id, {})
+    columns = USER_VIEWS[view]
+    if user_id in users and (cached is None or all(column in cached for column in columns)):
+        return cached
+
+    row = get_db().execute(f'{_select(view)} WHERE id = ?', [user_id]).fetchone()
+    if row is None:
+        users[user_id] = None
+        return None
+    if view == 'credentials':
+        return dict(row)
+    return _remember(user_id, dict(row))
+
+def get_profile(user_id):
+    """Return the user's profile view, cached across requests."""
+    profile = profile_cache.get(user_id)
+    if profile is not None:
+        _remember(user_id, profile)
+        return profile
+
+    user = get_user(user_id)
+    if user is None:
+        return None
+    profile = {column: user[column] for column in USER_VIEWS['profile']}
+    profile_cache.set(user_id, profile)
+    return profile
+
+def find_user_by_phone(phone_number, view='credentials'):
+    """Look a user up by their formatted phone number."""
+    row = get_db().execute(f'{_select(view)} WHERE phone_number = ?', [phone_number]).fetchone()
+    if row is None:
+        return None
+    if view != 'credentials':
+        _remember(row['id'], dict(row))
+    return dict(row)
+
+def phone_registered(phone_number):
+    """Return True when the phone number already belongs to a user."""
+    return get_db().execute(
+        'SELECT 1 FROM users WHERE phone_number = ?', [phone_number]
+    ).fetchone() is not None
+
+def count_users():
+    return get_db().execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+def iter_users(view='contact', db=None, batch_size=500):
+    """Yield every user's columns for ``view``, fetched in batches."""
+    db = db or get_db()
+    cursor = db.execute(f'{_select(view)} ORDER BY id')
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        for row in rows:
+            yield dict(row)
+
+def update_contact(user_id, zipcode, phone_number):
+    """Change a user's zipcode and phone number, re-geocoding from the local index.
+
+    ZIPs the index doesn't have are resolved later by the scheduled backfill.
+    """
+    latitude, longitude = geocode_zip(zipcode)
+    db = get_db()
+    db.execute(
+        'UPDATE users SET zipcode = ?, phone_number = ?, latitude = ?, longitude = ? WHERE id = ?',
+        [zipcode, phone_number, latitude, longitude, user_id]
+    )
+    db.commit()
+    forget_user(user_id)
+
+def update_preferences(user_id, temperature_unit, temperature_sensitivity):
+    """Change a user's temperature unit and sensitivity."""
+    db = get_db()
+    db.execute(
+        'UPDATE users SET temperature_unit = ?, temperature_sensitivity = ? WHERE id = ?',
+        [temperature_unit, temperature_sensitivity, user_id]
+    )
+    db.commit()
+    forget_user(user_id)
+
+def update_password(user_id, password_hash):
+    """Replace a user's password hash, e.g. to upgrade its parameters."""
+    db = get_db()
+    db.execute('UPDATE users SET password = ? WHERE id = ?', [password_hash, user_id])
+    db.commit()
+
+def forget_user(user_id):
+    """Drop a user from this request's identity map and the profile cache."""
+    _identity_map().pop(user_id, None)
+    invalidate_profile(user_id)